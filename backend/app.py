@@ -3,10 +3,13 @@ import psycopg2
 from psycopg2.extras import RealDictCursor, execute_values, DictCursor  # Added DictCursor if needed
 import pandas as pd
 import io
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, g
 from flask_cors import CORS
 import datetime
 import re
+import json
+import threading
+import time
 # werkzeug.utils is already imported implicitly by Flask, but good to be explicit if using functions
 # from werkzeug.utils import secure_filename # Uncomment if you explicitly use secure_filename
 
@@ -14,16 +17,49 @@ import re
 # Make sure your scheduler_module.py contains load_data_from_db and generate_excel_report_for_send_file
 # and the TimetableEntry class (likely a namedtuple or dataclass)
 import scheduler_module
+import db_instrumentation
+import metrics
+import profiling
+import scheduling_jobs
+import singleflight
+import structured_logging
+
+# 日志统一走结构化日志的队列 (JSON 行，LOG_FORMAT=text 为普通文本)；app.logger 没有自己的处理器，
+# 记录经根 logger 输出，请求线程不等待 stderr 写入
+structured_logging.configure()
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
+
+class TimedJSONProvider(app.json_provider_class):
+    """jsonify 的序列化耗时计入当前请求 (Server-Timing 中的 json 项)。"""
+
+    def dumps(self, obj, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            db_instrumentation.record_json((time.perf_counter() - started) * 1000)
+
+
+app.json_provider_class = TimedJSONProvider
+app.json = TimedJSONProvider(app)
+
 # --- Database Configuration ---
 # TODO: In production, use environment variables exclusively and avoid default sensitive values
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_NAME = os.getenv("DB_NAME", "postgres")
 DB_USER = os.getenv("DB_USER", "postgres")  # Replace with your DB user
 DB_PASSWORD = os.getenv("DB_PASSWORD", "031104")  # Replace with your DB password
+# 设为 1 时在首次请求前把 timetable_entries 迁移为按 semester_id 分区的表
+TIMETABLE_PARTITIONED = os.getenv("TIMETABLE_PARTITIONED", "0") == "1"
+# 同时运行的后台排课进程数
+SCHEDULING_WORKERS = int(os.getenv("SCHEDULING_WORKERS", "1"))
+# psycopg2.connect 的参数，后台排课子进程用它自行建立连接
+DB_CONNECT_PARAMS = dict(host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASSWORD)
+# 设为 0 时关闭数据库语句计时、慢查询日志和 Server-Timing 响应头 (慢查询阈值见 DB_SLOW_QUERY_MS)
+DB_INSTRUMENTATION = os.getenv("DB_INSTRUMENTATION", "1") != "0"
 
 
 # WARNING: Storing password directly in code or env vars is not ideal for production.
@@ -48,12 +84,10 @@ def get_teacher_id_by_user_id(user_id):
 def get_db_connection():
     """Establishes and returns a database connection."""
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
+        if DB_INSTRUMENTATION:
+            conn = db_instrumentation.connect(**DB_CONNECT_PARAMS)  # 语句计时，见 db_instrumentation.py
+        else:
+            conn = psycopg2.connect(**DB_CONNECT_PARAMS)
         # conn.autocommit = True # Only enable autocommit if you are sure you don't need transactions
         return conn
     except psycopg2.Error as e:
@@ -62,6 +96,61 @@ def get_db_connection():
         return None
 
 
+# --- 请求级数据库计时和请求指标 (先于其他 before_request 注册，表结构初始化的查询也计入) ---
+@app.before_request
+def begin_request_metrics():
+    g.metrics_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"  # 不用原始路径，避免标签无限增长
+        metrics.HTTP_REQUEST_DURATION.observe(time.perf_counter() - started, route=route, method=request.method)
+        metrics.HTTP_REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+    return response
+
+
+@app.before_request
+def begin_db_timing():
+    if DB_INSTRUMENTATION:
+        db_instrumentation.begin_request(request.url_rule.rule if request.url_rule else request.path)
+
+
+@app.after_request
+def add_server_timing_header(response):
+    timings = db_instrumentation.end_request()
+    if timings is not None:
+        response.headers['Server-Timing'] = timings.server_timing()
+    return response
+
+
+@app.teardown_request
+def end_db_timing(exc):
+    db_instrumentation.end_request()  # 未处理的异常不会经过 after_request，这里清掉本线程的统计
+
+
+# --- 表结构初始化 (每个进程只成功执行一次) ---
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+@app.before_request
+def ensure_schema_ready():
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        try:
+            scheduler_module.ensure_schedule_schema(get_db_connection, partition_timetable=TIMETABLE_PARTITIONED)
+            _schema_ready = True
+        except Exception as e:
+            # 不阻塞当前请求，下一个请求会再试
+            app.logger.error(f"Error preparing timetable schema: {e}", exc_info=True)
+
+
 @app.route('/register', methods=['POST'])
 def register():
     data = request.get_json()
@@ -110,7 +199,7 @@ def register():
         return jsonify({'message': 'Username already exists or ID conflict!'}), 409
     except Exception as e:
         if conn: conn.rollback()
-        print(f"Error during registration: {e}")
+        app.logger.error("Error during registration: %s", e, exc_info=True)
         return jsonify({'message': 'An error occurred during registration.'}), 500
     finally:
         if cur: cur.close()
@@ -152,7 +241,7 @@ def login():
         else:
             return jsonify({'message': 'Invalid username, password, or user type.'}), 401
     except Exception as e:
-        print(f"Error during login: {e}")
+        app.logger.error("Error during login: %s", e, exc_info=True)
         return jsonify({'message': 'An error occurred during login.'}), 500
     finally:
         if cur: cur.close()
@@ -318,6 +407,8 @@ def upload_course_plans():
     updated_courses_count = 0
     inserted_assignments_count = 0
     error_messages = []
+    import_started = time.perf_counter()
+    import_status = "error"
 
     try:
         # Use BytesIO to pass the file content to pandas
@@ -487,9 +578,11 @@ def upload_course_plans():
 
         if error_messages:
             summary_message += "\n处理过程中遇到以下问题 (部分行可能已跳过):\n" + "\n".join(error_messages)
+            import_status = "partial_success"
             # Use status code 207 (Multi-Status) to indicate partial success
             return jsonify({"message": summary_message, "status": "partial_success"}), 207
         else:
+            import_status = "success"
             return jsonify({"message": summary_message, "status": "success"}), 200
 
     except pd.errors.EmptyDataError:
@@ -512,6 +605,11 @@ def upload_course_plans():
         if conn:
             conn.autocommit = True  # Restore default autocommit behavior if needed, or just close
             conn.close()
+        # 导入吞吐量 = rate(import_rows_total) / rate(import_duration_seconds_sum)
+        metrics.IMPORT_DURATION.observe(time.perf_counter() - import_started, status=import_status)
+        metrics.IMPORT_ROWS.inc(processed_rows, stage="processed")
+        if import_status != "error":  # 出错时事务已回滚
+            metrics.IMPORT_ROWS.inc(inserted_assignments_count, stage="inserted")
 
 
 @app.route('/api/course-plans/template', methods=['GET'])
@@ -887,22 +985,126 @@ def update_course_plan(plan_id):
             conn.close()
 
 
+# 请求体中的开关参数: 只接受 JSON 布尔值或 '1'/'true'/'yes'、'0'/'false'/'no' (不区分大小写)
+TRUE_FLAG_VALUES = ('1', 'true', 'yes')
+FALSE_FLAG_VALUES = ('0', 'false', 'no')
+
+def parse_flag(value, default):
+    """解析开关参数，value 为 None (未提供) 时返回 default，无法识别时抛出 ValueError。"""
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        lowered = value.strip().lower()
+        if lowered in TRUE_FLAG_VALUES:
+            return True
+        if lowered in FALSE_FLAG_VALUES:
+            return False
+    raise ValueError(f"无法识别的开关值: {value!r}")
+
+
+# --- 后台排课任务 ---
+_job_manager = None
+_job_manager_lock = threading.Lock()
+
+def get_job_manager():
+    """第一次使用时创建排课任务队列 (此时 DB_CONNECT_PARAMS 已确定)。"""
+    global _job_manager
+    with _job_manager_lock:
+        if _job_manager is None:
+            _job_manager = scheduling_jobs.SchedulingJobManager(DB_CONNECT_PARAMS, max_workers=SCHEDULING_WORKERS)
+        return _job_manager
+
+
+# 同步排课 (?wait=1) 的进程内合并: 相同学期、相同参数的并发请求只执行一次并共享结果。
+# 跨进程/跨实例的互斥由 scheduler_module 中的学期 advisory lock 保证。
+_run_flight = singleflight.SingleFlight()
+
 # Route to trigger the scheduling algorithm
+# 默认提交到后台任务队列并立即返回 202 和 job_id；?wait=1 时在当前请求内同步执行 (旧行为)
 @app.route('/api/schedule/run/<int:semester_id>', methods=['POST'])
 def run_scheduling_for_semester_api(semester_id):
     app.logger.info(f"API: Received request to run scheduling for semester_id: {semester_id}")
+    # 默认边排课边写库 (streaming)，?streaming=0 可退回到排完后一次性写入
+    streaming = request.args.get('streaming', '1').lower() not in ('0', 'false', 'no')
+    # ?storage=series 时按模板时段压缩存储 (每个时段一行 + 周次数组)
+    storage_mode = request.args.get('storage', 'rows').lower()
+    if storage_mode not in ('rows', 'series'):
+        return jsonify({"message": "storage 参数只能是 rows 或 series"}), 400
+    # ?incremental=1 时只重排自上次排课以来教学任务有变化的专业
+    incremental = request.args.get('incremental', '0').lower() in ('1', 'true', 'yes')
+    # 默认从上次中断的检查点继续 (输入未变时)，?resume=0 强制从头排课
+    resume = request.args.get('resume', '1').lower() not in ('0', 'false', 'no')
+    # ?memory_budget_mb=N 设置本次排课的内存预算 (接近预算时改为流式写库或中止)，?track_memory=1 只统计内存
+    try:
+        memory_budget_mb = float(request.args['memory_budget_mb']) if request.args.get('memory_budget_mb') else None
+    except ValueError:
+        return jsonify({"message": "memory_budget_mb 必须是数字"}), 400
+    if memory_budget_mb is not None and memory_budget_mb < 0:
+        return jsonify({"message": "memory_budget_mb 不能为负数"}), 400
+    track_memory = request.args.get('track_memory', '0').lower() in ('1', 'true', 'yes')
+    if request.args.get('wait', '0').lower() not in ('1', 'true', 'yes'):
+        profile = profiling.take('scheduling')  # 管理员布置的分析随任务传给排课子进程
+        try:
+            if profile is not None:
+                job, joined = get_job_manager().submit(semester_id, streaming=streaming, storage_mode=storage_mode,
+                                                       incremental=incremental, resume=resume,
+                                                       memory_budget_mb=memory_budget_mb, track_memory=track_memory,
+                                                       profile=profile), False
+            else:
+                # 相同学期、相同参数的任务还没结束时直接返回该任务，不重复排课
+                job, joined = get_job_manager().submit_or_join(semester_id, streaming=streaming,
+                                                               storage_mode=storage_mode, incremental=incremental,
+                                                               resume=resume, memory_budget_mb=memory_budget_mb,
+                                                               track_memory=track_memory)
+        except Exception as e:
+            app.logger.error(f"API: Error submitting scheduling job for semester {semester_id}: {e}", exc_info=True)
+            return jsonify({"message": "提交排课任务失败"}), 500
+        return jsonify({
+            "message": "已有相同的排课任务在进行，已合并到该任务" if joined else "排课任务已提交",
+            "job_id": job.id,
+            "status": job.status,
+            "joined": joined,
+            "status_url": f"/api/schedule/jobs/{job.id}"
+        }), 202
+    # tracemalloc 是进程全局的，Web 进程里的预算会把其他请求的分配也算进来: 同步排课只统计，不设预算
+    # (也不使用 SCHEDULING_MEMORY_BUDGET_MB 默认预算)
+    if memory_budget_mb:
+        return jsonify({"message": "memory_budget_mb 只能用于后台排课任务，不能与 wait=1 同时使用"}), 400
     try:
         # Pass the app's get_db_connection function to the scheduler module
         # The scheduler module should handle connecting, fetching data, running algo, saving results, disconnecting
-        scheduling_summary = scheduler_module.run_full_scheduling_process(semester_id, get_db_connection)
+        scheduling_summary, shared = _run_flight.do(
+            ('run', semester_id, streaming, storage_mode, incremental, resume, track_memory),
+            lambda: scheduler_module.run_full_scheduling_process(semester_id, get_db_connection,
+                                                                 streaming=streaming,
+                                                                 storage_mode=storage_mode,
+                                                                 incremental=incremental,
+                                                                 resume=resume,
+                                                                 memory_budget_mb=0,
+                                                                 track_memory=track_memory))
 
         app.logger.info(
-            f"API: Scheduling for semester {semester_id} finished. Status: {scheduling_summary.get('status')}")
+            f"API: Scheduling for semester {semester_id} finished. Status: {scheduling_summary.get('status')}"
+            f"{' (shared with a concurrent request)' if shared else ''}")
+        if not shared:
+            metrics.record_scheduling_run(scheduling_summary)
 
         status = scheduling_summary.get("status", "failure").lower()
         message = scheduling_summary.get("message", "排课已执行。")
-        summary = scheduling_summary.get("summary", {})  # Ensure summary is included
+        # 整个摘要 (含 stats 分阶段耗时和热点计数)；冲突只返回计数，?conflicts=1 时附带冲突说明 (?conflict_limit=N 条)
+        if request.args.get('conflicts', '0').lower() in ('1', 'true', 'yes'):
+            summary = dict(scheduling_summary)
+            summary["conflicts"] = scheduler_module.describe_conflicts(
+                scheduling_summary.get("conflicts", []), load_export_lookup_data(),
+                limit=request.args.get('conflict_limit', 500, type=int))
+        else:
+            summary = scheduler_module.summary_without_conflicts(scheduling_summary)
 
+        if status == "busy":
+            # 同一学期的排课正在其他请求/进程中进行
+            return jsonify({"message": message}), 409
         if status.startswith("success"):
             # Successfully ran, even if some constraints weren't met (might be partial success)
             # scheduler_module should indicate if it's partial or full success
@@ -925,6 +1127,183 @@ def run_scheduling_for_semester_api(semester_id):
         return jsonify({"message": f"执行排课时发生内部错误。"}), 500
 
 
+# 多学期批量排课: 请求体 {"semester_ids": [1, 2, ...], "workers": 可选}，基础数据只加载一次，
+# 各学期在独立进程中并行排课。作为后台任务提交，立即返回 202 和 job_id；
+# 完成后 /api/schedule/jobs/<job_id> 的 summary 为合并摘要 (含各学期耗时)。
+@app.route('/api/schedule/batch', methods=['POST'])
+def run_batch_scheduling_api():
+    data = request.get_json(silent=True) or {}
+    semester_ids = data.get('semester_ids')
+    if not isinstance(semester_ids, list) or not semester_ids:
+        return jsonify({"message": "semester_ids 必须是非空的学期 ID 列表"}), 400
+    try:
+        semester_ids = list(dict.fromkeys(int(sid) for sid in semester_ids))  # 去重并保持顺序
+        workers = int(data['workers']) if data.get('workers') else None  # 默认按 CPU 核数
+    except (TypeError, ValueError):
+        return jsonify({"message": "semester_ids 和 workers 必须是整数"}), 400
+    storage_mode = data.get('storage', 'rows')
+    if storage_mode not in ('rows', 'series'):
+        return jsonify({"message": "storage 参数只能是 rows 或 series"}), 400
+    try:
+        streaming = parse_flag(data.get('streaming'), True)
+        incremental = parse_flag(data.get('incremental'), False)
+        resume = parse_flag(data.get('resume'), True)
+    except ValueError:
+        return jsonify({"message": "streaming、incremental、resume 只能是 true/false"}), 400
+    app.logger.info(f"API: Received batch scheduling request for semesters {semester_ids}")
+    try:
+        job = get_job_manager().submit_batch(semester_ids, max_workers=workers, streaming=streaming,
+                                             storage_mode=storage_mode, incremental=incremental, resume=resume)
+    except Exception as e:
+        app.logger.error(f"API: Error submitting batch scheduling job for semesters {semester_ids}: {e}", exc_info=True)
+        return jsonify({"message": "提交批量排课任务失败"}), 500
+    return jsonify({
+        "message": "批量排课任务已提交",
+        "job_id": job.id,
+        "status": job.status,
+        "semester_ids": job.semester_ids,
+        "status_url": f"/api/schedule/jobs/{job.id}"
+    }), 202
+
+
+@app.route('/api/schedule/jobs', methods=['GET'])
+def list_scheduling_jobs():
+    semester_id = request.args.get('semester_id', type=int)
+    return jsonify(get_job_manager().list_jobs(semester_id)), 200
+
+@app.route('/api/schedule/jobs/<job_id>', methods=['GET'])
+def get_scheduling_job(job_id):
+    # ?events=1 时附带最近的进度事件
+    include_events = request.args.get('events', '0').lower() in ('1', 'true', 'yes')
+    job = get_job_manager().snapshot(job_id, include_events=include_events)
+    if job is None:
+        return jsonify({"message": "排课任务不存在"}), 404
+    return jsonify(job), 200
+
+# 排课进度的 server-sent events 流: 每条进度事件推送一次，任务结束时推送 end 事件后关闭。
+# 事件 id 为累计序号，断线重连时浏览器带上 Last-Event-ID 即可从断点继续。
+SSE_KEEPALIVE_SECONDS = 15
+
+@app.route('/api/schedule/jobs/<job_id>/events', methods=['GET'])
+def stream_scheduling_job_events(job_id):
+    manager = get_job_manager()
+    if manager.get(job_id) is None:
+        return jsonify({"message": "排课任务不存在"}), 404
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID') or request.args.get('after', 0))
+    except ValueError:
+        last_event_id = 0
+
+    def generate():
+        event_count = last_event_id
+        while True:
+            events, total, job = manager.wait_for_events(job_id, event_count, timeout=SSE_KEEPALIVE_SECONDS)
+            if job is None:
+                return
+            if not events and total == event_count and job['status'] not in scheduling_jobs.FINISHED_STATUSES:
+                yield ": keep-alive\n\n"  # 注释行，防止代理因空闲断开连接
+                continue
+            first_id = total - len(events) + 1
+            for offset, event in enumerate(events):
+                yield (f"id: {first_id + offset}\nevent: {event.get('type', 'message')}\n"
+                       f"data: {json.dumps(event, ensure_ascii=False)}\n\n")
+            event_count = total
+            if job['status'] in scheduling_jobs.FINISHED_STATUSES:
+                yield f"event: end\ndata: {json.dumps(job, ensure_ascii=False, default=str)}\n\n"
+                return
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/schedule/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_scheduling_job(job_id):
+    if not get_job_manager().cancel(job_id):
+        return jsonify({"message": "排课任务不存在或已经结束"}), 409
+    return jsonify({"message": "已请求取消排课任务", "job": get_job_manager().snapshot(job_id)}), 202
+
+# 排课任务的冲突说明: 任务结束后按冲突记录生成文字 (冲突周数多的在前)，?limit=N 限制条数 (默认 500)。
+@app.route('/api/schedule/jobs/<job_id>/conflicts', methods=['GET'])
+def get_scheduling_job_conflicts(job_id):
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return jsonify({"message": "排课任务不存在"}), 404
+    if job.is_batch:
+        return jsonify({"message": "批量排课任务不保留冲突明细，请单独排该学期"}), 400
+    if job.status not in scheduling_jobs.FINISHED_STATUSES:
+        return jsonify({"message": "排课任务尚未结束", "status": job.status}), 409
+    records = (job.summary or {}).get("conflicts", [])
+    limit = request.args.get('limit', 500, type=int)
+    try:
+        conflicts = scheduler_module.describe_conflicts(records, load_export_lookup_data(), limit=limit)
+    except Exception as e:
+        app.logger.error(f"API: Error describing conflicts for job {job_id}: {e}", exc_info=True)
+        return jsonify({"message": "生成冲突说明失败"}), 500
+    return jsonify({"job_id": job_id, "total": len(records), "conflicts": conflicts}), 200
+
+
+# what-if 模拟排课: 请求体为覆盖项 (见 scheduler_module.apply_simulation_overrides)，可带 seed。
+# 只在内存中排课，不写数据库，返回排课摘要和与当前课表的差异。?conflicts=1 时摘要附带冲突说明。
+@app.route('/api/schedule/simulate/<int:semester_id>', methods=['POST'])
+def simulate_scheduling_api(semester_id):
+    data = request.get_json(silent=True) or {}
+    seed = data.pop('seed', None)
+    try:
+        conflict_details = request.args.get('conflicts', '0').lower() in ('1', 'true', 'yes')
+        result = scheduler_module.simulate_scheduling(semester_id, get_db_connection, overrides=data, seed=seed,
+                                                      conflict_details=conflict_details)
+        return jsonify(result), 200
+    except (ValueError, KeyError) as e:
+        return jsonify({"message": f"模拟参数无效: {e}"}), 400
+    except Exception as e:
+        app.logger.error(f"API: Error simulating scheduling for semester {semester_id}: {e}", exc_info=True)
+        return jsonify({"message": "模拟排课时发生内部错误"}), 500
+
+
+# --- 课表版本: 列表、对比、回滚 ---
+@app.route('/api/schedule/versions/<int:semester_id>', methods=['GET'])
+def list_schedule_versions_api(semester_id):
+    try:
+        versions = scheduler_module.list_schedule_versions(get_db_connection, semester_id)
+        for v in versions:
+            if isinstance(v.get('created_at'), datetime.datetime):
+                v['created_at'] = v['created_at'].strftime('%Y-%m-%d %H:%M:%S')
+        return jsonify(versions), 200
+    except Exception as e:
+        app.logger.error(f"API: Error listing schedule versions for semester {semester_id}: {e}", exc_info=True)
+        return jsonify({"message": "获取课表版本失败"}), 500
+
+@app.route('/api/schedule/versions/<int:semester_id>/diff', methods=['GET'])
+def diff_schedule_versions_api(semester_id):
+    from_version = request.args.get('from', type=int)
+    to_version = request.args.get('to', type=int)
+    if from_version is None or to_version is None:
+        return jsonify({"message": "缺少参数 from 或 to (版本 ID)"}), 400
+    try:
+        diff = scheduler_module.diff_schedule_versions(get_db_connection, semester_id, from_version, to_version)
+        return jsonify({"from": from_version, "to": to_version, **diff}), 200
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 404
+    except Exception as e:
+        app.logger.error(f"API: Error diffing versions {from_version}->{to_version} for semester {semester_id}: {e}",
+                         exc_info=True)
+        return jsonify({"message": "对比课表版本失败"}), 500
+
+@app.route('/api/schedule/versions/<int:semester_id>/rollback/<int:version_id>', methods=['POST'])
+def rollback_schedule_version_api(semester_id, version_id):
+    try:
+        new_version_id, removed, added = scheduler_module.rollback_schedule_to_version(
+            get_db_connection, semester_id, version_id)
+        return jsonify({"message": f"学期 {semester_id} 课表已回滚到版本 {version_id}",
+                        "version_id": new_version_id, "removed": removed, "added": added}), 200
+    except scheduler_module.SemesterBusy as e:
+        return jsonify({"message": str(e)}), 409
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 404
+    except Exception as e:
+        app.logger.error(f"API: Error rolling back semester {semester_id} to version {version_id}: {e}", exc_info=True)
+        return jsonify({"message": "回滚课表版本失败"}), 500
+
+
 # API to get timetable data for a whole semester
 @app.route('/api/timetables/semester/<int:semester_id>', methods=['GET'])
 def get_semester_timetable(semester_id):
@@ -936,16 +1315,16 @@ def get_semester_timetable(semester_id):
         cur = conn.cursor(cursor_factory=RealDictCursor)  # Or DictCursor
 
         # Use time_slots based on your schema
-        query = """
+        query = f"""
         SELECT
-            te.id, te.week_number, te.assignment_id,
+            te.id, te.series_id, te.is_pinned, te.week_number, te.assignment_id,
             s.name as semester_name,
             m.id as major_id, m.name as major_name,
             c.id as course_id, c.name as course_name, c.course_type,
             u.username as teacher_name, t.id as teacher_id,
             cl.id as classroom_id, cl.building || '-' || cl.room_number as classroom_name, -- Concatenate building and room
             ts.id as timeslot_id, ts.day_of_week, ts.period, ts.start_time, ts.end_time -- TIME fields
-        FROM timetable_entries te
+        FROM {scheduler_module.EXPANDED_TIMETABLE_SQL} te
         JOIN semesters s ON te.semester_id = s.id
         JOIN majors m ON te.major_id = m.id
         JOIN courses c ON te.course_id = c.id
@@ -993,34 +1372,46 @@ def get_semester_timetable(semester_id):
         if conn: conn.close()
 
 
+# --- 导出请求合并 ---
+# 并发的相同导出请求共用一次基础数据加载和 Excel 生成 (只合并同时进行的请求，不缓存)
+_export_flight = singleflight.SingleFlight()
+
+def load_export_lookup_data():
+    """加载导出所需的基础数据 (学期、专业、教师等)，并发请求共用同一次加载，调用方不得修改返回值。"""
+    all_data, _ = _export_flight.do(('load_data',),
+                                    lambda: scheduler_module.load_data_from_db(get_db_connection))
+    return all_data
+
+def build_excel_export(key, schedule_entries, all_data, semester, **report_kwargs):
+    """生成 Excel 导出，key 相同的并发请求共用一次生成结果；每个请求拿到独立的 BytesIO。"""
+    started = time.perf_counter()
+    excel_bytes, _ = _export_flight.do(
+        ('excel',) + tuple(key),
+        lambda: scheduler_module.generate_excel_report_for_send_file(
+            schedule_entries, all_data, semester, **report_kwargs).getvalue())
+    # 按请求记录 (共用生成结果的请求耗时为等待时间)，kind 为 semester/teacher/major/student_major
+    metrics.EXPORT_DURATION.observe(time.perf_counter() - started, kind=key[0])
+    metrics.EXPORT_SIZE.observe(len(excel_bytes), kind=key[0])
+    return io.BytesIO(excel_bytes)
+
+
 # API to export timetable data for a whole semester to Excel#无用
 @app.route('/api/timetables/export/semester/<int:semester_id>', methods=['GET'])
 def export_semester_timetable_excel(semester_id):
     try:
         # load_data_from_db is expected to get all necessary lookup data (semesters, majors, etc.)
-        all_data = scheduler_module.load_data_from_db(get_db_connection)
+        all_data = load_export_lookup_data()
         current_semester = all_data.get('semesters', {}).get(semester_id)  # Use get with default {} for safety
         if not current_semester:
             return jsonify({"message": "学期信息未找到，无法导出"}), 404  # Use 404 if semester ID is bad
 
         conn = get_db_connection()
         if conn is None: return jsonify({"message": "数据库连接失败"}), 500
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)  # DictCursor is fine for fetching raw data
 
-        # Fetch raw TimetableEntry compatible data
-        # Ensure field names match what scheduler_module.TimetableEntry expects
-        cur.execute("""
-            SELECT id, semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number, assignment_id
-            FROM timetable_entries WHERE semester_id = %s
-            """, (semester_id,))
-        raw_entries = cur.fetchall()
-        cur.close()
+        # 普通条目为 TimetableEntry，压缩条目为 TimetableSeries，导出时按需展开
+        schedule_entries_for_export = scheduler_module.load_schedule_entries(conn, semester_id)
         conn.close()
 
-        # Convert fetched dicts to TimetableEntry objects (assuming it's a namedtuple/dataclass)
-        # This requires scheduler_module.TimetableEntry to accept these fields
-        schedule_entries_for_export = [scheduler_module.TimetableEntry(**row) for row in raw_entries]
-
         # Check if semester has valid week information before proceeding to generate report
         if not current_semester or not hasattr(current_semester, 'total_weeks') or current_semester.total_weeks <= 0:
             # Still try to generate if there are entries, might just have weird output
@@ -1028,9 +1419,8 @@ def export_semester_timetable_excel(semester_id):
                 return jsonify({"message": "当前学期无排课数据可供导出，或学期周数未设置"}), 404
 
         # generate_excel_report_for_send_file should handle empty schedule_entries gracefully
-        excel_buffer = scheduler_module.generate_excel_report_for_send_file(
-            schedule_entries_for_export, all_data, current_semester
-        )
+        excel_buffer = build_excel_export(('semester', semester_id),
+                                          schedule_entries_for_export, all_data, current_semester)
 
         # Sanitize semester name for filename
         # Allow CJK, alphanumeric, hyphen, underscore, space. Replace others with underscore.
@@ -1077,15 +1467,15 @@ def get_teacher_timetable(teacher_id, semester_id):
         if conn is None: return jsonify({"message": "数据库连接失败"}), 500
         cur = conn.cursor(cursor_factory=RealDictCursor)  # Or DictCursor
         # Use time_slots based on your schema
-        query = """
-        SELECT te.id, te.week_number, te.assignment_id,
+        query = f"""
+        SELECT te.id, te.series_id, te.is_pinned, te.week_number, te.assignment_id,
                s.name as semester_name,
                m.id as major_id, m.name as major_name,
                c.id as course_id, c.name as course_name, c.course_type,
                u.username as teacher_name, t.id as teacher_id,
                cl.id as classroom_id, cl.building || '-' || cl.room_number as classroom_name,
                ts.id as timeslot_id, ts.day_of_week, ts.period, ts.start_time, ts.end_time -- TIME fields
-        FROM timetable_entries te
+        FROM {scheduler_module.EXPANDED_TIMETABLE_SQL} te
         JOIN semesters s ON te.semester_id = s.id
         JOIN majors m ON te.major_id = m.id
         JOIN courses c ON te.course_id = c.id
@@ -1136,7 +1526,7 @@ def get_teacher_timetable(teacher_id, semester_id):
 @app.route('/api/timetables/export/teacher/<int:teacher_id>/semester/<int:semester_id>', methods=['GET'])
 def export_teacher_timetable_excel(teacher_id, semester_id):
     try:
-        all_data = scheduler_module.load_data_from_db(get_db_connection)
+        all_data = load_export_lookup_data()
         current_semester = all_data.get('semesters', {}).get(semester_id)
         teacher_info = all_data.get('teachers', {}).get(teacher_id)  # Assuming teachers dict is keyed by id
         if not current_semester or not teacher_info:
@@ -1144,23 +1534,16 @@ def export_teacher_timetable_excel(teacher_id, semester_id):
 
         conn = get_db_connection()
         if conn is None: return jsonify({"message": "数据库连接失败"}), 500
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur.execute("""
-            SELECT id, semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number, assignment_id
-            FROM timetable_entries WHERE semester_id = %s AND teacher_id = %s
-            """, (semester_id, teacher_id))
-        raw_entries = cur.fetchall()
-        cur.close()
+        schedule_entries_for_export = scheduler_module.load_schedule_entries(conn, semester_id, teacher_id=teacher_id)
         conn.close()
-        schedule_entries_for_export = [scheduler_module.TimetableEntry(**row) for row in raw_entries]
 
         if not current_semester or not hasattr(current_semester, 'total_weeks') or current_semester.total_weeks <= 0:
             if not schedule_entries_for_export:
                 return jsonify({"message": "当前学期或指定教师无排课数据可供导出"}), 404
 
-        excel_buffer = scheduler_module.generate_excel_report_for_send_file(
-            schedule_entries_for_export, all_data, current_semester, target_teacher_id=teacher_id
-        )
+        excel_buffer = build_excel_export(('teacher', teacher_id, semester_id),
+                                          schedule_entries_for_export, all_data, current_semester,
+                                          target_teacher_id=teacher_id)
 
         safe_teacher_name = re.sub(r'[^\w\u4e00-\u9fff\s\-]', '_',
                                    teacher_info.name if hasattr(teacher_info, 'name') else str(
@@ -1212,9 +1595,11 @@ def get_major_timetable(major_id, semester_id):
 
         # 基础查询语句，连接必要的表以获取所需信息
         # 注意：你的原始查询缺少了 JOIN courses, teachers, users, classrooms 获取名称的部分，这里补上
-        query = """
+        query = f"""
             SELECT
                 te.id,
+                te.series_id, -- 压缩存储条目的来源 (普通条目为 NULL)
+                te.is_pinned, -- 固定条目重新排课时保留
                 te.semester_id,
                 te.major_id,
                 te.course_id,
@@ -1232,7 +1617,7 @@ def get_major_timetable(major_id, semester_id):
                 u.username as teacher_name,
                 cl.building || '-' || cl.room_number as classroom_name, -- classroom_name 已在你的原代码中
                 m.name as major_name -- 如果需要显示专业名（虽然在此视图可能不需要）
-            FROM timetable_entries te
+            FROM {scheduler_module.EXPANDED_TIMETABLE_SQL} te
             JOIN time_slots ts ON te.timeslot_id = ts.id
             JOIN courses c ON te.course_id = c.id
             JOIN teachers t ON te.teacher_id = t.id
@@ -1295,7 +1680,7 @@ def get_major_timetable(major_id, semester_id):
 @app.route('/api/timetables/export/major/<int:major_id>/semester/<int:semester_id>', methods=['GET'])
 def export_major_timetable_excel(major_id, semester_id):
     try:
-        all_data = scheduler_module.load_data_from_db(get_db_connection)
+        all_data = load_export_lookup_data()
         current_semester = all_data.get('semesters', {}).get(semester_id)
         major_info = all_data.get('majors', {}).get(major_id)  # Assuming majors dict is keyed by id
         if not current_semester or not major_info:
@@ -1303,23 +1688,16 @@ def export_major_timetable_excel(major_id, semester_id):
 
         conn = get_db_connection()
         if conn is None: return jsonify({"message": "数据库连接失败"}), 500
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur.execute("""
-            SELECT id, semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number, assignment_id
-            FROM timetable_entries WHERE semester_id = %s AND major_id = %s
-            """, (semester_id, major_id))
-        raw_entries = cur.fetchall()
-        cur.close()
+        schedule_entries_for_export = scheduler_module.load_schedule_entries(conn, semester_id, major_id=major_id)
         conn.close()
-        schedule_entries_for_export = [scheduler_module.TimetableEntry(**row) for row in raw_entries]
 
         if not current_semester or not hasattr(current_semester, 'total_weeks') or current_semester.total_weeks <= 0:
             if not schedule_entries_for_export:
                 return jsonify({"message": "当前学期或指定专业无排课数据可供导出"}), 404
 
-        excel_buffer = scheduler_module.generate_excel_report_for_send_file(
-            schedule_entries_for_export, all_data, current_semester, target_major_id=major_id
-        )
+        excel_buffer = build_excel_export(('major', major_id, semester_id),
+                                          schedule_entries_for_export, all_data, current_semester,
+                                          target_major_id=major_id)
 
         safe_major_name = re.sub(r'[^\w\u4e00-\u9fff\s\-]', '_',
                                  major_info.name if hasattr(major_info, 'name') else str(major_id))
@@ -1384,15 +1762,15 @@ def get_student_timetable(user_id, semester_id):
         student_major_id = student_info['major_id']
 
         # 2. Fetch timetable entries using the student's major_id, semester_id, and week filter
-        query = """
+        query = f"""
             SELECT
-                te.id, te.semester_id, te.major_id, te.course_id, te.teacher_id, te.classroom_id, te.timeslot_id, te.week_number, te.assignment_id,
+                te.id, te.series_id, te.is_pinned, te.semester_id, te.major_id, te.course_id, te.teacher_id, te.classroom_id, te.timeslot_id, te.week_number, te.assignment_id,
                 ts.day_of_week, ts.period, ts.start_time, ts.end_time,
                 c.name as course_name, c.course_type,
                 u.username as teacher_name, -- Include teacher name
                 cl.building || '-' || cl.room_number as classroom_name
                 -- No need for major_name in student view result, but could fetch it if needed
-            FROM timetable_entries te
+            FROM {scheduler_module.EXPANDED_TIMETABLE_SQL} te
             JOIN time_slots ts ON te.timeslot_id = ts.id
             JOIN courses c ON te.course_id = c.id
             JOIN teachers t ON te.teacher_id = t.id
@@ -1475,7 +1853,7 @@ def export_student_timetable_excel(user_id, semester_id):
 
         # Load all necessary lookup data (including semesters, majors, teachers, etc.)
         # load_data_from_db returns dictionaries keyed by ID, e.g., {'semesters': {id: semester_obj, ...}}
-        all_data = scheduler_module.load_data_from_db(get_db_connection) # Pass the connection function
+        all_data = load_export_lookup_data()
 
         current_semester = all_data.get('semesters', {}).get(semester_id)
         if not current_semester:
@@ -1483,32 +1861,21 @@ def export_student_timetable_excel(user_id, semester_id):
              return jsonify({"message": "学期信息未找到，无法导出"}), 404
 
         # 2. Fetch *all* timetable entries for this student's major and semester
-        # Use DictCursor for fetching raw data to pass to TimetableEntry constructor
-        cur_dict = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur_dict.execute("""
-            SELECT id, semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number, assignment_id
-            FROM timetable_entries
-            WHERE semester_id = %s AND major_id = %s
-            ORDER BY week_number, timeslot_id; -- Consistent ordering
-            """, (semester_id, student_major_id)) # Filter by student's major_id
-        raw_entries = cur_dict.fetchall()
-        cur_dict.close() # Close dict cursor
+        # 普通条目为 TimetableEntry，压缩条目为 TimetableSeries，导出时按需展开
+        schedule_entries_for_export = scheduler_module.load_schedule_entries(conn, semester_id,
+                                                                             major_id=student_major_id)
 
         conn.close() # Close main connection
 
-        if not raw_entries:
+        if not schedule_entries_for_export:
             return jsonify({"message": "当前学期无排课数据可供导出，或学期周数未设置"}), 404
 
-        # Convert fetched dicts to TimetableEntry objects (assuming it's a namedtuple/dataclass)
-        schedule_entries_for_export = [scheduler_module.TimetableEntry(**row) for row in raw_entries]
-
         # Generate Excel report. Pass student_major_id or user_id if generate_excel_report_for_send_file
         # needs to filter or format specifically for a student (e.g., hide other majors' data if the raw_entries included them).
         # Given the query filters by major_id, the generator just needs the list and lookup data.
-        excel_buffer = scheduler_module.generate_excel_report_for_send_file(
-            schedule_entries_for_export, all_data, current_semester
-            # Optionally pass target_major_id=student_major_id or other flags if generator logic depends on it
-        )
+        # 同专业学生的导出内容相同，按专业合并
+        excel_buffer = build_excel_export(('student_major', student_major_id, semester_id),
+                                          schedule_entries_for_export, all_data, current_semester)
 
         # Sanitize names for filename
         safe_student_username = re.sub(r'[^\w\u4e00-\u9fff\s\-]', '_', student_username)
@@ -1587,15 +1954,15 @@ def get_teacher_weekly_timetable(user_id, semester_id):
 
         # --- Step 3: Execute the SQL query with semester_id, teacher_id, and week_number filtering ---
         # Modify the query to filter by teacher_id and week_number
-        query = """
-        SELECT te.id, te.week_number, te.assignment_id,
+        query = f"""
+        SELECT te.id, te.series_id, te.is_pinned, te.week_number, te.assignment_id,
                s.name as semester_name,
                m.id as major_id, m.name as major_name,
                c.id as course_id, c.name as course_name, c.course_type,
                u.username as teacher_name, t.id as teacher_id,
                cl.id as classroom_id, cl.building || '-' || cl.room_number as classroom_name,
                ts.id as timeslot_id, ts.day_of_week, ts.period, ts.start_time, ts.end_time -- TIME fields
-        FROM timetable_entries te
+        FROM {scheduler_module.EXPANDED_TIMETABLE_SQL} te
         JOIN semesters s ON te.semester_id = s.id
         LEFT JOIN majors m ON te.major_id = m.id -- Use LEFT JOIN for major
         JOIN courses c ON te.course_id = c.id
@@ -2009,10 +2376,11 @@ def delete_teacher_scheduling_preference(preference_id):
 from flask import abort # 用于返回错误码
 
 # --- Helper function for conflict checking (Simplified Example) ---
-def check_conflict(conn, entry_id_to_update, new_timeslot_id, new_classroom_id, week_number):
+def check_conflict(conn, entry_id_to_update, new_timeslot_id, new_classroom_id, week_number, series_id_to_update=None):
     """
     检查更新后的条目是否与现有条目冲突 (简化版)。
     返回冲突描述字符串，如果无冲突则返回 None。
+    series_id_to_update 不为 None 时，检查的是压缩条目某一周的调整 (entry_id_to_update 忽略)。
     注意：这个检查逻辑需要根据你的具体规则细化！
     """
     cur = None
@@ -2020,11 +2388,17 @@ def check_conflict(conn, entry_id_to_update, new_timeslot_id, new_classroom_id,
         cur = conn.cursor(cursor_factory=RealDictCursor)
 
         # 获取要更新的条目的基本信息 (教师, 专业, 学期)
-        cur.execute("""
+        if series_id_to_update is not None:
+            source_table, self_id = "timetable_entry_series", series_id_to_update
+            exclude_self = "te.series_id IS DISTINCT FROM %s"
+        else:
+            source_table, self_id = "timetable_entries", entry_id_to_update
+            exclude_self = "te.id IS DISTINCT FROM %s"  # 压缩条目展开后 id 为 NULL，不能用 !=
+        cur.execute(f"""
             SELECT teacher_id, major_id, semester_id
-            FROM timetable_entries
+            FROM {source_table}
             WHERE id = %s
-        """, (entry_id_to_update,))
+        """, (self_id,))
         entry_info = cur.fetchone()
         if not entry_info:
             return "要更新的条目不存在" # 或者在调用前检查
@@ -2034,48 +2408,48 @@ def check_conflict(conn, entry_id_to_update, new_timeslot_id, new_classroom_id,
         semester_id = entry_info['semester_id'] # 用于限定范围
 
         # 检查教师冲突: 同学期、同周次、新时间段，是否有其他课 (排除自身)
-        cur.execute("""
+        cur.execute(f"""
             SELECT te.id, c.name as course_name
-            FROM timetable_entries te
+            FROM {scheduler_module.EXPANDED_TIMETABLE_SQL} te
             JOIN courses c ON te.course_id = c.id
             WHERE te.teacher_id = %s
               AND te.semester_id = %s
               AND te.week_number = %s
               AND te.timeslot_id = %s
-              AND te.id != %s
-        """, (teacher_id, semester_id, week_number, new_timeslot_id, entry_id_to_update))
+              AND {exclude_self}
+        """, (teacher_id, semester_id, week_number, new_timeslot_id, self_id))
         teacher_conflict = cur.fetchone()
         if teacher_conflict:
             return f"教师在该时间已有课程: {teacher_conflict['course_name']}"
 
         # 检查教室冲突: 同学期、同周次、新时间段、新教室，是否已被占用 (排除自身)
         if new_classroom_id: # 只有在指定了新教室时才检查
-            cur.execute("""
+            cur.execute(f"""
                 SELECT te.id, c.name as course_name, m.name as major_name
-                FROM timetable_entries te
+                FROM {scheduler_module.EXPANDED_TIMETABLE_SQL} te
                 JOIN courses c ON te.course_id = c.id
                 JOIN majors m ON te.major_id = m.id
                 WHERE te.classroom_id = %s
                   AND te.semester_id = %s
                   AND te.week_number = %s
                   AND te.timeslot_id = %s
-                  AND te.id != %s
-            """, (new_classroom_id, semester_id, week_number, new_timeslot_id, entry_id_to_update))
+                  AND {exclude_self}
+            """, (new_classroom_id, semester_id, week_number, new_timeslot_id, self_id))
             classroom_conflict = cur.fetchone()
             if classroom_conflict:
                 return f"教室在该时间已被专业 '{classroom_conflict['major_name']}' 的课程 '{classroom_conflict['course_name']}' 占用"
 
         # 检查专业/班级冲突: 同学期、同周次、新时间段，该专业是否已有其他课 (排除自身)
-        cur.execute("""
+        cur.execute(f"""
             SELECT te.id, c.name as course_name
-            FROM timetable_entries te
+            FROM {scheduler_module.EXPANDED_TIMETABLE_SQL} te
             JOIN courses c ON te.course_id = c.id
             WHERE te.major_id = %s
               AND te.semester_id = %s
               AND te.week_number = %s
               AND te.timeslot_id = %s
-              AND te.id != %s
-        """, (major_id, semester_id, week_number, new_timeslot_id, entry_id_to_update))
+              AND {exclude_self}
+        """, (major_id, semester_id, week_number, new_timeslot_id, self_id))
         major_conflict = cur.fetchone()
         if major_conflict:
             return f"该专业在该时间已有课程: {major_conflict['course_name']}"
@@ -2152,6 +2526,11 @@ def update_timetable_entry(entry_id):
             raise ValueError("周数必须是正数")
     except (ValueError, TypeError):
         return jsonify({"message": "week_number 必须是一个有效的正整数"}), 400
+    # 4. 可选的 "pin": true/false 设置是否固定该条目 (重新排课时保留)，不传时保持条目原来的固定状态
+    try:
+        pin_entry = parse_flag(data.get('pin'), None)
+    except ValueError:
+        return jsonify({"message": "pin 只能是 true 或 false"}), 400
     conn = None
     cur = None
     try:
@@ -2182,17 +2561,25 @@ def update_timetable_entry(entry_id):
         # 注意：这里只更新 timeslot_id 和 classroom_id
         # 如果需要更新其他字段（如 week_number），也需要加入 SET 子句
         # 但通常手动调整是移动到新的时间/地点，周次不变或由用户指定
-        update_query = """
+        # 记录调整前的课时，用于课表版本 (先取版本锁，再读取和改动行)
+        scheduler_module.lock_schedule_versions_for_row(cur, 'timetable_entries', entry_id)
+        cur.execute(f"SELECT semester_id, {scheduler_module.VERSION_KEY_SQL} FROM timetable_entries WHERE id = %s",
+                    (entry_id,))
+        old_row = cur.fetchone()
+
+        update_query = f"""
         UPDATE timetable_entries
-        SET timeslot_id = %s, classroom_id = %s
+        SET timeslot_id = %s, classroom_id = %s, is_pinned = COALESCE(%s, is_pinned)
         WHERE id = %s
+        RETURNING {scheduler_module.VERSION_KEY_SQL}
         """
         # 使用 new_classroom_id，如果它是 None，数据库字段需要允许 NULL
-        cur.execute(update_query, (new_timeslot_id, new_classroom_id, entry_id))
+        cur.execute(update_query, (new_timeslot_id, new_classroom_id, pin_entry, entry_id))
 
-        if cur.rowcount == 0:
+        if cur.rowcount == 0 or not old_row:
             conn.rollback()
             return jsonify({"message": "未找到要更新的课表条目，或数据未改变"}), 404
+        scheduler_module.record_manual_schedule_change(cur, old_row[0], [old_row[1:]], [cur.fetchone()])
 
         conn.commit() # 提交事务
         return jsonify({"message": "课表条目更新成功"}), 200
@@ -2211,6 +2598,37 @@ def update_timetable_entry(entry_id):
             conn.autocommit = True # 恢复 autocommit 状态
             conn.close()
 
+# 固定/取消固定课表条目: 固定的条目在重新排课时保留，排课只围绕它们安排其余课时
+@app.route('/api/timetables/entry/<int:entry_id>/pin', methods=['PUT'])
+def pin_timetable_entry(entry_id):
+    data = request.get_json(silent=True) or {}
+    try:
+        pinned = parse_flag(data.get('pinned'), True)
+    except ValueError:
+        return jsonify({"message": "pinned 只能是 true 或 false"}), 400
+    conn = None
+    cur = None
+    try:
+        conn = get_db_connection()
+        if conn is None: return jsonify({"message": "数据库连接失败"}), 500
+        cur = conn.cursor()
+        conn.autocommit = True # 单条语句
+
+        cur.execute("UPDATE timetable_entries SET is_pinned = %s WHERE id = %s", (pinned, entry_id))
+        if cur.rowcount == 0:
+            return jsonify({"message": "未找到要固定的课表条目"}), 404
+        return jsonify({"message": f"课表条目 {entry_id} 已{'固定' if pinned else '取消固定'}", "is_pinned": pinned}), 200
+
+    except psycopg2.Error as db_err:
+        app.logger.error(f"DB error pinning timetable entry {entry_id}: {db_err}", exc_info=True)
+        return jsonify({"message": f"数据库操作失败: {db_err}"}), 500
+    except Exception as e:
+        app.logger.error(f"Error pinning timetable entry {entry_id}: {e}", exc_info=True)
+        return jsonify({"message": f"服务器内部错误: {e}"}), 500
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
 @app.route('/api/timetables/entry/<int:entry_id>', methods=['DELETE'])
 def delete_timetable_entry(entry_id):
     conn = None
@@ -2219,25 +2637,272 @@ def delete_timetable_entry(entry_id):
         conn = get_db_connection()
         if conn is None: return jsonify({"message": "数据库连接失败"}), 500
         cur = conn.cursor()
-        conn.autocommit = True # 删除是单个操作
+        conn.autocommit = False # 删除和版本记录在同一事务内
+        scheduler_module.lock_schedule_versions_for_row(cur, 'timetable_entries', entry_id)
 
-        cur.execute("DELETE FROM timetable_entries WHERE id = %s", (entry_id,))
+        cur.execute(f"DELETE FROM timetable_entries WHERE id = %s RETURNING semester_id, {scheduler_module.VERSION_KEY_SQL}",
+                    (entry_id,))
+        deleted_row = cur.fetchone()
 
-        if cur.rowcount > 0:
+        if deleted_row:
+            scheduler_module.record_manual_schedule_change(cur, deleted_row[0], removed_keys=[deleted_row[1:]])
+            conn.commit()
             return jsonify({"message": f"课表条目 {entry_id} 删除成功"}), 200
         else:
+            conn.rollback()
             return jsonify({"message": "删除失败，课表条目可能不存在"}), 404
 
     except psycopg2.Error as db_err:
+        if conn: conn.rollback()
         app.logger.error(f"DB error deleting timetable entry {entry_id}: {db_err}", exc_info=True)
         return jsonify({"message": f"数据库操作失败: {db_err}"}), 500
     except Exception as e:
+        if conn: conn.rollback()
         app.logger.error(f"Error deleting timetable entry {entry_id}: {e}", exc_info=True)
         return jsonify({"message": f"服务器内部错误: {e}"}), 500
+    finally:
+        if cur: cur.close()
+        if conn:
+            conn.autocommit = True # 恢复 autocommit 状态
+            conn.close()
+
+# --- 压缩存储条目的单周调整 ---
+# 压缩条目 (timetable_entry_series) 代表多周重复的同一节课。调整其中某一周时，
+# 把该周从 weeks 中移除，并在 timetable_entries 中插入一条例外行记录新的时间/教室。
+@app.route('/api/timetables/series/<int:series_id>/week/<int:week_number>', methods=['PUT'])
+def update_timetable_series_week(series_id, week_number):
+    data = request.get_json()
+    if not data:
+        return jsonify({"message": "请求体不能为空"}), 400
+    try:
+        new_timeslot_id = int(data.get('timeslot_id'))
+    except (ValueError, TypeError):
+        return jsonify({"message": "timeslot_id 必须是一个有效的整数"}), 400
+    raw_classroom_id = data.get('classroom_id')
+    new_classroom_id = None
+    if raw_classroom_id is not None:
+        try:
+            new_classroom_id = int(raw_classroom_id)
+        except (ValueError, TypeError):
+            return jsonify({"message": "classroom_id 必须是一个有效的整数或 null"}), 400
+    # 拆出的这一周是手动调整的结果，默认固定；传 "pin": false 可不固定
+    try:
+        pin_entry = parse_flag(data.get('pin'), True)
+    except ValueError:
+        return jsonify({"message": "pin 只能是 true 或 false"}), 400
+
+    conn = None
+    cur = None
+    try:
+        conn = get_db_connection()
+        if conn is None: return jsonify({"message": "数据库连接失败"}), 500
+        conn.autocommit = False # 使用事务
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        scheduler_module.lock_schedule_versions_for_row(cur, 'timetable_entry_series', series_id)
+
+        cur.execute("""
+            SELECT id, semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, weeks, assignment_id
+            FROM timetable_entry_series WHERE id = %s FOR UPDATE
+        """, (series_id,))
+        series = cur.fetchone()
+        if not series or week_number not in series['weeks']:
+            conn.rollback()
+            return jsonify({"message": "未找到要更新的课表条目 (该周无此课程)"}), 404
+
+        cur.execute("SELECT 1 FROM time_slots WHERE id = %s", (new_timeslot_id,))
+        if not cur.fetchone():
+            conn.rollback()
+            return jsonify({"message": f"无效的时间段 ID: {new_timeslot_id}"}), 400
+        if new_classroom_id is not None:
+            cur.execute("SELECT 1 FROM classrooms WHERE id = %s", (new_classroom_id,))
+            if not cur.fetchone():
+                conn.rollback()
+                return jsonify({"message": f"无效的教室 ID: {new_classroom_id}"}), 400
+
+        conflict_reason = check_conflict(conn, None, new_timeslot_id, new_classroom_id, week_number,
+                                         series_id_to_update=series_id)
+        if conflict_reason:
+            conn.rollback()
+            return jsonify({"message": f"无法更新，存在冲突: {conflict_reason}"}), 409
+
+        cur.execute("""
+            UPDATE timetable_entry_series SET weeks = array_remove(weeks, %s) WHERE id = %s
+        """, (week_number, series_id))
+        cur.execute("""
+            INSERT INTO timetable_entries
+            (semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number, assignment_id,
+             is_pinned)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id
+        """, (series['semester_id'], series['major_id'], series['course_id'], series['teacher_id'],
+              new_classroom_id, new_timeslot_id, week_number, series['assignment_id'], pin_entry))
+        new_entry_id = cur.fetchone()['id']
+        old_key = tuple(week_number if col == 'week_number' else series[col]
+                        for col in scheduler_module.VERSION_KEY_COLUMNS)
+        new_key = tuple({'timeslot_id': new_timeslot_id, 'classroom_id': new_classroom_id}.get(col, old_key[i])
+                        for i, col in enumerate(scheduler_module.VERSION_KEY_COLUMNS))
+        scheduler_module.record_manual_schedule_change(cur, series['semester_id'], [old_key], [new_key])
+        # 所有周都被拆出时删除空的压缩条目
+        cur.execute("DELETE FROM timetable_entry_series WHERE id = %s AND cardinality(weeks) = 0", (series_id,))
+
+        conn.commit()
+        return jsonify({"message": "课表条目更新成功", "entry_id": new_entry_id}), 200
+
+    except psycopg2.Error as db_err:
+        if conn: conn.rollback()
+        app.logger.error(f"DB error updating timetable series {series_id} week {week_number}: {db_err}", exc_info=True)
+        return jsonify({"message": f"数据库操作失败: {db_err}"}), 500
+    except Exception as e:
+        if conn: conn.rollback()
+        app.logger.error(f"Error updating timetable series {series_id} week {week_number}: {e}", exc_info=True)
+        return jsonify({"message": f"服务器内部错误: {e}"}), 500
+    finally:
+        if cur: cur.close()
+        if conn:
+            conn.autocommit = True # 恢复 autocommit 状态
+            conn.close()
+
+@app.route('/api/timetables/series/<int:series_id>/week/<int:week_number>', methods=['DELETE'])
+def delete_timetable_series_week(series_id, week_number):
+    conn = None
+    cur = None
+    try:
+        conn = get_db_connection()
+        if conn is None: return jsonify({"message": "数据库连接失败"}), 500
+        cur = conn.cursor()
+        conn.autocommit = False # 删除和版本记录在同一事务内
+        scheduler_module.lock_schedule_versions_for_row(cur, 'timetable_entry_series', series_id)
+
+        cur.execute("""
+            UPDATE timetable_entry_series SET weeks = array_remove(weeks, %s)
+            WHERE id = %s AND %s = ANY(weeks)
+            RETURNING semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, assignment_id
+        """, (week_number, series_id, week_number))
+        removed_row = cur.fetchone()
+        if not removed_row:
+            conn.rollback()
+            return jsonify({"message": "删除失败，课表条目可能不存在"}), 404
+        cur.execute("DELETE FROM timetable_entry_series WHERE id = %s AND cardinality(weeks) = 0", (series_id,))
+        semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, assignment_id = removed_row
+        removed_key = (major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number, assignment_id)
+        scheduler_module.record_manual_schedule_change(cur, semester_id, removed_keys=[removed_key])
+        conn.commit()
+        return jsonify({"message": f"课表条目 {series_id} 第 {week_number} 周删除成功"}), 200
+
+    except psycopg2.Error as db_err:
+        if conn: conn.rollback()
+        app.logger.error(f"DB error deleting timetable series {series_id} week {week_number}: {db_err}", exc_info=True)
+        return jsonify({"message": f"数据库操作失败: {db_err}"}), 500
+    except Exception as e:
+        if conn: conn.rollback()
+        app.logger.error(f"Error deleting timetable series {series_id} week {week_number}: {e}", exc_info=True)
+        return jsonify({"message": f"服务器内部错误: {e}"}), 500
+    finally:
+        if cur: cur.close()
+        if conn:
+            conn.autocommit = True # 恢复 autocommit 状态
+            conn.close()
+
+# --- 按需性能分析 (仅管理员) ---
+# 布置后，下一次排课 (target=scheduling) 或 Excel 导出 (target=export) 在 cProfile 或采样分析器下执行，
+# 结果通过下面的接口列出和下载。user_id 放在请求体 (POST) 或查询参数 (GET/DELETE) 中。
+def check_admin_user(user_id):
+    """user_id 不是管理员时返回错误响应，是管理员时返回 None。"""
+    if user_id is None:
+        return jsonify({"error": "缺少 user_id"}), 400
+    conn = None
+    cur = None
+    try:
+        conn = get_db_connection()
+        if conn is None:
+            return jsonify({"message": "数据库连接失败"}), 500
+        cur = conn.cursor()
+        cur.execute("SELECT role FROM users WHERE id = %s", (user_id,))
+        user_info = cur.fetchone()
+        if not user_info or user_info[0].lower() != 'admin':
+            return jsonify({"error": "只有管理员可以使用性能分析"}), 403
+        return None
+    except Exception as e:
+        app.logger.error(f"Error checking admin user {user_id}: {e}", exc_info=True)
+        return jsonify({"message": "服务器内部错误"}), 500
     finally:
         if cur: cur.close()
         if conn: conn.close()
 
+
+@app.route('/api/admin/profiling', methods=['GET'])
+def list_profiling_api():
+    denied = check_admin_user(request.args.get('user_id', type=int))
+    if denied:
+        return denied
+    try:
+        results = profiling.list_results()
+    except PermissionError as e:
+        return jsonify({"message": f"分析结果目录不安全: {e}"}), 500
+    return jsonify({"armed": profiling.armed_requests(), "results": results}), 200
+
+
+@app.route('/api/admin/profiling/arm', methods=['POST'])
+def arm_profiling_api():
+    data = request.get_json(silent=True) or {}
+    denied = check_admin_user(data.get('user_id'))
+    if denied:
+        return denied
+    try:
+        profile = profiling.arm(data.get('target', 'scheduling'), mode=data.get('mode', 'cprofile'),
+                                interval=data.get('interval_ms', profiling.DEFAULT_SAMPLE_INTERVAL * 1000) / 1000,
+                                armed_by=data.get('user_id'))
+    except (TypeError, ValueError) as e:
+        return jsonify({"message": str(e)}), 400
+    app.logger.info(f"API: Profiling armed for next {profile['target']} ({profile['mode']}) by user {data.get('user_id')}")
+    return jsonify({"message": "已布置，下一次请求将被分析", "profile": profile}), 201
+
+
+@app.route('/api/admin/profiling/arm/<target>', methods=['DELETE'])
+def disarm_profiling_api(target):
+    denied = check_admin_user(request.args.get('user_id', type=int))
+    if denied:
+        return denied
+    if profiling.disarm(target) is None:
+        return jsonify({"message": f"没有布置对 {target} 的分析"}), 404
+    return jsonify({"message": "已取消布置"}), 200
+
+
+@app.route('/api/admin/profiling/<profile_id>', methods=['GET'])
+def download_profiling_api(profile_id):
+    """下载分析结果: cProfile 为 .prof (pstats 格式，?format=text 返回文本报表)，采样为折叠栈 .folded (火焰图输入)。"""
+    denied = check_admin_user(request.args.get('user_id', type=int))
+    if denied:
+        return denied
+    try:
+        meta, path = profiling.get_result(profile_id)
+    except PermissionError as e:
+        return jsonify({"message": f"分析结果目录不安全: {e}"}), 500
+    if meta is None or not os.path.exists(path):
+        return jsonify({"message": "分析结果不存在"}), 404
+    if request.args.get('format') == 'text' and meta['mode'] == 'cprofile':
+        report = profiling.format_stats_text(path, sort=request.args.get('sort', 'cumulative'),
+                                             limit=request.args.get('limit', 50, type=int))
+        return Response(report, mimetype='text/plain; charset=utf-8')
+    return send_file(path, mimetype='application/octet-stream' if meta['mode'] == 'cprofile' else 'text/plain',
+                     as_attachment=True, download_name=meta['data_file'])
+
+
+@app.route('/api/admin/db-stats', methods=['GET'])
+def db_stats_api():
+    """各路由的数据库耗时累计 (本进程启动以来)。"""
+    denied = check_admin_user(request.args.get('user_id', type=int))
+    if denied:
+        return denied
+    return jsonify({"enabled": DB_INSTRUMENTATION, "slow_query_ms": db_instrumentation.SLOW_QUERY_MS,
+                    "routes": db_instrumentation.route_stats()}), 200
+
+
+# Prometheus 抓取接口 (文本格式)，指标定义见 metrics.py
+@app.route('/metrics', methods=['GET'])
+def metrics_api():
+    return Response(metrics.REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @app.route('/')
 def index():
     return "Timetable Scheduling Backend API is running."
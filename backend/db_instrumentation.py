@@ -0,0 +1,220 @@
+# db_instrumentation.py
+# -*- coding: utf-8 -*-
+# 数据库计时: get_db_connection 返回的连接换成 TimedConnection，它创建的游标 (包括 RealDictCursor 等
+# 自定义游标类) 会记录每条语句的耗时。请求开始时 begin_request() 建立本线程的收集器，语句耗时计入当前
+# 路由；超过 DB_SLOW_QUERY_MS 的语句写慢查询日志 (只记录参数的类型/长度，不记录参数值)。
+# 请求结束时 end_request() 返回本次请求的合计，由 app.py 写成 Server-Timing 响应头。
+# 连接数和语句耗时同时计入 metrics 注册表 (/metrics)。
+import logging
+import os
+import re
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+import metrics
+
+SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "200"))
+SQL_LOG_LIMIT = 500  # 慢查询日志中 SQL 的最大长度
+
+logger = logging.getLogger("db_instrumentation")
+
+_local = threading.local()
+_route_stats = {}  # 路由 -> 累计统计，见 route_stats()
+_route_stats_lock = threading.Lock()
+
+
+class RequestTimings:
+    """一个请求内的数据库/序列化耗时合计 (毫秒)。"""
+
+    def __init__(self, route):
+        self.route = route
+        self.started = time.perf_counter()
+        self.connect_ms = 0.0
+        self.connects = 0
+        self.query_ms = 0.0
+        self.queries = 0
+        self.slow_queries = 0
+        self.json_ms = 0.0
+
+    def server_timing(self):
+        """Server-Timing 响应头的值。"""
+        total_ms = (time.perf_counter() - self.started) * 1000
+        return ", ".join([
+            f'db;dur={self.query_ms:.2f};desc="{self.queries} queries"',
+            f'db-connect;dur={self.connect_ms:.2f};desc="{self.connects} connections"',
+            f"json;dur={self.json_ms:.2f}",
+            f"total;dur={total_ms:.2f}",
+        ])
+
+
+def begin_request(route):
+    _local.timings = RequestTimings(route)
+    return _local.timings
+
+
+def end_request():
+    """结束本线程当前请求的统计，返回 RequestTimings (没有进行中的请求时返回 None)。"""
+    timings = getattr(_local, "timings", None)
+    _local.timings = None
+    if timings is not None:
+        _record_route(timings)
+    return timings
+
+
+def current_timings():
+    return getattr(_local, "timings", None)
+
+
+def record_json(elapsed_ms):
+    timings = current_timings()
+    if timings is not None:
+        timings.json_ms += elapsed_ms
+
+
+def describe_params(params):
+    """参数的"形状": 只保留类型和长度，例如 (int, str[12], list[40])，不把参数值写进日志。"""
+    def shape(value):
+        if value is None:
+            return "None"
+        if isinstance(value, (str, bytes, list, tuple, set, dict)):
+            return f"{type(value).__name__}[{len(value)}]"
+        return type(value).__name__
+    if params is None:
+        return "-"
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{key}: {shape(value)}" for key, value in params.items()) + "}"
+    if isinstance(params, (list, tuple)):
+        return "(" + ", ".join(shape(value) for value in params) + ")"
+    return shape(params)
+
+
+def _compact_sql(query, cursor=None):
+    if hasattr(query, "as_string") and cursor is not None:
+        try:
+            query = query.as_string(cursor)  # psycopg2.sql.Composed
+        except Exception:
+            pass
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    elif not isinstance(query, str):
+        query = str(query)
+    query = re.sub(r"\s+", " ", query).strip()
+    return query if len(query) <= SQL_LOG_LIMIT else query[:SQL_LOG_LIMIT] + " ..."
+
+
+def _record_statement(query, params, elapsed_ms, cursor):
+    metrics.DB_QUERY_DURATION.observe(elapsed_ms / 1000)
+    timings = current_timings()
+    if timings is not None:
+        timings.query_ms += elapsed_ms
+        timings.queries += 1
+    if elapsed_ms >= SLOW_QUERY_MS:
+        if timings is not None:
+            timings.slow_queries += 1
+        logger.warning("SLOW QUERY %.1fms route=%s rows=%s params=%s sql=%s", elapsed_ms,
+                       timings.route if timings else "-", cursor.rowcount, describe_params(params),
+                       _compact_sql(query, cursor),
+                       extra={"event": "db.slow_query", "duration_ms": round(elapsed_ms, 1),
+                              "route": timings.route if timings else None, "rows": cursor.rowcount})
+
+
+def _record_route(timings):
+    with _route_stats_lock:
+        stats = _route_stats.setdefault(timings.route, {"requests": 0, "queries": 0, "query_ms": 0.0,
+                                                        "max_query_ms_per_request": 0.0, "connect_ms": 0.0,
+                                                        "json_ms": 0.0, "slow_queries": 0})
+        stats["requests"] += 1
+        stats["queries"] += timings.queries
+        stats["query_ms"] += timings.query_ms
+        stats["max_query_ms_per_request"] = max(stats["max_query_ms_per_request"], timings.query_ms)
+        stats["connect_ms"] += timings.connect_ms
+        stats["json_ms"] += timings.json_ms
+        stats["slow_queries"] += timings.slow_queries
+
+
+def route_stats():
+    """各路由的累计统计 (进程启动以来)，按数据库总耗时倒序。"""
+    with _route_stats_lock:
+        items = [(route, dict(stats)) for route, stats in _route_stats.items()]
+    for _, stats in items:
+        for key in ("query_ms", "max_query_ms_per_request", "connect_ms", "json_ms"):
+            stats[key] = round(stats[key], 2)
+        stats["avg_query_ms"] = round(stats["query_ms"] / stats["requests"], 2) if stats["requests"] else 0.0
+    return dict(sorted(items, key=lambda item: item[1]["query_ms"], reverse=True))
+
+
+class TimedCursorMixin:
+    """给任意 psycopg2 游标类加上语句计时。"""
+
+    def _timed(self, method, query, params, *args):
+        started = time.perf_counter()
+        try:
+            return method(query, params, *args) if args or params is not None else method(query)
+        finally:
+            _record_statement(query, params, (time.perf_counter() - started) * 1000, self)
+
+    def execute(self, query, vars=None):
+        return self._timed(super().execute, query, vars)
+
+    def executemany(self, query, vars_list):
+        return self._timed(super().executemany, query, vars_list)
+
+    def callproc(self, procname, parameters=None):
+        return self._timed(super().callproc, procname, parameters)
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            _record_statement(sql, None, (time.perf_counter() - started) * 1000, self)
+
+
+_timed_cursor_classes = {}
+_timed_cursor_lock = threading.Lock()
+
+
+def timed_cursor_class(cursor_class):
+    """返回 cursor_class 的计时子类 (按类缓存)。"""
+    timed = _timed_cursor_classes.get(cursor_class)
+    if timed is None:
+        with _timed_cursor_lock:
+            timed = _timed_cursor_classes.get(cursor_class)
+            if timed is None:
+                timed = type(f"Timed{cursor_class.__name__}", (TimedCursorMixin, cursor_class), {})
+                _timed_cursor_classes[cursor_class] = timed
+    return timed
+
+
+class TimedConnection(psycopg2.extensions.connection):
+    """cursor() 返回的游标 (不论 cursor_factory 是什么) 都带语句计时。"""
+
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get("cursor_factory") or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs["cursor_factory"] = timed_cursor_class(factory)
+        return super().cursor(*args, **kwargs)
+
+    def close(self):
+        if not self.closed:
+            metrics.DB_CONNECTIONS_OPEN.dec()
+        return super().close()
+
+
+def connect(**params):
+    """与 psycopg2.connect 相同，返回 TimedConnection，并把建立连接的耗时计入当前请求。"""
+    started = time.perf_counter()
+    try:
+        conn = psycopg2.connect(connection_factory=TimedConnection, **params)
+    except psycopg2.Error:
+        metrics.DB_CONNECTION_ERRORS.inc()
+        raise
+    metrics.DB_CONNECTIONS.inc()
+    metrics.DB_CONNECTIONS_OPEN.inc()
+    timings = current_timings()
+    if timings is not None:
+        timings.connect_ms += (time.perf_counter() - started) * 1000
+        timings.connects += 1
+    return conn
@@ -0,0 +1,424 @@
+# load_test.py
+# -*- coding: utf-8 -*-
+# 课表 API 压力测试: 用 synthetic_data 生成数据写入本地 PostgreSQL (--dsn 指向的测试库，或 --pgserver
+# 启动的嵌入式实例)，排一次课，然后用多个线程按比例发送读/写混合请求 (课表查询、教师工作台、手动调整、
+# Excel 导出)，报告每个接口的 p50/p95/p99 延迟和每秒请求数。
+# 默认在本进程内启动 app (werkzeug 多线程服务器)，也可以用 --url 压一个已经运行的后端 (仍需 --dsn 读取 ID)。
+#
+# 示例:
+#   python load_test.py --pgserver /tmp/loadtest_pg --seed-db --majors 50 --duration 30 --concurrency 16
+#   python load_test.py --dsn postgresql://postgres@localhost/loadtest --seed-db --reset --mix student=10,export=0
+#   python load_test.py --dsn postgresql://postgres@localhost/loadtest --url http://127.0.0.1:5000 --duration 60
+import argparse
+import collections
+import json
+import math
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+import scheduler_module
+import synthetic_data
+from scheduler_benchmark import quiet
+
+# --- 可选: 嵌入式 PostgreSQL (pip install pgserver) ---
+try:
+    import pgserver
+    PGSERVER_AVAILABLE = True
+except ImportError:
+    PGSERVER_AVAILABLE = False
+
+# 基础表 (与后端使用的列一致)；课表相关的表和列由 scheduler_module.ensure_schedule_schema 补齐
+BASE_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS users (id INT PRIMARY KEY, username VARCHAR(100) UNIQUE NOT NULL,
+    password VARCHAR(255) NOT NULL, role VARCHAR(20) NOT NULL);
+CREATE TABLE IF NOT EXISTS teachers (id SERIAL PRIMARY KEY, user_id INT REFERENCES users(id));
+CREATE TABLE IF NOT EXISTS majors (id SERIAL PRIMARY KEY, name VARCHAR(100) UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS students (id SERIAL PRIMARY KEY, user_id INT REFERENCES users(id),
+    major_id INT REFERENCES majors(id));
+CREATE TABLE IF NOT EXISTS semesters (id SERIAL PRIMARY KEY, name VARCHAR(100) NOT NULL, start_date DATE, end_date DATE);
+CREATE TABLE IF NOT EXISTS classrooms (id SERIAL PRIMARY KEY, building VARCHAR(50), room_number VARCHAR(20),
+    capacity INT, room_type VARCHAR(20));
+CREATE TABLE IF NOT EXISTS courses (id SERIAL PRIMARY KEY, name VARCHAR(100) UNIQUE NOT NULL, total_sessions INT,
+    course_type VARCHAR(20));
+CREATE TABLE IF NOT EXISTS time_slots (id SERIAL PRIMARY KEY, day_of_week VARCHAR(10), period INT,
+    start_time TIME, end_time TIME);
+CREATE TABLE IF NOT EXISTS course_assignments (id SERIAL PRIMARY KEY, major_id INT REFERENCES majors(id),
+    course_id INT REFERENCES courses(id), teacher_id INT REFERENCES teachers(id),
+    semester_id INT REFERENCES semesters(id), is_core_course BOOLEAN, expected_students INT);
+CREATE TABLE IF NOT EXISTS timetable_entries (id SERIAL PRIMARY KEY, semester_id INT REFERENCES semesters(id),
+    major_id INT REFERENCES majors(id), course_id INT REFERENCES courses(id), teacher_id INT REFERENCES teachers(id),
+    classroom_id INT REFERENCES classrooms(id), timeslot_id INT REFERENCES time_slots(id), week_number INT,
+    assignment_id INT REFERENCES course_assignments(id) ON DELETE CASCADE);
+CREATE TABLE IF NOT EXISTS teacher_scheduling_preferences (id SERIAL PRIMARY KEY,
+    teacher_id INT REFERENCES teachers(id), semester_id INT REFERENCES semesters(id),
+    timeslot_id INT REFERENCES time_slots(id), preference_type VARCHAR(20), reason TEXT, status VARCHAR(20),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (teacher_id, semester_id, timeslot_id, preference_type));
+"""
+SEEDED_TABLES = ('timetable_entries', 'teacher_scheduling_preferences', 'course_assignments', 'students',
+                 'teachers', 'courses', 'classrooms', 'time_slots', 'majors', 'semesters', 'users')
+STUDENT_USER_OFFSET = 100000
+ADMIN_USER_ID = 1
+
+# 默认流量比例: 以学生/教师查课表为主，少量手动调整和导出
+DEFAULT_MIX = {'semester': 1, 'teacher': 6, 'major': 6, 'student': 40, 'teacher_dashboard': 15,
+               'edit': 2, 'export': 1}
+
+
+def log(message):
+    print(f"LOADTEST: {message}", file=sys.stderr)
+
+
+# ==================================
+# 1. 数据准备
+# ==================================
+def seed_database(get_connection, n_majors, students_per_major, seed=0, reset=False):
+    """建表并写入合成数据，然后排一次课。库中已有数据时必须 reset=True (清空后重写)。"""
+    all_data = synthetic_data.generate_university(n_majors, seed=seed)
+    conn = get_connection()
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute(BASE_SCHEMA_SQL)
+        cur.execute("SELECT EXISTS (SELECT 1 FROM users)")
+        if cur.fetchone()[0]:
+            if not reset:
+                raise RuntimeError("目标数据库中已有数据，确认是测试库后加 --reset 清空重建")
+            cur.execute(f"TRUNCATE {', '.join(SEEDED_TABLES)} RESTART IDENTITY CASCADE")
+        teachers = all_data['teachers'].values()
+        users = [(ADMIN_USER_ID, 'admin', 'admin', 'admin')]
+        users += [(t.user_id, t.name, 'x', 'teacher') for t in teachers]
+        students = []
+        for mid in all_data['majors']:
+            for k in range(students_per_major):
+                user_id = STUDENT_USER_OFFSET + mid * 1000 + k
+                users.append((user_id, f"student{user_id}", 'x', 'student'))
+                students.append((user_id, mid))
+        execute_values(cur, "INSERT INTO users (id, username, password, role) VALUES %s", users)
+        execute_values(cur, "INSERT INTO teachers (id, user_id) VALUES %s", [(t.id, t.user_id) for t in teachers])
+        execute_values(cur, "INSERT INTO majors (id, name) VALUES %s",
+                       [(m.id, m.name) for m in all_data['majors'].values()])
+        execute_values(cur, "INSERT INTO students (user_id, major_id) VALUES %s", students)
+        execute_values(cur, "INSERT INTO semesters (id, name, start_date, end_date) VALUES %s",
+                       [(s.id, s.name, s.start_date, s.end_date) for s in all_data['semesters'].values()])
+        execute_values(cur, "INSERT INTO classrooms (id, building, room_number, capacity, room_type) VALUES %s",
+                       [(c.id, all_data['classroom_buildings'][c.id], c.name.split('-', 1)[-1], c.capacity, c.type)
+                        for c in all_data['classrooms'].values()])
+        execute_values(cur, "INSERT INTO courses (id, name, total_sessions, course_type) VALUES %s",
+                       [(c.id, c.name, c.total_sessions, c.course_type) for c in all_data['courses'].values()])
+        execute_values(cur, "INSERT INTO time_slots (id, day_of_week, period, start_time, end_time) VALUES %s",
+                       [(t.id, t.day_of_week, t.period, t.start_time, t.end_time)
+                        for t in all_data['timeslots'].values()])
+        execute_values(cur, """INSERT INTO course_assignments
+                                   (id, major_id, course_id, teacher_id, semester_id, is_core_course, expected_students)
+                               VALUES %s""",
+                       [tuple(a) for a in all_data['course_assignments'].values()])
+        execute_values(cur, """INSERT INTO teacher_scheduling_preferences
+                                   (teacher_id, semester_id, timeslot_id, preference_type, reason, status)
+                               VALUES %s""",
+                       [(t, s, ts, 'avoid', '压力测试数据', 'approved')
+                        for t, ts, s in sorted(all_data['approved_avoid_preferences'])])
+        # 显式写入了 id，把序列推到最大值之后，后端新增记录时不会撞主键
+        for table in ('teachers', 'majors', 'semesters', 'classrooms', 'courses', 'time_slots', 'course_assignments'):
+            cur.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT MAX(id) FROM {table}))")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if cur: cur.close()
+        conn.close()
+
+    scheduler_module.ensure_schedule_schema(get_connection)
+    semester_id = min(all_data['semesters'])
+    with quiet():
+        summary = scheduler_module.run_full_scheduling_process(semester_id, get_connection, checkpoint_interval=0)
+    if not summary.get("status", "").startswith("success"):
+        raise RuntimeError(f"排课失败: {summary.get('message')}")
+    log(f"已写入 {synthetic_data.describe(all_data)}，学生 {len(students)} 人，"
+        f"排课 {summary['db_records_saved']} 条")
+
+
+def load_targets(get_connection):
+    """从数据库读取压测用的 ID (学期、教师、专业、学生、课表条目)。"""
+    conn = get_connection()
+    cur = None
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT id, start_date, end_date FROM semesters ORDER BY id LIMIT 1")
+        row = cur.fetchone()
+        if row is None:
+            raise RuntimeError("数据库中没有学期数据，先用 --seed-db 写入测试数据")
+        semester_id = row[0]
+        total_weeks = max(1, ((row[2] - row[1]).days + 7) // 7) if row[1] and row[2] else 16
+
+        def column(query, *params):
+            cur.execute(query, params)
+            return [r[0] for r in cur.fetchall()]
+        targets = {
+            "semester_id": semester_id,
+            "total_weeks": total_weeks,
+            "teacher_ids": column("SELECT id FROM teachers ORDER BY id"),
+            "teacher_user_ids": column("SELECT user_id FROM teachers ORDER BY id"),
+            "major_ids": column("SELECT id FROM majors ORDER BY id"),
+            "student_user_ids": column("SELECT user_id FROM students ORDER BY id"),
+            "timeslot_ids": column("SELECT id FROM time_slots ORDER BY id"),
+            "entries": [],
+        }
+        cur.execute("SELECT id, classroom_id, week_number FROM timetable_entries WHERE semester_id = %s "
+                    "ORDER BY id LIMIT 5000", (semester_id,))
+        targets["entries"] = cur.fetchall()
+        for key in ("teacher_ids", "major_ids", "student_user_ids"):
+            if not targets[key]:
+                raise RuntimeError(f"数据库中缺少压测需要的数据 ({key})")
+        return targets
+    finally:
+        if cur: cur.close()
+        conn.close()
+
+
+# ==================================
+# 2. 请求生成
+# ==================================
+def make_request(kind, targets, rnd):
+    """返回 (method, path, json_body)。"""
+    sid = targets["semester_id"]
+    week = rnd.randint(1, targets["total_weeks"])
+    if kind == 'semester':
+        return 'GET', f"/api/timetables/semester/{sid}", None
+    if kind == 'teacher':
+        return 'GET', f"/api/timetables/teacher/{rnd.choice(targets['teacher_ids'])}/semester/{sid}", None
+    if kind == 'major':
+        return 'GET', f"/api/timetables/major/{rnd.choice(targets['major_ids'])}/semester/{sid}?week={week}", None
+    if kind == 'student':
+        return ('GET', f"/api/timetables/student/{rnd.choice(targets['student_user_ids'])}/semester/{sid}"
+                       f"?week={week}", None)
+    if kind == 'teacher_dashboard':
+        return ('GET', f"/api/timetables/teacher-dashboard/{rnd.choice(targets['teacher_user_ids'])}"
+                       f"/semester/{sid}?week={week}", None)
+    if kind == 'edit':
+        # 把一个条目挪到同一周的随机时段 (冲突时后端返回 409，也算正常响应)
+        entry_id, classroom_id, week_number = rnd.choice(targets["entries"])
+        return 'PUT', f"/api/timetables/entry/{entry_id}", {
+            "timeslot_id": rnd.choice(targets["timeslot_ids"]), "classroom_id": classroom_id,
+            "week_number": week_number, "pin": False}
+    if kind == 'export':
+        return 'GET', f"/api/timetables/export/major/{rnd.choice(targets['major_ids'])}/semester/{sid}", None
+    raise ValueError(f"未知的请求类型: {kind}")
+
+
+def send_request(base_url, method, path, body, timeout):
+    """发送请求，返回 (状态码, 字节数)。连接失败/超时返回状态码 0。"""
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    req = urllib.request.Request(base_url + path, data=data, method=method,
+                                 headers={'Content-Type': 'application/json'} if data else {})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return resp.status, len(resp.read())
+    except urllib.error.HTTPError as e:
+        return e.code, len(e.read() or b'')
+    except (urllib.error.URLError, OSError):
+        return 0, 0
+
+
+# ==================================
+# 3. 压测与统计
+# ==================================
+class EndpointStats:
+    def __init__(self):
+        self.latencies = []
+        self.statuses = collections.Counter()
+        self.bytes = 0
+
+    def add(self, latency, status, size):
+        self.latencies.append(latency)
+        self.statuses[status] += 1
+        self.bytes += size
+
+
+def percentile(sorted_values, fraction):
+    """最近秩法百分位，sorted_values 已排序。"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run_load(base_url, targets, mix, concurrency, duration=None, total_requests=None, timeout=30, seed=0):
+    """
+    concurrency 个线程按 mix 的权重随机选接口发请求，直到 duration 秒或共发出 total_requests 个请求。
+    返回 (各接口的 EndpointStats, 实际耗时秒数)。
+    """
+    kinds = [kind for kind, weight in mix.items() if weight > 0]
+    weights = [mix[kind] for kind in kinds]
+    if not targets["entries"]:
+        weights = [0 if kind == 'edit' else w for kind, w in zip(kinds, weights)]
+    stats = collections.defaultdict(EndpointStats)
+    stats_lock = threading.Lock()
+    issued = [0]
+    started = time.perf_counter()
+    deadline = started + duration if duration else None
+
+    def next_slot():
+        with stats_lock:
+            if total_requests is not None and issued[0] >= total_requests:
+                return False
+            issued[0] += 1
+            return True
+
+    def worker(worker_index):
+        rnd = random.Random(seed * 1000 + worker_index)
+        while (deadline is None or time.perf_counter() < deadline) and next_slot():
+            kind = rnd.choices(kinds, weights)[0]
+            method, path, body = make_request(kind, targets, rnd)
+            request_started = time.perf_counter()
+            status, size = send_request(base_url, method, path, body, timeout)
+            latency = time.perf_counter() - request_started
+            with stats_lock:
+                stats[kind].add(latency, status, size)
+
+    threads = [threading.Thread(target=worker, args=(i,), name=f"loadtest-{i}", daemon=True)
+               for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return dict(stats), time.perf_counter() - started
+
+
+def summarize(stats, elapsed):
+    report = {"elapsed_seconds": round(elapsed, 3), "endpoints": {}}
+    total = 0
+    for kind, endpoint in sorted(stats.items()):
+        latencies = sorted(endpoint.latencies)
+        count = len(latencies)
+        total += count
+        errors = sum(n for status, n in endpoint.statuses.items() if status == 0 or status >= 500)
+        report["endpoints"][kind] = {
+            "requests": count,
+            "rps": round(count / elapsed, 2) if elapsed else 0.0,
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+            "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+            "errors": errors,
+            "statuses": {str(status): n for status, n in sorted(endpoint.statuses.items())},
+            "bytes": endpoint.bytes,
+        }
+    report["total_requests"] = total
+    report["total_rps"] = round(total / elapsed, 2) if elapsed else 0.0
+    return report
+
+
+def format_report(report):
+    lines = [f"{'endpoint':<18}{'reqs':>7}{'rps':>9}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}"
+             f"{'max(ms)':>10}{'errors':>8}  statuses"]
+    for kind, e in report["endpoints"].items():
+        statuses = " ".join(f"{status}:{n}" for status, n in e["statuses"].items())
+        lines.append(f"{kind:<18}{e['requests']:>7}{e['rps']:>9.1f}{e['p50_ms']:>10.1f}{e['p95_ms']:>10.1f}"
+                     f"{e['p99_ms']:>10.1f}{e['max_ms']:>10.1f}{e['errors']:>8}  {statuses}")
+    lines.append(f"total: {report['total_requests']} 个请求, {report['elapsed_seconds']:.1f}s, "
+                 f"{report['total_rps']:.1f} req/s")
+    return "\n".join(lines)
+
+
+# ==================================
+# 4. 本进程内的后端
+# ==================================
+def start_local_server(db_params):
+    """在后台线程中启动 app (多线程 werkzeug 服务器，随机端口)，返回 (base_url, server)。"""
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    import app as backend_app
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass  # 每个请求一行访问日志会明显拖慢压测
+
+    backend_app.DB_CONNECT_PARAMS = dict(db_params)
+    backend_app.app.logger.setLevel('WARNING')
+    server = make_server('127.0.0.1', 0, backend_app.app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, name="loadtest-server", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server
+
+
+def parse_mix(text):
+    mix = dict(DEFAULT_MIX)
+    if not text:
+        return mix
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in DEFAULT_MIX:
+            raise ValueError(f"未知的接口 {name}，可选: {', '.join(DEFAULT_MIX)}")
+        mix[name] = float(weight)
+    return mix
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="课表 API 压力测试 (合成数据 + 本地 PostgreSQL)")
+    db = parser.add_mutually_exclusive_group(required=True)
+    db.add_argument('--dsn', help="测试库的 PostgreSQL 连接串 (--seed-db 会写入数据)")
+    db.add_argument('--pgserver', metavar='DIR', help="在 DIR 启动嵌入式 PostgreSQL (需要 pip install pgserver)")
+    parser.add_argument('--url', help="压测已运行的后端 (默认在本进程内启动 app)")
+    parser.add_argument('--seed-db', action='store_true', help="写入合成数据并排课")
+    parser.add_argument('--reset', action='store_true', help="--seed-db 时清空库中已有数据")
+    parser.add_argument('--majors', type=int, default=20)
+    parser.add_argument('--students-per-major', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20, help="压测秒数")
+    parser.add_argument('--requests', type=int, help="总请求数 (给出时先到者为准)")
+    parser.add_argument('--timeout', type=float, default=30, help="单个请求超时秒数")
+    parser.add_argument('--mix', help="接口权重，如 student=40,edit=0 (未给出的用默认值)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', metavar='PATH', help="把结果写成 JSON")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.pgserver:
+        if not PGSERVER_AVAILABLE:
+            parser.error("--pgserver 需要先安装 pgserver (pip install pgserver)")
+        db_params = {'dsn': pgserver.get_server(args.pgserver, cleanup_mode='stop').get_uri()}
+    else:
+        db_params = {'dsn': args.dsn}
+    get_connection = lambda: psycopg2.connect(**db_params)
+
+    if args.seed_db:
+        seed_database(get_connection, args.majors, args.students_per_major, seed=args.seed, reset=args.reset)
+    targets = load_targets(get_connection)
+    if args.url:
+        base_url = args.url.rstrip('/')
+        server = None
+    else:
+        base_url, server = start_local_server(db_params)
+    log(f"压测 {base_url}: 并发 {args.concurrency}，{args.duration}s，权重 {mix}")
+    try:
+        with quiet():
+            stats, elapsed = run_load(base_url, targets, mix, args.concurrency, duration=args.duration,
+                                      total_requests=args.requests, timeout=args.timeout, seed=args.seed)
+    finally:
+        if server is not None:
+            server.shutdown()
+    report = summarize(stats, elapsed)
+    print(format_report(report))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,288 @@
+# metrics.py
+# -*- coding: utf-8 -*-
+# 进程内指标注册表，按 Prometheus 文本格式 (0.0.4) 输出，由 app.py 的 /metrics 接口暴露。
+# 计数器/直方图/仪表的每次更新只是持锁修改字典，开销很小；多线程共享同一个注册表。
+# 多进程部署 (gunicorn 多 worker 等) 时设置 METRICS_MULTIPROC_DIR: 每个进程定期 (以及退出时) 把自己的
+# 数值写到 <目录>/metrics_<pid>.json，/metrics 把目录中各进程的文件与本进程的实时数值合并 (计数器和
+# 直方图求和，仪表只合并仍在运行的进程)。该目录应在服务启动前清空。
+import atexit
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR") or None
+FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))  # 秒
+
+logger = logging.getLogger("metrics")
+
+# 直方图的默认桶
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+RUN_DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+COUNT_BUCKETS = (0, 10, 100, 500, 1000, 5000, 10000, 50000, 100000, 500000)
+SIZE_BUCKETS = (1024, 10240, 102400, 512000, 1048576, 5242880, 20971520)
+
+
+class Registry:
+    def __init__(self, multiproc_dir=None):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.multiproc_dir = multiproc_dir
+        self._next_flush = 0.0
+        if multiproc_dir:
+            os.makedirs(multiproc_dir, exist_ok=True)
+            atexit.register(self.flush)
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"指标 {metric.name} 已注册")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def maybe_flush(self):
+        """多进程模式下距上次写文件超过 FLUSH_INTERVAL 秒时写一次 (由更新指标的调用顺带触发)。"""
+        if self.multiproc_dir and time.monotonic() >= self._next_flush:
+            self.flush()
+
+    def snapshot(self):
+        """本进程所有指标的可序列化副本。"""
+        with self.lock:
+            return {name: metric.dump() for name, metric in self.metrics.items()}
+
+    def flush(self):
+        """把本进程的数值写到多进程目录 (先写临时文件再改名)。"""
+        if not self.multiproc_dir:
+            return
+        self._next_flush = time.monotonic() + FLUSH_INTERVAL
+        path = os.path.join(self.multiproc_dir, f"metrics_{os.getpid()}.json")
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"pid": os.getpid(), "metrics": self.snapshot()}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("写入指标文件 %s 失败: %s", path, e, extra={"event": "metrics.flush_failed"})
+
+    def _collect(self):
+        merged = self.snapshot()
+        if not self.multiproc_dir:
+            return merged
+        for name in os.listdir(self.multiproc_dir):
+            if not (name.startswith("metrics_") and name.endswith(".json")):
+                continue
+            try:
+                with open(os.path.join(self.multiproc_dir, name), encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue  # 正在被替换的文件
+            pid = data.get("pid")
+            if pid == os.getpid():
+                continue  # 本进程用实时数值
+            alive = _pid_alive(pid)
+            for metric_name, dumped in data.get("metrics", {}).items():
+                if dumped["type"] == "gauge" and not alive:
+                    continue
+                target = merged.get(metric_name)
+                if target is None:
+                    merged[metric_name] = dumped
+                else:
+                    _merge_dump(target, dumped)
+        return merged
+
+    def render(self):
+        """Prometheus 文本格式。"""
+        lines = []
+        for name, dumped in sorted(self._collect().items()):
+            lines.append(f"# HELP {name} {dumped['help']}")
+            lines.append(f"# TYPE {name} {dumped['type']}")
+            labelnames = dumped["labelnames"]
+            for labels, value in sorted(dumped["samples"], key=lambda sample: sample[0]):
+                if dumped["type"] == "histogram":
+                    bucket_counts, total, count = value
+                    cumulative = 0
+                    for bound, bucket_count in zip(dumped["buckets"], bucket_counts):
+                        cumulative += bucket_count
+                        lines.append(f"{name}_bucket{_labels(labelnames, labels, le=_format_value(bound))} "
+                                     f"{cumulative}")
+                    lines.append(f"{name}_bucket{_labels(labelnames, labels, le='+Inf')} {count}")
+                    lines.append(f"{name}_sum{_labels(labelnames, labels)} {_format_value(total)}")
+                    lines.append(f"{name}_count{_labels(labelnames, labels)} {count}")
+                else:
+                    lines.append(f"{name}{_labels(labelnames, labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, TypeError):
+        return pid is not None
+    return True
+
+
+def _merge_dump(target, other):
+    samples = {tuple(labels): value for labels, value in target["samples"]}
+    for labels, value in other["samples"]:
+        key = tuple(labels)
+        current = samples.get(key)
+        if current is None:
+            samples[key] = value
+        elif target["type"] == "histogram":
+            samples[key] = [[a + b for a, b in zip(current[0], value[0])], current[1] + value[1],
+                            current[2] + value[2]]
+        else:
+            samples[key] = current + value
+    target["samples"] = [[list(labels), value] for labels, value in samples.items()]
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labelnames, labels, **extra):
+    pairs = list(zip(labelnames, labels)) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        if value.is_integer():
+            return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, help_text, labelnames=(), registry=None):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.registry = registry or REGISTRY
+        self.values = {}
+        self.registry.register(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"指标 {self.name} 需要标签 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def dump(self):
+        return {"type": self.type_name, "help": self.help, "labelnames": list(self.labelnames),
+                "samples": [[list(key), self._dump_value(value)] for key, value in self.values.items()]}
+
+    def _dump_value(self, value):
+        return value
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        self.registry.maybe_flush()
+
+
+class Gauge(_Metric):
+    """仪表。多进程模式下合并各运行中进程的数值之和。"""
+    type_name = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        self.registry.maybe_flush()
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = value
+        self.registry.maybe_flush()
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self.registry.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+        self.registry.maybe_flush()
+
+    def dump(self):
+        dumped = super().dump()
+        dumped["buckets"] = list(self.buckets)
+        return dumped
+
+    def _dump_value(self, value):
+        return [list(value[0]), value[1], value[2]]
+
+
+REGISTRY = Registry(MULTIPROC_DIR)
+
+# --- HTTP ---
+HTTP_REQUEST_DURATION = Histogram("http_request_duration_seconds", "HTTP 请求处理耗时", ("route", "method"))
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP 请求数", ("route", "method", "status"))
+
+# --- 数据库 ---
+DB_CONNECTIONS = Counter("db_connections_total", "建立的数据库连接数")
+DB_CONNECTION_ERRORS = Counter("db_connection_errors_total", "建立数据库连接失败次数")
+DB_CONNECTIONS_OPEN = Gauge("db_connections_open", "当前打开的数据库连接数 (通过 get_db_connection 建立)")
+DB_QUERY_DURATION = Histogram("db_query_duration_seconds", "数据库语句耗时")
+
+# --- 排课 ---
+SCHEDULING_RUNS = Counter("scheduling_runs_total", "排课运行次数", ("status", "mode"))
+SCHEDULING_RUN_DURATION = Histogram("scheduling_run_duration_seconds", "排课运行耗时 (获得学期锁之后)",
+                                    ("status", "mode"), buckets=RUN_DURATION_BUCKETS)
+SCHEDULING_SESSIONS_PLACED = Histogram("scheduling_run_sessions_placed", "每次排课排入的课时条目数",
+                                       ("mode",), buckets=COUNT_BUCKETS)
+SCHEDULING_TASKS_UNSCHEDULED = Histogram("scheduling_run_tasks_unscheduled", "每次排课未完成的教学任务数",
+                                         ("mode",), buckets=COUNT_BUCKETS)
+
+# --- 导出 / 导入 ---
+EXPORT_DURATION = Histogram("export_duration_seconds", "Excel 导出耗时", ("kind",))
+EXPORT_SIZE = Histogram("export_size_bytes", "Excel 导出文件大小", ("kind",), buckets=SIZE_BUCKETS)
+IMPORT_DURATION = Histogram("import_duration_seconds", "课程计划导入耗时", ("status",),
+                            buckets=RUN_DURATION_BUCKETS)
+IMPORT_ROWS = Counter("import_rows_total", "课程计划导入的行数 (stage=processed 为读取的 Excel 行，"
+                                           "inserted 为写入的教学任务)", ("stage",))
+
+
+def record_scheduling_run(summary):
+    """按排课摘要 (run_full_scheduling_process 的返回值) 记录排课指标。"""
+    status = summary.get("status", "failure")
+    mode = summary.get("mode", "full")
+    SCHEDULING_RUNS.inc(status=status, mode=mode)
+    if summary.get("duration_seconds") is not None:
+        SCHEDULING_RUN_DURATION.observe(summary["duration_seconds"], status=status, mode=mode)
+    if status.startswith("success"):
+        SCHEDULING_SESSIONS_PLACED.observe(summary.get("total_scheduled_entries", 0), mode=mode)
+        SCHEDULING_TASKS_UNSCHEDULED.observe(summary.get("total_uncompleted_tasks", 0), mode=mode)
@@ -0,0 +1,32 @@
+# private_storage.py
+# -*- coding: utf-8 -*-
+# 本地私有目录: 排课检查点和性能分析结果只能写在仅当前用户可访问的目录里。
+# 默认放在用户缓存目录 ($XDG_CACHE_HOME 或 ~/.cache) 下的 course_scheduling/<用途>，不再使用共享的 /tmp；
+# 目录以 0700 创建，已存在的目录若不属于当前用户或对组/其他用户开放则拒绝使用，
+# 防止本机其他用户预先放置文件。
+import os
+import stat
+
+
+def default_directory(purpose):
+    """<用户缓存目录>/course_scheduling/<purpose>。"""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "course_scheduling", purpose)
+
+
+def ensure_private_directory(path):
+    """
+    创建 (不存在时) 并检查目录: 必须是真实目录 (不是符号链接)、属于当前用户、组和其他用户没有任何权限。
+    不满足时抛出 PermissionError。返回 path。
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise PermissionError(f"{path} 不是目录 (可能是符号链接)，拒绝使用")
+    if os.name == "posix":
+        if info.st_uid != os.getuid():
+            raise PermissionError(f"目录 {path} 不属于当前用户，拒绝使用")
+        if info.st_mode & 0o077:
+            raise PermissionError(f"目录 {path} 对组或其他用户开放 (权限 {stat.S_IMODE(info.st_mode):o})，"
+                                  f"拒绝使用；请改为 0700")
+    return path
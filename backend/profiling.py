@@ -0,0 +1,259 @@
+# profiling.py
+# -*- coding: utf-8 -*-
+# 按需性能分析: 管理员先"布置"一次分析 (arm)，下一次排课或 Excel 导出在 cProfile 或采样分析器下执行，
+# 结果文件写到 PROFILE_DIR，可通过接口下载。没有布置时入口只做一次字典判空，不产生额外开销。
+# 结果元数据也写在磁盘上，后台排课子进程写出的结果 Web 进程同样能列出和下载。
+# PROFILE_DIR 必须是只有当前用户可访问的私有目录 (见 private_storage)；数据文件名总是由结果 ID 和分析方式
+# 重新拼出，不信任元数据里的路径。
+import collections
+import cProfile
+import functools
+import io
+import json
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import uuid
+
+import private_storage
+
+PROFILE_DIR = os.getenv("SCHEDULING_PROFILE_DIR") or private_storage.default_directory("profiles")
+PROFILE_TARGETS = ("scheduling", "export")
+PROFILE_MODES = ("cprofile", "sampling")
+DEFAULT_SAMPLE_INTERVAL = 0.005  # 秒
+MAX_PROFILES = 50  # 超出后删除最早的结果
+DATA_FILE_SUFFIXES = {"cprofile": ".prof", "sampling": ".folded"}
+_PROFILE_ID_RE = re.compile(r"[0-9a-f]{32}")  # uuid4().hex
+
+logger = logging.getLogger("profiling")
+
+_armed = {}  # target -> 布置的分析请求 (dict)
+_armed_lock = threading.Lock()
+
+
+def arm(target, mode="cprofile", interval=DEFAULT_SAMPLE_INTERVAL, armed_by=None):
+    """布置对下一次 target ('scheduling' 或 'export') 的分析，返回分析请求。重复布置会覆盖之前未使用的请求。"""
+    if target not in PROFILE_TARGETS:
+        raise ValueError(f"不支持的分析对象: {target}，可选值: {', '.join(PROFILE_TARGETS)}")
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"不支持的分析方式: {mode}，可选值: {', '.join(PROFILE_MODES)}")
+    interval = float(interval)
+    if not 0.0005 <= interval <= 1:
+        raise ValueError("采样间隔必须在 0.0005 到 1 秒之间")
+    request = {"id": uuid.uuid4().hex, "target": target, "mode": mode, "interval": interval,
+               "armed_by": armed_by, "armed_at": time.time()}
+    with _armed_lock:
+        _armed[target] = request
+    return request
+
+
+def disarm(target):
+    """取消布置，返回被取消的请求 (没有时为 None)。"""
+    with _armed_lock:
+        return _armed.pop(target, None)
+
+
+def armed_requests():
+    with _armed_lock:
+        return dict(_armed)
+
+
+def take(target):
+    """取走 target 的分析请求 (只生效一次)。没有布置时直接返回 None，不加锁。"""
+    if not _armed:
+        return None
+    with _armed_lock:
+        return _armed.pop(target, None)
+
+
+def profiled(target, label):
+    """
+    装饰器: 布置了 target 的分析时，被装饰函数的下一次调用在分析器下执行。
+    label(*args, **kwargs) 生成结果的说明文字。
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _armed:
+                return fn(*args, **kwargs)
+            request = take(target)
+            if request is None:
+                return fn(*args, **kwargs)
+            return run_profiled(request, label(*args, **kwargs), fn, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def run_profiled(request, label, fn, *args, **kwargs):
+    """按 request 在当前线程中分析执行 fn(*args, **kwargs)，写出结果后返回 fn 的返回值。"""
+    if request["mode"] == "sampling":
+        profiler = StackSampler(threading.get_ident(), request.get("interval", DEFAULT_SAMPLE_INTERVAL))
+    else:
+        profiler = cProfile.Profile()
+    started_at = time.time()
+    started = time.perf_counter()
+    error = None
+    profiler.enable()
+    try:
+        return fn(*args, **kwargs)
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        profiler.disable()
+        try:
+            _write_result(request, label, profiler, started_at, time.perf_counter() - started, error)
+        except Exception as write_e:
+            # 分析结果写不出来不影响被分析的请求本身
+            logger.warning("写入分析结果失败: %s", write_e, extra={"event": "profiling.write_failed"})
+
+
+class StackSampler:
+    """
+    采样分析器: 后台线程每隔 interval 秒读取目标线程的调用栈，按折叠栈 (collapsed stack) 计数，
+    输出格式可直接交给 flamegraph.pl / speedscope 生成火焰图。
+    """
+
+    def __init__(self, thread_id, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def enable(self):
+        self._thread = threading.Thread(target=self._run, name="profiling-sampler", daemon=True)
+        self._thread.start()
+
+    def disable(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(names))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def is_profile_id(value):
+    return isinstance(value, str) and _PROFILE_ID_RE.fullmatch(value) is not None
+
+
+def data_file_name(profile_id, mode):
+    """由结果 ID 和分析方式得到数据文件名 (不含目录)；ID 或方式不合法时返回 None。"""
+    if not is_profile_id(profile_id) or mode not in DATA_FILE_SUFFIXES:
+        return None
+    return profile_id + DATA_FILE_SUFFIXES[mode]
+
+
+def _write_result(request, label, profiler, started_at, duration, error):
+    private_storage.ensure_private_directory(PROFILE_DIR)
+    profile_id = request["id"]
+    if isinstance(profiler, StackSampler):
+        data_file = data_file_name(profile_id, "sampling")
+        with open(os.path.join(PROFILE_DIR, data_file), "w", encoding="utf-8") as f:
+            f.write(profiler.collapsed())
+        extra = {"samples": profiler.samples}
+    else:
+        data_file = data_file_name(profile_id, "cprofile")
+        profiler.dump_stats(os.path.join(PROFILE_DIR, data_file))
+        extra = {"total_calls": pstats.Stats(profiler).total_calls}
+    meta = dict(request, label=label, data_file=data_file, started_at=started_at,
+                duration_seconds=round(duration, 6), error=error, pid=os.getpid(), **extra)
+    # 先写临时文件再改名，列表接口不会读到写了一半的元数据
+    tmp_path = os.path.join(PROFILE_DIR, f".{profile_id}.json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(PROFILE_DIR, f"{profile_id}.json"))
+    logger.info("%s 的分析结果已写入 %s (耗时 %.3f 秒)", label, data_file, duration,
+                extra={"event": "profiling.result_written", "profile_id": profile_id,
+                       "duration_ms": round(duration * 1000, 1)})
+    _prune_results()
+
+
+def _profile_dir():
+    """PROFILE_DIR 不存在时返回 None；存在但不安全 (见 private_storage) 时抛出 PermissionError。"""
+    if not os.path.isdir(PROFILE_DIR):
+        return None
+    return private_storage.ensure_private_directory(PROFILE_DIR)
+
+
+def _read_meta(profile_dir, profile_id):
+    """读取一个结果的元数据；id/mode 与文件名不符时返回 None。data_file 按 ID 重新生成。"""
+    try:
+        with open(os.path.join(profile_dir, f"{profile_id}.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None  # 不存在或正在被清理
+    if not isinstance(meta, dict) or meta.get("id") != profile_id:
+        return None
+    data_file = data_file_name(profile_id, meta.get("mode"))
+    if data_file is None:
+        return None
+    meta["data_file"] = data_file
+    return meta
+
+
+def list_results():
+    """按时间倒序返回已完成的分析结果元数据。"""
+    profile_dir = _profile_dir()
+    if profile_dir is None:
+        return []
+    results = []
+    for name in os.listdir(profile_dir):
+        profile_id, ext = os.path.splitext(name)
+        if ext != ".json" or not is_profile_id(profile_id):
+            continue
+        meta = _read_meta(profile_dir, profile_id)
+        if meta is not None:
+            results.append(meta)
+    results.sort(key=lambda meta: meta.get("started_at") if isinstance(meta.get("started_at"), (int, float)) else 0,
+                 reverse=True)
+    return results
+
+
+def get_result(profile_id):
+    """返回 (元数据, 数据文件路径)，不存在时返回 (None, None)。"""
+    if not is_profile_id(profile_id):
+        return None, None
+    profile_dir = _profile_dir()
+    if profile_dir is None:
+        return None, None
+    meta = _read_meta(profile_dir, profile_id)
+    if meta is None:
+        return None, None
+    return meta, os.path.join(profile_dir, meta["data_file"])
+
+
+def format_stats_text(path, sort="cumulative", limit=50):
+    """把 cProfile 结果文件转成 pstats 文本报表。"""
+    stream = io.StringIO()
+    pstats.Stats(path, stream=stream).sort_stats(sort).print_stats(limit)
+    return stream.getvalue()
+
+
+def _prune_results():
+    results = list_results()
+    for meta in results[MAX_PROFILES:]:
+        for name in (f"{meta['id']}.json", meta["data_file"]):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, name))
+            except OSError:
+                pass
@@ -0,0 +1,333 @@
+# replay_corpus.py
+# -*- coding: utf-8 -*-
+# 回放语料: 把一个真实学期的排课输入 (基础数据 + 固定条目) 和随机种子保存成匿名化的回放文件，
+# 之后对语料目录中的所有回放文件重新排课，与保存的基线比较运行时间、峰值内存、排入课时、
+# 未完成任务和硬约束违规数，任何指标超出阈值就报 REGRESSION 并以非零状态退出。
+#
+# 示例:
+#   python replay_corpus.py capture --semester 1 --seed 42 --output replay_corpus/2025_fall.json   # 从数据库采集
+#   python replay_corpus.py synthesize --majors 50 --seed 1 --output replay_corpus/synthetic_50.json
+#   python replay_corpus.py run --corpus replay_corpus --update-baselines   # 记录/刷新基线
+#   python replay_corpus.py run --corpus replay_corpus                      # 回归检查
+# 仓库自带的语料在 backend/replay_corpus/ (run 的默认目录)。运行时间只和同一台机器、同一 Python 版本
+# 记录的基线比较；基线来自其它环境时只给出提示，换机器后先 --update-baselines 记录本机基线。
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import psycopg2
+
+import scheduler_module
+import synthetic_data
+from scheduler_benchmark import quiet
+from scheduler_cli import default_db_params
+
+REPLAY_FORMAT = 'course-scheduling-replay'
+REPLAY_VERSION = 1
+BASELINE_FILE = 'baselines.json'
+DEFAULT_CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'replay_corpus')
+
+# 回归阈值: 时间/内存按相对增幅 (同时要求绝对增量超过 *_slack，避免小样本的计时噪声)，
+# 排入课时按相对降幅，未完成任务和硬约束违规只要变多就算回归
+DEFAULT_THRESHOLDS = {
+    "runtime": 0.25,
+    "runtime_slack_seconds": 0.05,
+    "memory": 0.25,
+    "memory_slack_mb": 1.0,
+    "placed_sessions": 0.0,
+    "uncompleted_tasks": 0,
+    "hard_violations": 0,
+}
+
+
+# ==================================
+# 采集 (匿名化)
+# ==================================
+def anonymize_data(all_data, semester_id, pinned_entries=()):
+    """
+    只保留目标学期用到的记录，并把人名/专业名/课程名/教室名换成编号。ID 保持不变；
+    专业按原名称的顺序重新命名，排课顺序 (sort_major_ids 按名称) 与原数据一致。
+    """
+    assignments = {aid: a for aid, a in all_data['course_assignments'].items() if a.semester_id == semester_id}
+    course_ids = {a.course_id for a in assignments.values()} | {e.course_id for e in pinned_entries}
+    teacher_ids = {a.teacher_id for a in assignments.values()} | {e.teacher_id for e in pinned_entries}
+    major_ids = {a.major_id for a in assignments.values()} | {e.major_id for e in pinned_entries}
+    semester = all_data['semesters'][semester_id]
+
+    ordered_majors = scheduler_module.sort_major_ids([mid for mid in major_ids if mid in all_data['majors']],
+                                                     all_data)
+    majors = {mid: scheduler_module.Major(id=mid, name=f"专业{rank:04d}")
+              for rank, mid in enumerate(ordered_majors, start=1)}
+    buildings = {}
+    for building in sorted({b or '' for b in all_data.get('classroom_buildings', {}).values()}):
+        buildings[building] = f"楼{len(buildings) + 1}"
+    classroom_buildings = {cid: buildings[building or '']
+                           for cid, building in all_data.get('classroom_buildings', {}).items()}
+    return {
+        'semesters': {semester_id: semester._replace(name=f"学期{semester_id}")},
+        'majors': majors,
+        'teachers': {tid: scheduler_module.Teacher(id=tid, user_id=tid, name=f"教师{tid}")
+                     for tid in sorted(teacher_ids) if tid in all_data['teachers']},
+        'classrooms': {cid: c._replace(name=f"{classroom_buildings.get(cid, '楼?')}-{cid}")
+                       for cid, c in all_data['classrooms'].items()},
+        'classroom_buildings': classroom_buildings,
+        'courses': {cid: c._replace(name=f"课程{cid}")
+                    for cid, c in all_data['courses'].items() if cid in course_ids},
+        'timeslots': dict(all_data['timeslots']),
+        'timeslot_lookup': dict(all_data['timeslot_lookup']),
+        'course_assignments': assignments,
+        'approved_avoid_preferences': {p for p in all_data.get('approved_avoid_preferences', set())
+                                       if p[2] == semester_id and p[0] in teacher_ids},
+    }
+
+
+def build_replay(all_data, semester_id, seed, pinned_entries=(), source=None, anonymize=True):
+    """生成回放文件内容 (dict)。"""
+    if semester_id not in all_data['semesters']:
+        raise ValueError(f"未找到 ID 为 {semester_id} 的学期信息。")
+    pinned_entries = [e for e in pinned_entries if e.semester_id == semester_id]
+    if anonymize:
+        all_data = anonymize_data(all_data, semester_id, pinned_entries)
+    return {
+        'format': REPLAY_FORMAT,
+        'version': REPLAY_VERSION,
+        'semester_id': semester_id,
+        'seed': seed,
+        'source': source,
+        'anonymized': anonymize,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'tables': scheduler_module.data_to_snapshot_tables(all_data, pinned_entries),
+    }
+
+
+def save_replay(path, replay):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(replay, f, ensure_ascii=False, default=str)
+
+
+def load_replay(path):
+    """读取回放文件，返回 (回放元数据, all_data, 固定条目)。"""
+    with open(path, encoding='utf-8') as f:
+        replay = json.load(f)
+    if replay.get('format') != REPLAY_FORMAT:
+        raise ValueError(f"{path} 不是排课回放文件")
+    if replay.get('version', 0) > REPLAY_VERSION:
+        raise ValueError(f"{path} 的版本 {replay.get('version')} 高于当前支持的版本 {REPLAY_VERSION}")
+    all_data, pinned_entries = scheduler_module.data_from_snapshot_tables(replay['tables'])
+    return replay, all_data, pinned_entries
+
+
+# ==================================
+# 回放与比较
+# ==================================
+def replay_metrics(path, repeat=1, memory=True):
+    """重新排一次回放文件中的学期，返回各项指标。运行时间取 repeat 次中最快的一次。"""
+    replay, all_data, pinned_entries = load_replay(path)
+    semester_id, seed = replay['semester_id'], replay['seed']
+    best_wall = None
+    for _ in range(max(1, repeat)):
+        started = time.perf_counter()
+        with quiet():
+            summary, frame = scheduler_module.schedule_semester_in_memory(
+                all_data, semester_id, pinned_entries=pinned_entries, seed=seed)
+        elapsed = time.perf_counter() - started
+        best_wall = elapsed if best_wall is None else min(best_wall, elapsed)
+    quality = scheduler_module.validate_schedule(all_data, semester_id, frame)
+    metrics = {
+        "runtime_seconds": round(best_wall, 4),
+        "placed_sessions": quality["placed_sessions"],
+        "required_sessions": quality["required_sessions"],
+        "uncompleted_tasks": summary["total_uncompleted_tasks"],
+        "conflicts": summary["total_conflicts"],
+        "hard_violations": quality["hard_violations"],
+    }
+    if memory:
+        tracemalloc.start()
+        try:
+            with quiet():
+                scheduler_module.schedule_semester_in_memory(all_data, semester_id, pinned_entries=pinned_entries,
+                                                             seed=seed)
+            metrics["peak_memory_mb"] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+        finally:
+            tracemalloc.stop()
+    return metrics
+
+
+def compare_metrics(current, baseline, thresholds=None, compare_runtime=True):
+    """返回回归说明列表 (为空表示没有回归)。compare_runtime=False 时不比较运行时间 (基线来自其它机器)。"""
+    t = dict(DEFAULT_THRESHOLDS, **(thresholds or {}))
+    regressions = []
+    base_runtime = baseline.get("runtime_seconds")
+    if base_runtime is not None and compare_runtime:
+        limit = max(base_runtime * (1 + t["runtime"]), base_runtime + t["runtime_slack_seconds"])
+        if current["runtime_seconds"] > limit:
+            regressions.append(f"运行时间 {current['runtime_seconds']:.3f}s > 基线 {base_runtime:.3f}s "
+                               f"(上限 {limit:.3f}s)")
+    base_memory = baseline.get("peak_memory_mb")
+    if base_memory is not None and current.get("peak_memory_mb") is not None:
+        limit = max(base_memory * (1 + t["memory"]), base_memory + t["memory_slack_mb"])
+        if current["peak_memory_mb"] > limit:
+            regressions.append(f"峰值内存 {current['peak_memory_mb']:.1f}MB > 基线 {base_memory:.1f}MB "
+                               f"(上限 {limit:.1f}MB)")
+    base_placed = baseline.get("placed_sessions")
+    if base_placed is not None and current["placed_sessions"] < base_placed * (1 - t["placed_sessions"]):
+        regressions.append(f"排入课时 {current['placed_sessions']} < 基线 {base_placed}")
+    for key, label in (("uncompleted_tasks", "未完成任务"), ("hard_violations", "硬约束违规")):
+        base_value = baseline.get(key)
+        if base_value is not None and current[key] > base_value + t[key]:
+            regressions.append(f"{label} {current[key]} > 基线 {base_value}")
+    return regressions
+
+
+def runtime_environment():
+    """记录基线的运行环境: 运行时间只在同一环境下可比。"""
+    return {"host": platform.node(), "machine": platform.machine(), "python": platform.python_version()}
+
+
+def load_baselines(corpus_dir):
+    """返回 (各回放文件的基线, 记录基线时的运行环境)。"""
+    path = os.path.join(corpus_dir, BASELINE_FILE)
+    if not os.path.exists(path):
+        return {}, None
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    environment = {key: data.get(key) for key in ("host", "machine", "python")}
+    return data.get("replays", {}), environment
+
+
+def save_baselines(corpus_dir, baselines):
+    with open(os.path.join(corpus_dir, BASELINE_FILE), 'w', encoding='utf-8') as f:
+        json.dump(dict(runtime_environment(), updated_at=time.strftime('%Y-%m-%dT%H:%M:%S'), replays=baselines),
+                  f, ensure_ascii=False, indent=2, sort_keys=True)
+
+
+def list_replays(corpus_dir):
+    return sorted(name for name in os.listdir(corpus_dir)
+                  if name.endswith('.json') and name != BASELINE_FILE)
+
+
+def run_corpus(corpus_dir, repeat=1, memory=True, update_baselines=False, thresholds=None):
+    """
+    回放语料目录中的所有文件。返回 (结果列表, 是否有回归)。
+    update_baselines=True 时用本次结果覆盖基线 (不做比较)；没有基线的文件只记录不比较。
+    基线的运行环境与本机不同时跳过运行时间比较，并在结果的 warnings 中说明。
+    """
+    baselines, baseline_environment = load_baselines(corpus_dir)
+    same_environment = baseline_environment == runtime_environment()
+    results = []
+    regressed = False
+    for name in list_replays(corpus_dir):
+        metrics = replay_metrics(os.path.join(corpus_dir, name), repeat=repeat, memory=memory)
+        baseline = baselines.get(name)
+        regressions, warnings = [], []
+        if not update_baselines and baseline is not None:
+            regressions = compare_metrics(metrics, baseline, thresholds, compare_runtime=same_environment)
+            if not same_environment:
+                warnings.append(f"基线记录于 {_format_environment(baseline_environment)}，"
+                                f"本机为 {_format_environment(runtime_environment())}，跳过运行时间比较")
+        regressed = regressed or bool(regressions)
+        results.append({"replay": name, "metrics": metrics, "baseline": baseline, "regressions": regressions,
+                        "warnings": warnings})
+        if update_baselines or baseline is None:
+            baselines[name] = metrics
+    if update_baselines or any(r["baseline"] is None for r in results):
+        save_baselines(corpus_dir, baselines)
+    return results, regressed
+
+
+def _format_environment(environment):
+    environment = environment or {}
+    return (f"{environment.get('host') or '?'} ({environment.get('machine') or '?'}, "
+            f"Python {environment.get('python') or '?'})")
+
+
+def format_results(results):
+    lines = []
+    for result in results:
+        m = result["metrics"]
+        status = ("REGRESSION" if result["regressions"] else
+                  "NEW BASELINE" if result["baseline"] is None else "ok")
+        lines.append(f"[{status}] {result['replay']}: {m['runtime_seconds']:.3f}s, "
+                     f"{m.get('peak_memory_mb', '-')}MB, 排入 {m['placed_sessions']}/{m['required_sessions']}, "
+                     f"未完成 {m['uncompleted_tasks']}, 违规 {m['hard_violations']}")
+        lines.extend(f"    !! {message}" for message in result["regressions"])
+        lines.extend(f"    ?? {message}" for message in result.get("warnings", []))
+    return "\n".join(lines)
+
+
+# ==================================
+# 命令行
+# ==================================
+def build_parser():
+    parser = argparse.ArgumentParser(description="排课回放语料: 采集匿名化回放文件，回放并与基线比较")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    capture = commands.add_parser('capture', help="从数据库采集一个学期的回放文件")
+    capture.add_argument('--semester', '-s', type=int, required=True)
+    capture.add_argument('--seed', type=int, required=True)
+    capture.add_argument('--dsn', help="PostgreSQL 连接串，默认读取 DB_* 环境变量")
+    capture.add_argument('--output', '-o', required=True)
+    capture.add_argument('--no-anonymize', dest='anonymize', action='store_false',
+                         help="保留原始名称 (只用于本地排查，不要提交到语料库)")
+
+    synthesize = commands.add_parser('synthesize', help="用合成数据生成回放文件")
+    synthesize.add_argument('--majors', type=int, default=20)
+    synthesize.add_argument('--seed', type=int, default=0)
+    synthesize.add_argument('--output', '-o', required=True)
+
+    run = commands.add_parser('run', help="回放语料目录并与基线比较，有回归时退出码为 1")
+    run.add_argument('--corpus', default=os.getenv('SCHEDULING_REPLAY_CORPUS', DEFAULT_CORPUS_DIR))
+    run.add_argument('--repeat', type=int, default=3, help="每个文件重复次数，运行时间取最快一次")
+    run.add_argument('--no-memory', dest='memory', action='store_false', help="不测峰值内存")
+    run.add_argument('--update-baselines', action='store_true', help="用本次结果覆盖基线")
+    run.add_argument('--runtime-threshold', type=float, default=DEFAULT_THRESHOLDS["runtime"],
+                     help="运行时间允许的相对增幅 (默认 %(default)s)")
+    run.add_argument('--memory-threshold', type=float, default=DEFAULT_THRESHOLDS["memory"],
+                     help="峰值内存允许的相对增幅 (默认 %(default)s)")
+    run.add_argument('--json', metavar='PATH', help="把结果写成 JSON")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == 'capture':
+        db_params = default_db_params(args.dsn)
+        get_connection = lambda: psycopg2.connect(**db_params)
+        with quiet():
+            all_data = scheduler_module.load_data_from_db(get_connection)
+            pinned_entries = scheduler_module.load_pinned_entries(get_connection, args.semester)
+        save_replay(args.output, build_replay(all_data, args.semester, args.seed, pinned_entries,
+                                              source=f"semester {args.semester}", anonymize=args.anonymize))
+        print(f"REPLAY: 已写入 {args.output}", file=sys.stderr)
+        return 0
+    if args.command == 'synthesize':
+        all_data = synthetic_data.generate_university(args.majors, seed=args.seed)
+        save_replay(args.output, build_replay(all_data, min(all_data['semesters']), args.seed,
+                                              source=f"synthetic majors={args.majors}", anonymize=False))
+        print(f"REPLAY: 已写入 {args.output}", file=sys.stderr)
+        return 0
+
+    if not os.path.isdir(args.corpus):
+        print(f"REPLAY: 语料目录 {args.corpus} 不存在", file=sys.stderr)
+        return 2
+    results, regressed = run_corpus(args.corpus, repeat=args.repeat, memory=args.memory,
+                                    update_baselines=args.update_baselines,
+                                    thresholds={"runtime": args.runtime_threshold, "memory": args.memory_threshold})
+    print(format_results(results))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if regressed:
+        print(f"REPLAY: REGRESSION — {sum(1 for r in results if r['regressions'])} 个回放文件的指标超出基线阈值",
+              file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
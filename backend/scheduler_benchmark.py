@@ -0,0 +1,209 @@
+# scheduler_benchmark.py
+# -*- coding: utf-8 -*-
+# 排课基准测试: 用 synthetic_data 生成不同规模的数据，在内存中 (不连数据库) 分别测量
+#   template     generate_initial_template (所有专业)
+#   solve_major  schedule_with_generated_template (单个专业，空占用状态，抽样 --sample-majors 个专业)
+#   pipeline     完整流程: 快照表 -> all_data (代替 load_data_from_db) -> schedule_semester_in_memory
+# 报告墙钟/CPU 时间 (重复 --repeat 次取最快)、峰值内存 (tracemalloc 单独跑一次) 和排课质量。
+#
+# 示例:
+#   python scheduler_benchmark.py --sizes 5,20,50 --seed 1
+#   python scheduler_benchmark.py --sizes 100,200,500 --repeat 1 --no-memory --json bench.json
+import argparse
+import contextlib
+import json
+import logging
+import random
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+
+import scheduler_module
+import synthetic_data
+
+DEFAULT_SIZES = (5, 20, 50, 100, 200, 500)
+BENCHMARKS = ('template', 'solve_major', 'pipeline')
+
+
+def log(message):
+    print(f"BENCHMARK: {message}", file=sys.stderr)
+
+
+@contextlib.contextmanager
+def quiet(loggers=("scheduler",), level=logging.WARNING):
+    """
+    临时把排课日志 (logger "scheduler") 提到 WARNING，屏蔽逐专业的 INFO 事件，避免日志输出影响计时。
+    退出时恢复原来的级别。要看完整日志时不用 quiet，直接设置 LOG_LEVEL。
+    """
+    previous = {name: logging.getLogger(name).level for name in loggers}
+    for name in loggers:
+        logging.getLogger(name).setLevel(level)
+    try:
+        yield
+    finally:
+        for name, old_level in previous.items():
+            logging.getLogger(name).setLevel(old_level)
+
+
+def assignments_by_major(all_data, semester_id):
+    grouped = defaultdict(dict)
+    for assign_id, assign in all_data['course_assignments'].items():
+        if assign.semester_id == semester_id:
+            grouped[assign.major_id][assign_id] = assign
+    return grouped
+
+
+def empty_timetable_state():
+    return {'teacher_schedule': set(), 'classroom_schedule': set(), 'major_schedule': set()}
+
+
+# --- 被测函数: 每个返回一个可重复调用的无参函数 ---
+def bench_template(all_data, semester_id, options):
+    grouped = assignments_by_major(all_data, semester_id)
+
+    def run():
+        for major_assignments in grouped.values():
+            scheduler_module.generate_initial_template(major_assignments, all_data, rng=random.Random(options.seed))
+        return {"majors": len(grouped)}
+    return run
+
+
+def bench_solve_major(all_data, semester_id, options):
+    grouped = assignments_by_major(all_data, semester_id)
+    semester = all_data['semesters'][semester_id]
+    sample = sorted(grouped)[:options.sample_majors]
+    templates = {mid: scheduler_module.generate_initial_template(grouped[mid], all_data, rng=random.Random(options.seed))
+                 for mid in sample}
+
+    def run():
+        rng = random.Random(options.seed)
+        placed = 0
+        for mid in sample:
+            template_dp, pool = templates[mid]
+            result = scheduler_module.schedule_with_generated_template(
+                grouped[mid], semester, all_data['majors'][mid], all_data, template_dp, pool,
+                empty_timetable_state(), rng=rng)
+            placed += len(result['schedule'])
+        return {"majors": len(sample), "placed": placed}
+    return run
+
+
+def bench_pipeline(all_data, semester_id, options):
+    tables = scheduler_module.data_to_snapshot_tables(all_data)
+
+    def run():
+        loaded_data, pinned_entries = scheduler_module.data_from_snapshot_tables(tables)
+        summary, frame = scheduler_module.schedule_semester_in_memory(
+            loaded_data, semester_id, pinned_entries=pinned_entries, seed=options.seed)
+        return {"summary": summary, "frame": frame}
+    return run
+
+
+BENCH_FACTORIES = {'template': bench_template, 'solve_major': bench_solve_major, 'pipeline': bench_pipeline}
+
+
+def measure(run, repeat, memory):
+    """返回 (最后一次的结果, 计时字典)。计时取 repeat 次中最快的一次；memory=True 时再跑一次测峰值内存。"""
+    best_wall = best_cpu = None
+    result = None
+    for _ in range(repeat):
+        started_wall, started_cpu = time.perf_counter(), time.process_time()
+        with quiet():
+            result = run()
+        wall, cpu = time.perf_counter() - started_wall, time.process_time() - started_cpu
+        if best_wall is None or wall < best_wall:
+            best_wall, best_cpu = wall, cpu
+    timing = {"wall_seconds": round(best_wall, 4), "cpu_seconds": round(best_cpu, 4)}
+    if memory:
+        tracemalloc.start()
+        try:
+            with quiet():
+                run()
+            timing["peak_memory_mb"] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+        finally:
+            tracemalloc.stop()
+    return result, timing
+
+
+def schedule_quality(all_data, semester_id, summary, frame):
+    """排课质量: validate_schedule 的结果加上摘要中的冲突数和未完成任务数。"""
+    quality = scheduler_module.validate_schedule(all_data, semester_id, frame)
+    quality["conflicts"] = summary.get("total_conflicts", 0)
+    quality["uncompleted_tasks"] = summary.get("total_uncompleted_tasks", 0)
+    return quality
+
+
+def run_size(n_majors, options):
+    """生成 n_majors 个专业的数据并跑所选的基准，返回该规模的结果字典。"""
+    started = time.perf_counter()
+    all_data = synthetic_data.generate_university(n_majors, seed=options.seed,
+                                                  courses_per_major=options.courses_per_major)
+    result = {"majors": n_majors, "dataset": synthetic_data.describe(all_data),
+              "generate_seconds": round(time.perf_counter() - started, 4), "benchmarks": {}}
+    semester_id = min(all_data['semesters'])
+    for name in options.benchmarks:
+        run = BENCH_FACTORIES[name](all_data, semester_id, options)
+        output, timing = measure(run, options.repeat, options.memory)
+        if name == 'pipeline':
+            timing["quality"] = schedule_quality(all_data, semester_id, output["summary"], output["frame"])
+            timing["stats"] = output["summary"].get("stats")
+        else:
+            timing.update(output)
+        result["benchmarks"][name] = timing
+        log(f"{n_majors} 个专业 {name}: {timing['wall_seconds']:.3f}s")
+    return result
+
+
+def format_report(results):
+    lines = [f"{'majors':>7} {'benchmark':<12}{'wall(s)':>10}{'cpu(s)':>10}{'peak(MB)':>10}"
+             f"{'placed':>9}{'conflicts':>10}{'violations':>11}"]
+    for result in results:
+        for name, timing in result["benchmarks"].items():
+            quality = timing.get("quality")
+            if quality:
+                quality_cols = (f"{quality['placement_rate']:>9.1%}{quality['conflicts']:>10}"
+                                f"{quality['hard_violations']:>11}")
+            else:
+                quality_cols = f"{'':>9}{'':>10}{'':>11}"
+            peak = timing.get("peak_memory_mb")
+            lines.append(f"{result['majors']:>7} {name:<12}{timing['wall_seconds']:>10.3f}"
+                         f"{timing['cpu_seconds']:>10.3f}{(f'{peak:.1f}' if peak is not None else '-'):>10}"
+                         + quality_cols)
+    return "\n".join(lines)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="排课基准测试 (合成数据，内存中运行，不连数据库)")
+    parser.add_argument('--sizes', default=",".join(map(str, DEFAULT_SIZES)),
+                        help="逗号分隔的专业数列表 (默认 %(default)s)")
+    parser.add_argument('--bench', dest='benchmarks', action='append', choices=BENCHMARKS,
+                        help="只跑指定的基准，可重复 (默认全部)")
+    parser.add_argument('--seed', type=int, default=0, help="数据生成和排课的随机种子")
+    parser.add_argument('--repeat', type=int, default=3, help="每个基准重复次数，取最快一次")
+    parser.add_argument('--courses-per-major', type=int, default=8)
+    parser.add_argument('--sample-majors', type=int, default=20, help="solve_major 抽样的专业数")
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help="不测峰值内存 (省一次运行)")
+    parser.add_argument('--json', metavar='PATH', help="把完整结果写成 JSON")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    except ValueError:
+        build_parser().error("--sizes 必须是逗号分隔的整数")
+    args.benchmarks = args.benchmarks or list(BENCHMARKS)
+    args.repeat = max(1, args.repeat)
+    results = [run_size(n_majors, args) for n_majors in sizes]
+    print(format_report(results))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"seed": args.seed, "repeat": args.repeat, "results": results}, f, ensure_ascii=False, indent=2)
+        log(f"结果已写入 {args.json}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
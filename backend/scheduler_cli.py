@@ -0,0 +1,355 @@
+# scheduler_cli.py
+# -*- coding: utf-8 -*-
+# 排课命令行入口: 不经过 Flask，在批处理机器上直接运行 scheduler_module。
+#
+# 输入: 数据库 (--dsn 或与后端相同的 DB_* 环境变量) 或数据快照 (--snapshot，JSON 文件或 Parquet 目录)。
+# 输出: 文件 (--output，.json/.csv/.parquet/.xlsx) 和/或数据库 (--write-db)。
+#
+# 示例:
+#   python scheduler_cli.py --semester 1 --dump-snapshot sem1.json          # 从数据库导出快照
+#   python scheduler_cli.py --snapshot sem1.json --semester 1 --seed 42 --output out.json --profile
+#   python scheduler_cli.py --semester 1 --semester 2 --write-db --workers 2  # 与 /api/schedule/batch 相同
+import argparse
+import cProfile
+import concurrent.futures
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import pstats
+import sys
+import threading
+import time
+
+import pandas as pd
+import psycopg2
+
+import scheduler_module
+import structured_logging
+
+STRATEGIES = ('template',)  # 目前只有固定周模板策略 (第 1 周排模板，后续各周复制)
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_BUDGET = 3  # 时间预算用完 (结果不完整或已取消) 或超出内存预算而中止
+
+
+def log(message):
+    print(f"SCHEDULER_CLI: {message}", file=sys.stderr)
+
+
+@contextlib.contextmanager
+def stdout_to_stderr():
+    """
+    运行期间把标准输出 (文件描述符 1) 指向 stderr: 其他模块直接 print 的输出 (包括 spawn 出的工作进程)
+    都写到 stderr，stdout 只留给最后的 JSON 报告，便于脚本解析。
+    """
+    sys.stdout.flush()
+    saved_fd = os.dup(1)
+    os.dup2(2, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved_fd, 1)
+        os.close(saved_fd)
+
+
+def default_db_params(dsn=None):
+    """--dsn 优先，否则与 app.py 一样读取 DB_* 环境变量。"""
+    if dsn:
+        return {'dsn': dsn}
+    return dict(host=os.getenv("DB_HOST", "localhost"), database=os.getenv("DB_NAME", "postgres"),
+                user=os.getenv("DB_USER", "postgres"), password=os.getenv("DB_PASSWORD", "031104"))
+
+
+class PhaseTimer:
+    """记录各阶段的墙钟时间和 CPU 时间，--profile 时输出。"""
+
+    def __init__(self):
+        self.phases = []
+        self._open = {}
+
+    def start(self, name):
+        self._open[name] = (time.perf_counter(), time.process_time())
+
+    def stop(self, name, **extra):
+        wall_started, cpu_started = self._open.pop(name)
+        self.phases.append(dict(phase=name, wall_seconds=round(time.perf_counter() - wall_started, 4),
+                                cpu_seconds=round(time.process_time() - cpu_started, 4), **extra))
+
+    def on_progress(self, event):
+        """run_full_scheduling_process 的进度回调: 把 phase 事件的开始/结束记成阶段耗时。"""
+        if event.get('type') != 'phase':
+            return
+        name = f"run.{event.get('phase')}"
+        if event.get('status') == 'started':
+            self.start(name)
+        elif event.get('status') == 'finished' and name in self._open:
+            self.stop(name)
+
+    def report(self):
+        lines = [f"{'phase':<24}{'wall(s)':>12}{'cpu(s)':>12}"]
+        for phase in self.phases:
+            lines.append(f"{phase['phase']:<24}{phase['wall_seconds']:>12.4f}{phase['cpu_seconds']:>12.4f}")
+        return "\n".join(lines)
+
+
+# --- 输入 ---
+def load_inputs(args, db_params, semester_ids):
+    """返回 (all_data, {学期 ID: 固定条目列表})。"""
+    if args.snapshot:
+        all_data, pinned_entries = scheduler_module.load_data_snapshot(args.snapshot)
+        pinned_by_semester = {sid: [e for e in pinned_entries if e.semester_id == sid] for sid in semester_ids}
+        return all_data, pinned_by_semester
+    get_connection = lambda: psycopg2.connect(**db_params)
+    all_data = scheduler_module.load_data_from_db(get_connection)
+    pinned_by_semester = {sid: scheduler_module.load_pinned_entries(get_connection, sid) for sid in semester_ids}
+    return all_data, pinned_by_semester
+
+
+# --- 离线排课 (内存中) ---
+_offline_worker_data = {}
+
+def _init_offline_worker(all_data):
+    structured_logging.configure()
+    _offline_worker_data['all_data'] = all_data
+
+def _solve_offline(semester_id, pinned_entries, seed, time_budget, all_data=None):
+    all_data = all_data if all_data is not None else _offline_worker_data['all_data']
+    deadline = time.monotonic() + time_budget if time_budget else None
+    started_wall, started_cpu = time.perf_counter(), time.process_time()
+    summary, entries = scheduler_module.schedule_semester_in_memory(all_data, semester_id, pinned_entries,
+                                                                    seed=seed, deadline=deadline)
+    summary["timings"] = {"wall_seconds": round(time.perf_counter() - started_wall, 4),
+                          "cpu_seconds": round(time.process_time() - started_cpu, 4)}
+    return semester_id, scheduler_module.summary_without_conflicts(summary), entries
+
+def solve_offline(all_data, pinned_by_semester, semester_ids, seed, time_budget, workers):
+    """排多个学期；workers > 1 且学期多于一个时在多个进程中并行。返回 {学期 ID: (摘要, 条目)}。"""
+    results = {}
+    if workers <= 1 or len(semester_ids) <= 1:
+        for sid in semester_ids:
+            _, summary, entries = _solve_offline(sid, pinned_by_semester[sid], seed, time_budget, all_data)
+            results[sid] = (summary, entries)
+        return results
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(semester_ids)),
+                                                mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=_init_offline_worker, initargs=(all_data,)) as executor:
+        futures = [executor.submit(_solve_offline, sid, pinned_by_semester[sid], seed, time_budget)
+                   for sid in semester_ids]
+        for future in concurrent.futures.as_completed(futures):
+            sid, summary, entries = future.result()
+            results[sid] = (summary, entries)
+    return results
+
+
+# --- 输出 ---
+def write_output_file(path, results, all_data):
+    """按扩展名写出排课结果: .json (摘要 + 条目)、.csv / .parquet (条目表)、.xlsx (与网页导出相同的课表)。"""
+    rows = [dict(entry._asdict()) for summary, entries in results.values() for entry in entries]
+    if path.endswith('.json'):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'summaries': {sid: summary for sid, (summary, _) in results.items()}, 'entries': rows},
+                      f, ensure_ascii=False, default=str)
+    elif path.endswith('.csv'):
+        pd.DataFrame.from_records(rows, columns=scheduler_module.TimetableEntry._fields).to_csv(path, index=False)
+    elif path.endswith('.parquet'):
+        pd.DataFrame.from_records(rows, columns=scheduler_module.TimetableEntry._fields).to_parquet(path, index=False)
+    elif path.endswith('.xlsx'):
+        if len(results) != 1:
+            raise ValueError("导出 .xlsx 时只能指定一个学期")
+        (sid, (_, entries)), = results.items()
+        excel_buffer = scheduler_module.generate_excel_report_for_send_file(entries, all_data, all_data['semesters'][sid])
+        with open(path, 'wb') as f:
+            f.write(excel_buffer.getvalue())
+    else:
+        raise ValueError(f"不支持的输出格式: {path} (可用 .json/.csv/.parquet/.xlsx)")
+
+def offline_assignment_fingerprints(all_data, semester_id, summary):
+    """
+    离线排课所用输入的教学任务指纹 (与在线排课相同，见 compute_assignment_fingerprints)。
+    因时间预算没排的专业不计入，下次增量排课会把它们当作新任务重排。
+    """
+    skipped = set(summary.get('skipped_majors', ()))
+    return scheduler_module.compute_assignment_fingerprints(
+        {aid: a for aid, a in all_data['course_assignments'].items()
+         if a.semester_id == semester_id and a.major_id not in skipped}, all_data)
+
+def write_schedule_to_db(semester_id, entries, get_connection, assignment_fingerprints=None):
+    """
+    把离线排出的课表写入数据库: 与在线排课一样先写暂存表再原子替换 (固定条目保留)，并记录一个 'cli' 版本。
+    assignment_fingerprints (见 offline_assignment_fingerprints) 在同一事务内更新增量排课的教学任务快照。
+    返回 (清除条数, 写入条数)。同一学期正在排课时抛出 SemesterBusy。
+    """
+    lock_conn = scheduler_module.acquire_semester_lock(get_connection, semester_id)
+    if lock_conn is None:
+        raise scheduler_module.SemesterBusy(f"学期 {semester_id} 正在排课，请稍后再试")
+    staging_table = None
+    try:
+        staging_table = scheduler_module.create_staging_table(semester_id, get_connection)
+        scheduler_module.save_schedule_to_db(entries, get_connection, table_name=staging_table)
+        cleared_count, saved_count, _ = scheduler_module.swap_staging_into_place(
+            semester_id, staging_table, get_connection, assignment_fingerprints=assignment_fingerprints,
+            version_source='cli')
+        staging_table = None
+        return cleared_count, saved_count
+    finally:
+        if staging_table:
+            scheduler_module.drop_staging_table(staging_table, get_connection)
+        scheduler_module.release_semester_lock(lock_conn, semester_id)
+
+
+def run_in_db(args, db_params, semester_ids, timer):
+    """输入输出都是数据库时直接走完整的在线排课流程 (检查点、版本、固定条目等)。"""
+    get_connection = lambda: psycopg2.connect(**db_params)
+    options = dict(streaming=args.streaming, storage_mode=args.storage, incremental=args.incremental,
+                   resume=not args.no_resume, memory_budget_mb=args.memory_budget_mb,
+                   track_memory=args.track_memory)
+    if len(semester_ids) > 1:
+        summary = scheduler_module.run_batch_scheduling(semester_ids, db_params, max_workers=args.workers,
+                                                        seed=args.seed, time_budget=args.time_budget, **options)
+        return summary, {sid: s.get('status', '') for sid, s in summary['semesters'].items()}
+    cancel_event = threading.Event()
+    budget_timer = threading.Timer(args.time_budget, cancel_event.set) if args.time_budget else None
+    if budget_timer:
+        budget_timer.start()
+    try:
+        summary = scheduler_module.run_full_scheduling_process(semester_ids[0], get_connection,
+                                                               progress_callback=timer.on_progress,
+                                                               cancel_event=cancel_event, seed=args.seed,
+                                                               **options)
+    finally:
+        if budget_timer:
+            budget_timer.cancel()
+    summary = scheduler_module.summary_without_conflicts(summary)  # 报告中只保留冲突计数
+    return summary, {semester_ids[0]: summary.get('status', '')}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="离线运行排课 (不经过 Web 服务)。")
+    parser.add_argument('--semester', '-s', type=int, action='append', required=True, dest='semesters',
+                        help="要排课的学期 ID，可重复指定多个")
+    parser.add_argument('--dsn', help="PostgreSQL 连接串 (默认读取 DB_HOST/DB_NAME/DB_USER/DB_PASSWORD)")
+    parser.add_argument('--snapshot', help="从数据快照读取输入 (JSON 文件或 .parquet 目录)，此时只有 --write-db 才连接数据库")
+    parser.add_argument('--dump-snapshot', metavar='PATH',
+                        help="把输入数据 (含所选学期的固定条目) 写成快照 (.json 或 .parquet 目录)；不带输出参数时只导出快照")
+    parser.add_argument('--output', '-o', help="排课结果写到文件 (.json/.csv/.parquet/.xlsx)")
+    parser.add_argument('--write-db', action='store_true', help="排课结果写入数据库")
+    parser.add_argument('--seed', type=int, help="随机种子，相同输入和种子得到相同课表")
+    parser.add_argument('--strategy', choices=STRATEGIES, default='template', help="排课策略")
+    parser.add_argument('--workers', type=int, default=1, help="多个学期并行排课的进程数")
+    parser.add_argument('--time-budget', type=float, help="每个学期的排课时间上限 (秒)")
+    parser.add_argument('--storage', choices=('rows', 'series'), default='rows',
+                        help="写数据库时的存储方式 (仅数据库输入 + --write-db)")
+    parser.add_argument('--no-streaming', dest='streaming', action='store_false',
+                        help="排完后一次性写库 (仅数据库输入 + --write-db)")
+    parser.add_argument('--incremental', action='store_true', help="只重排有变化的专业 (仅数据库输入 + --write-db)")
+    parser.add_argument('--no-resume', action='store_true', help="忽略检查点，从头排课 (仅数据库输入 + --write-db)")
+    parser.add_argument('--memory-budget-mb', type=float,
+                        help="内存预算 (MB)，接近时改为流式写库或中止 (仅数据库输入 + --write-db)")
+    parser.add_argument('--track-memory', action='store_true',
+                        help="统计各阶段内存峰值和主要分配位置 (仅数据库输入 + --write-db)")
+    parser.add_argument('--profile', action='store_true', help="输出 cProfile 统计和各阶段耗时 (stderr)")
+    parser.add_argument('--profile-output', metavar='PATH', help="把 cProfile 原始数据写到文件 (可用 snakeviz 等查看)")
+    parser.add_argument('--profile-limit', type=int, default=30, help="cProfile 输出的函数条数")
+    return parser
+
+
+def run(args, db_params, semester_ids, timer, profiler, report):
+    """执行一次命令行排课，返回 (摘要, {学期 ID: 状态})。"""
+    if profiler:
+        profiler.enable()
+    try:
+        if args.write_db and not args.output and not args.snapshot and not args.dump_snapshot:
+            # 数据库进、数据库出: 走完整的在线排课流程
+            timer.start('run')
+            summary, statuses = run_in_db(args, db_params, semester_ids, timer)
+            timer.stop('run')
+            return summary, statuses
+
+        timer.start('load_data')
+        all_data, pinned_by_semester = load_inputs(args, db_params, semester_ids)
+        timer.stop('load_data')
+        if args.dump_snapshot:
+            timer.start('dump_snapshot')
+            scheduler_module.save_data_snapshot(
+                args.dump_snapshot, all_data, [e for sid in semester_ids for e in pinned_by_semester[sid]])
+            timer.stop('dump_snapshot')
+            log(f"快照已写入 {args.dump_snapshot}")
+        if not (args.output or args.write_db):
+            return None, {}
+
+        unknown = [sid for sid in semester_ids if sid not in all_data['semesters']]
+        if unknown:
+            raise ValueError(f"未找到学期: {unknown}")
+        timer.start('solve')
+        results = solve_offline(all_data, pinned_by_semester, semester_ids, args.seed, args.time_budget,
+                                args.workers)
+        timer.stop('solve', entries=sum(len(entries) for _, entries in results.values()))
+        statuses = {sid: 'budget_exhausted' if summary.get('budget_exhausted') else 'success'
+                    for sid, (summary, _) in results.items()}
+        if args.output:
+            timer.start('write_output')
+            write_output_file(args.output, results, all_data)
+            timer.stop('write_output')
+            log(f"排课结果已写入 {args.output}")
+        if args.write_db:
+            timer.start('write_db')
+            get_connection = lambda: psycopg2.connect(**db_params)
+            report['db_records'] = {
+                sid: write_schedule_to_db(sid, entries, get_connection,
+                                          assignment_fingerprints=offline_assignment_fingerprints(all_data, sid, summary))
+                for sid, (summary, entries) in results.items()}
+            timer.stop('write_db')
+        return {sid: summary for sid, (summary, _) in results.items()}, statuses
+    finally:
+        if profiler:
+            profiler.disable()
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    structured_logging.configure()  # 排课日志写 stderr (级别和格式见 LOG_LEVEL / LOG_FORMAT)
+    if not (args.output or args.write_db or args.dump_snapshot):
+        log("需要至少指定 --output、--write-db 或 --dump-snapshot 之一")
+        return EXIT_FAILED
+    if args.dump_snapshot and args.snapshot:
+        log("--dump-snapshot 需要从数据库读取输入")
+        return EXIT_FAILED
+    semester_ids = list(dict.fromkeys(args.semesters))
+    db_params = default_db_params(args.dsn)
+    timer = PhaseTimer()
+    profiler = cProfile.Profile() if (args.profile or args.profile_output) else None
+    report = {'semesters': semester_ids, 'strategy': args.strategy, 'seed': args.seed}
+
+    try:
+        with stdout_to_stderr():
+            report['summary'], statuses = run(args, db_params, semester_ids, timer, profiler, report)
+    except (ImportError, ValueError, scheduler_module.SemesterBusy) as e:
+        # 缺少 Parquet 引擎、快照格式不对、学期不存在或正在排课等
+        log(f"失败: {e}")
+        return EXIT_FAILED
+
+    if profiler:
+        if args.profile_output:
+            profiler.dump_stats(args.profile_output)
+            log(f"cProfile 数据已写入 {args.profile_output}")
+        if args.profile:
+            stats_stream = io.StringIO()
+            pstats.Stats(profiler, stream=stats_stream).sort_stats('cumulative').print_stats(args.profile_limit)
+            print(stats_stream.getvalue(), file=sys.stderr)
+            print(timer.report(), file=sys.stderr)
+    report['timings'] = timer.phases
+    print(json.dumps(report, ensure_ascii=False, default=str, indent=2))
+
+    if any(status in ('budget_exhausted', 'cancelled', 'memory_budget_exceeded') for status in statuses.values()):
+        return EXIT_BUDGET
+    if any(not str(status).startswith('success') for status in statuses.values()):
+        return EXIT_FAILED
+    return EXIT_OK
+
+
+if __name__ == '__main__':
+    sys.exit(main())
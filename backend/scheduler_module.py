@@ -2,14 +2,37 @@
 # -*- coding: utf-8 -*-
 import psycopg2
 import psycopg2.extras
+from psycopg2 import sql as pgsql
 import datetime
 import math
 import random
 import copy
+import array
+import concurrent.futures
+import contextlib
+import hashlib
+import gzip
+import itertools
+import json
+import multiprocessing
+import os
 import pandas as pd
-from collections import defaultdict, namedtuple
+from collections import Counter, defaultdict, namedtuple
 import re
 import io
+import logging
+import queue
+import threading
+import time
+import tracemalloc
+import uuid
+
+import private_storage
+import profiling
+import structured_logging
+
+# 结构化日志 (输出格式和后台写出见 structured_logging.py)，extra 中的 event 用于按事件聚合
+logger = logging.getLogger("scheduler")
 
 # --- 检查 openpyxl 库 ---
 try:
@@ -38,13 +61,299 @@ TimetableEntry = namedtuple('TimetableEntry',
                             ['id', 'semester_id', 'major_id', 'course_id', 'teacher_id', 'classroom_id', 'timeslot_id',
                              'week_number', 'assignment_id'])
 TeacherPreference = namedtuple('TeacherPreference', ['id', 'teacher_id', 'semester_id', 'timeslot_id', 'preference_type', 'status', 'reason'])
+# 压缩存储: 同一模板时段在各周重复的条目合并为一条，weeks 为排入的周次列表
+TimetableSeries = namedtuple('TimetableSeries',
+                             ['id', 'semester_id', 'major_id', 'course_id', 'teacher_id', 'classroom_id', 'timeslot_id',
+                              'weeks', 'assignment_id'])
+
+# ==================================
+# 2.1 列式课表 (ScheduleFrame)
+# ==================================
+class ScheduleFrame:
+    """
+    排课结果的列式容器: 每个字段一个定长整数数组 (array 模块)，每条约 30 字节，
+    而 TimetableEntry 命名元组加列表槽位约 120 字节。列顺序与写库的列一致 (TIMETABLE_ENTRY_DB_COLUMNS)。
+    迭代时逐条生成 TimetableEntry (id 为 None)，原来遍历条目列表的代码不用改；
+    写库走 copy_into (COPY，按块直接从列数组生成文本)，不再先构造整张元组列表。
+    classroom_id / assignment_id 为 None 时存为 NULL_ID。
+    """
+    COLUMNS = ('semester_id', 'major_id', 'course_id', 'teacher_id', 'classroom_id', 'timeslot_id',
+               'week_number', 'assignment_id')
+    TYPECODES = ('i', 'i', 'i', 'i', 'i', 'i', 'H', 'i')
+    NULLABLE = ('classroom_id', 'assignment_id')
+    NULL_ID = -1
+    COPY_CHUNK_ROWS = 20000
+
+    def __init__(self):
+        self._columns = [array.array(code) for code in self.TYPECODES]
+
+    @classmethod
+    def from_entries(cls, entries):
+        """由 TimetableEntry 序列 (或另一个 ScheduleFrame) 构造。"""
+        frame = cls()
+        frame.extend(entries)
+        return frame
+
+    def __len__(self):
+        return len(self._columns[0])
+
+    def __iter__(self):
+        null_id = self.NULL_ID
+        for semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week, assignment_id in zip(
+                *self._columns):
+            yield TimetableEntry(None, semester_id, major_id, course_id, teacher_id,
+                                 None if classroom_id == null_id else classroom_id, timeslot_id, week,
+                                 None if assignment_id == null_id else assignment_id)
+
+    def __getstate__(self):
+        return self._columns
+
+    def __setstate__(self, columns):
+        self._columns = columns
+
+    def append_row(self, semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number,
+                   assignment_id):
+        columns = self._columns
+        columns[0].append(semester_id)
+        columns[1].append(major_id)
+        columns[2].append(course_id)
+        columns[3].append(teacher_id)
+        columns[4].append(self.NULL_ID if classroom_id is None else classroom_id)
+        columns[5].append(timeslot_id)
+        columns[6].append(week_number)
+        columns[7].append(self.NULL_ID if assignment_id is None else assignment_id)
+
+    def append(self, entry):
+        """追加一条 TimetableEntry (id 字段被忽略)。"""
+        self.append_row(entry.semester_id, entry.major_id, entry.course_id, entry.teacher_id, entry.classroom_id,
+                        entry.timeslot_id, entry.week_number, entry.assignment_id)
+
+    def extend(self, entries):
+        if isinstance(entries, ScheduleFrame):
+            for column, other in zip(self._columns, entries._columns):
+                column.extend(other)
+            return
+        for entry in entries:
+            self.append(entry)
+
+    def to_column_lists(self):
+        """{列名: 整数列表}，用于写检查点 (JSON)。"""
+        return {name: column.tolist() for name, column in zip(self.COLUMNS, self._columns)}
+
+    @classmethod
+    def from_column_lists(cls, columns):
+        """to_column_lists() 的逆操作，各列长度必须一致。"""
+        frame = cls()
+        for name, column in zip(cls.COLUMNS, frame._columns):
+            column.extend(columns[name])
+        if len({len(column) for column in frame._columns}) > 1:
+            raise ValueError("各列长度不一致")
+        return frame
+
+    def column(self, name):
+        """返回某一列的只读内存视图 (不复制)，NULL 值为 NULL_ID。"""
+        return memoryview(self._columns[self.COLUMNS.index(name)]).toreadonly()
+
+    def entry(self, index):
+        """第 index 行的 TimetableEntry (id 为 None)。"""
+        null_id = self.NULL_ID
+        semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week, assignment_id = (
+            column[index] for column in self._columns)
+        return TimetableEntry(None, semester_id, major_id, course_id, teacher_id,
+                              None if classroom_id == null_id else classroom_id, timeslot_id, week,
+                              None if assignment_id == null_id else assignment_id)
+
+    def _matching_indices(self, filters, candidates=None):
+        """满足全部 (列名, 值) 条件的行下标 (array('I'))；candidates 为 None 时扫描全部行。"""
+        checks = [(self._columns[self.COLUMNS.index(name)], value) for name, value in filters]
+        rows = range(len(self)) if candidates is None else candidates
+        return array.array('I', (index for index in rows
+                                 if all(column[index] == wanted for column, wanted in checks)))
+
+    def where(self, major_id=None, teacher_id=None, week_number=None):
+        """
+        按专业/教师/周次筛选，返回 ScheduleFrameView: 只保存命中行的下标 (每行 4 字节)，不复制列数据。
+        筛选本身要扫描一遍所有行 (没有索引)；需要独立的 ScheduleFrame 时调用视图的 to_frame()。
+        """
+        return ScheduleFrameView(self, self._matching_indices(_frame_filters(major_id, teacher_id, week_number)))
+
+    def copy_into(self, cur, table_name='timetable_entries'):
+        """用 COPY 把全部行写入 table_name (分块生成文本，不构造整张元组列表)。返回写入行数。"""
+        copy_sql = pgsql.SQL("COPY {} ({}) FROM STDIN").format(
+            pgsql.Identifier(table_name), pgsql.SQL(', ').join(map(pgsql.Identifier, self.COLUMNS))).as_string(cur)
+        null_id = self.NULL_ID
+        total = len(self)
+        for start in range(0, total, self.COPY_CHUNK_ROWS):
+            chunk = [column[start:start + self.COPY_CHUNK_ROWS] for column in self._columns]
+            buffer = io.StringIO()
+            buffer.writelines(
+                "\t".join("\\N" if value == null_id else str(value) for value in row) + "\n" for row in zip(*chunk))
+            buffer.seek(0)
+            cur.copy_expert(copy_sql, buffer)
+        return total
+
+    @property
+    def nbytes(self):
+        return sum(column.itemsize * len(column) for column in self._columns)
+
+
+def _frame_filters(major_id, teacher_id, week_number):
+    return [(name, value) for name, value in (('major_id', major_id), ('teacher_id', teacher_id),
+                                              ('week_number', week_number)) if value is not None]
+
+
+class ScheduleFrameView:
+    """
+    ScheduleFrame.where() 的结果: 底层 frame 加命中行的下标数组，迭代时按下标生成 TimetableEntry。
+    底层 frame 只追加不修改，之后追加的行不会出现在已有的视图中。
+    """
+    __slots__ = ('frame', 'indices')
+
+    def __init__(self, frame, indices):
+        self.frame = frame
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        entry = self.frame.entry
+        for index in self.indices:
+            yield entry(index)
+
+    def where(self, major_id=None, teacher_id=None, week_number=None):
+        """在视图的基础上继续筛选 (只检查已命中的行)。"""
+        return ScheduleFrameView(self.frame, self.frame._matching_indices(
+            _frame_filters(major_id, teacher_id, week_number), self.indices))
+
+    def to_frame(self):
+        """把命中的行复制成独立的 ScheduleFrame。"""
+        result = ScheduleFrame()
+        for target, source in zip(result._columns, self.frame._columns):
+            target.extend(source[index] for index in self.indices)
+        return result
+
+
+# ==================================
+# 2.2 排课冲突记录
+# ==================================
+# 冲突按整数记录，不在排课时拼接文字: reason 为下列原因位的组合 (模板复制时可能同时有多个原因)。
+# 模板复制阶段同一任务、同一时段、同一原因在相邻周次上的冲突合并为一条周次范围。
+# 需要展示时再由 describe_conflicts() 生成文字说明。
+CONFLICT_AVOID_PREFERENCE = 1
+CONFLICT_TEACHER_BUSY = 2
+CONFLICT_CLASSROOM_BUSY = 4
+CONFLICT_MAJOR_BUSY = 8
+CONFLICT_NO_CLASSROOM = 16
+CONFLICT_REASON_NAMES = {
+    CONFLICT_AVOID_PREFERENCE: ('avoid_preference', "教师偏好 (避免安排)"),
+    CONFLICT_TEACHER_BUSY: ('teacher_busy', "教师冲突 (已安排其它课程)"),
+    CONFLICT_CLASSROOM_BUSY: ('classroom_busy', "教室冲突 (已被占用)"),
+    CONFLICT_MAJOR_BUSY: ('major_busy', "专业冲突 (已安排其它课程)"),
+    CONFLICT_NO_CLASSROOM: ('no_classroom', "找不到容量足够的教室"),
+}
+
+ConflictRecord = namedtuple('ConflictRecord',
+                            ['major_id', 'assignment_id', 'timeslot_id', 'week_start', 'week_end', 'reason'])
+
+
+class ConflictLog:
+    """一个专业的冲突记录 (ConflictRecord 列表)。len() 为记录条数，weeks() 为涉及的周次总数 (合并前的冲突数)。"""
+    __slots__ = ('records', '_last_by_slot')
+
+    def __init__(self):
+        self.records = []
+        self._last_by_slot = {}  # (assignment_id, timeslot_id) -> 最近一条记录的下标
+
+    @classmethod
+    def from_records(cls, records):
+        log = cls()
+        log.__setstate__([ConflictRecord(*record) for record in records])
+        return log
+
+    def add(self, major_id, assignment_id, timeslot_id, week, reason):
+        key = (assignment_id, timeslot_id)
+        index = self._last_by_slot.get(key)
+        if index is not None:
+            last = self.records[index]
+            if last.week_end == week - 1 and last.reason == reason:
+                self.records[index] = last._replace(week_end=week)
+                return
+        self._last_by_slot[key] = len(self.records)
+        self.records.append(ConflictRecord(major_id, assignment_id, timeslot_id, week, week, reason))
+
+    def weeks(self):
+        return sum(record.week_end - record.week_start + 1 for record in self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __getstate__(self):
+        return self.records
+
+    def __setstate__(self, records):
+        self.records = records
+        self._last_by_slot = {(r.assignment_id, r.timeslot_id): i for i, r in enumerate(records)}
+
+
+def conflict_reason_codes(reason):
+    return [CONFLICT_REASON_NAMES[bit][0] for bit in sorted(CONFLICT_REASON_NAMES) if reason & bit]
+
+
+def conflict_reason_text(reason):
+    return "、".join(CONFLICT_REASON_NAMES[bit][1] for bit in sorted(CONFLICT_REASON_NAMES) if reason & bit)
+
+
+def describe_conflicts(records, all_data, limit=None):
+    """
+    把冲突记录展开成可读的字典 (专业/课程/教师名称、星期和节次、周次范围、原因代码和说明)，
+    按冲突周数从多到少排列；limit 限制返回条数。
+    """
+    records = sorted(records, key=lambda r: (-(r.week_end - r.week_start), r.major_id, r.week_start, r.timeslot_id))
+    if limit is not None:
+        records = records[:limit]
+    described = []
+    for record in records:
+        major = all_data['majors'].get(record.major_id)
+        assignment = all_data['course_assignments'].get(record.assignment_id)
+        course = all_data['courses'].get(assignment.course_id) if assignment else None
+        teacher = all_data['teachers'].get(assignment.teacher_id) if assignment else None
+        timeslot = all_data['timeslots'].get(record.timeslot_id)
+        weeks = (f"第 {record.week_start} 周" if record.week_start == record.week_end
+                 else f"第 {record.week_start}-{record.week_end} 周")
+        reason_text = conflict_reason_text(record.reason)
+        slot_text = f"{timeslot.day_of_week} 第 {timeslot.period} 节" if timeslot else f"时段 {record.timeslot_id}"
+        described.append({
+            "major_id": record.major_id,
+            "major_name": major.name if major else None,
+            "assignment_id": record.assignment_id,
+            "course_name": course.name if course else None,
+            "teacher_name": teacher.name if teacher else None,
+            "timeslot_id": record.timeslot_id,
+            "week_start": record.week_start,
+            "week_end": record.week_end,
+            "reasons": conflict_reason_codes(record.reason),
+            "message": f"{weeks} {slot_text} {course.name if course else '未知课程'}: {reason_text}",
+        })
+    return described
+
+
+def summary_without_conflicts(summary):
+    """排课摘要去掉冲突明细 (只保留计数)，用于接口返回和任务状态。"""
+    if not summary or "conflicts" not in summary:
+        return summary
+    return {key: value for key, value in summary.items() if key != "conflicts"}
+
 
 # ==================================
 # 3. 数据加载函数 (保持不变)
 # ==================================
 def load_data_from_db(get_connection_func):
     """从数据库加载所有基础数据，包括教师偏好"""
-    print("SCHEDULER: 开始从数据库加载数据...")
+    logger.info("开始从数据库加载数据", extra={"event": "load_data.started"})
     all_data = {}
     conn = None
     cur = None # Define cur outside try
@@ -53,7 +362,7 @@ def load_data_from_db(get_connection_func):
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
         # 加载学期 (计算 total_weeks)
-        cur.execute("SELECT id, name, start_date, end_date FROM semesters")
+        cur.execute("SELECT id, name, start_date, end_date FROM semesters ORDER BY id")
         raw_semesters = cur.fetchall()
         all_data['semesters'] = {}
         # print("  - 正在加载学期信息并计算总周数...")
@@ -72,14 +381,15 @@ def load_data_from_db(get_connection_func):
         # print(f"  - 加载并处理了 {len(all_data['semesters'])} 个学期信息")
 
         # 加载专业
-        cur.execute("SELECT id, name FROM majors")
+        cur.execute("SELECT id, name FROM majors ORDER BY id")
         all_data['majors'] = {row['id']: Major(**row) for row in cur.fetchall()}
         # print(f"  - 加载了 {len(all_data['majors'])} 个专业信息")
 
+        # 所有查询按 id 排序: 字典的遍历顺序决定排课顺序，固定顺序才能保证断点续排与一次排完结果一致
         # 加载教师
-        cur.execute("SELECT id, username FROM users")
+        cur.execute("SELECT id, username FROM users ORDER BY id")
         user_id_to_name = {row['id']: row['username'] for row in cur.fetchall()}
-        cur.execute("SELECT id, user_id FROM teachers")
+        cur.execute("SELECT id, user_id FROM teachers ORDER BY id")
         raw_teachers = cur.fetchall()
         all_data['teachers'] = {}
         for row in raw_teachers:
@@ -90,10 +400,12 @@ def load_data_from_db(get_connection_func):
         # print(f"  - 加载并处理了 {len(all_data['teachers'])} 个教师信息")
 
         # 加载教室
-        cur.execute("SELECT id, building, room_number, capacity, room_type FROM classrooms")
+        cur.execute("SELECT id, building, room_number, capacity, room_type FROM classrooms ORDER BY id")
         all_data['classrooms'] = {}
+        all_data['classroom_buildings'] = {} # {classroom_id: building}，模拟排课按教学楼关闭教室时使用
         for row in cur.fetchall():
             classroom_id = row['id']
+            all_data['classroom_buildings'][classroom_id] = row['building']
             building_name = row['building'] if row['building'] else '未知楼'
             room_num = row['room_number'] if row['room_number'] else '未知号'
             classroom_name = f"{building_name}-{room_num}"
@@ -103,7 +415,7 @@ def load_data_from_db(get_connection_func):
         # print(f"  - 加载了 {len(all_data['classrooms'])} 个教室信息")
 
         # 加载课程
-        cur.execute("SELECT id, name, total_sessions, course_type FROM courses")
+        cur.execute("SELECT id, name, total_sessions, course_type FROM courses ORDER BY id")
         all_data['courses'] = {row['id']: Course(**row) for row in cur.fetchall()}
         # print(f"  - 加载了 {len(all_data['courses'])} 个课程信息")
 
@@ -117,6 +429,7 @@ def load_data_from_db(get_connection_func):
         cur.execute("""
             SELECT id, major_id, course_id, teacher_id, semester_id, is_core_course, expected_students
             FROM course_assignments
+            ORDER BY id
         """)
         all_data['course_assignments'] = {row['id']: CourseAssignment(**row) for row in cur.fetchall()}
         # print(f"  - 加载了 {len(all_data['course_assignments'])} 个教学任务")
@@ -126,6 +439,7 @@ def load_data_from_db(get_connection_func):
             SELECT id, teacher_id, semester_id, timeslot_id, preference_type, status, reason
             FROM teacher_scheduling_preferences
             WHERE preference_type = 'avoid'
+            ORDER BY id
         """)
         # Store approved 'avoid' preferences in a set for quick lookup: (teacher_id, timeslot_id, semester_id)
         all_data['approved_avoid_preferences'] = set()
@@ -136,52 +450,179 @@ def load_data_from_db(get_connection_func):
         # --- 新增结束 ---
 
         cur.close()
-        print("SCHEDULER: 数据加载成功!")
+        logger.info("数据加载成功", extra={"event": "load_data.finished"})
         return all_data
 
     except psycopg2.Error as e:
-        print(f"SCHEDULER: 数据库连接或查询错误: {e}")
+        logger.error("数据库连接或查询错误: %s", e, extra={"event": "load_data.failed"})
         # import traceback; traceback.print_exc() # For more detailed server-side logs if needed
         raise  # Re-raise the exception to be caught by the Flask route
     except Exception as e:
-        print(f"SCHEDULER: 数据加载过程中发生未知错误: {e}")
+        logger.error("数据加载过程中发生未知错误: %s", e, extra={"event": "load_data.failed"})
         # import traceback; traceback.print_exc()
         raise # Re-raise
     finally:
         if cur: cur.close()
         if conn: conn.close()
 
+# ==================================
+# 3.1 数据快照 (离线排课用，JSON 或 Parquet)
+# ==================================
+# 快照保存 load_data_from_db 的全部基础数据 (外加可选的固定条目)，每张表是一组记录 (dict)。
+# JSON 为单个文件；Parquet 为一个目录，每张表一个 .parquet 文件 (需要安装 pyarrow 或 fastparquet)。
+SNAPSHOT_FORMAT = 'course-scheduling-snapshot'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_TABLES = {
+    'semesters': Semester,
+    'majors': Major,
+    'teachers': Teacher,
+    'classrooms': Classroom,
+    'courses': Course,
+    'timeslots': TimeSlot,
+    'course_assignments': CourseAssignment,
+}
+
+def _snapshot_value(value):
+    """把 Parquet/pandas 读回的值还原成普通 Python 值 (NaN -> None，numpy 数值 -> int/float/bool)。"""
+    if value is None:
+        return None
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if hasattr(value, 'item') and not isinstance(value, (str, bytes)):
+        return value.item()
+    return value
+
+def _snapshot_date(value):
+    value = _snapshot_value(value)
+    if value is None or isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if hasattr(value, 'date'):  # pandas.Timestamp
+        return value.date()
+    return datetime.date.fromisoformat(str(value)[:10])
+
+def _snapshot_time(value):
+    value = _snapshot_value(value)
+    if value is None or isinstance(value, datetime.time):
+        return value
+    return datetime.time.fromisoformat(str(value))
+
+def data_to_snapshot_tables(all_data, pinned_entries=()):
+    """把 all_data 转成 {表名: [记录, ...]}。"""
+    tables = {name: [item._asdict() for item in all_data.get(name, {}).values()] for name in SNAPSHOT_TABLES}
+    tables['classroom_buildings'] = [{'classroom_id': cid, 'building': building}
+                                     for cid, building in all_data.get('classroom_buildings', {}).items()]
+    tables['approved_avoid_preferences'] = [
+        {'teacher_id': t, 'timeslot_id': ts, 'semester_id': sem}
+        for t, ts, sem in sorted(all_data.get('approved_avoid_preferences', ()))]
+    tables['pinned_entries'] = [entry._asdict() for entry in pinned_entries]
+    return tables
+
+def data_from_snapshot_tables(tables):
+    """data_to_snapshot_tables 的逆操作，返回 (all_data, 固定条目列表)。"""
+    all_data = {}
+    for name, record_type in SNAPSHOT_TABLES.items():
+        items = {}
+        for row in tables.get(name, []):
+            fields = {field: _snapshot_value(row.get(field)) for field in record_type._fields}
+            if record_type is Semester:
+                fields['start_date'] = _snapshot_date(fields['start_date'])
+                fields['end_date'] = _snapshot_date(fields['end_date'])
+            elif record_type is TimeSlot:
+                fields['start_time'] = _snapshot_time(fields['start_time'])
+                fields['end_time'] = _snapshot_time(fields['end_time'])
+            items[fields['id']] = record_type(**fields)
+        all_data[name] = dict(sorted(items.items()))  # 与 load_data_from_db 一样按 id 排序
+    all_data['timeslots'] = dict(sorted(all_data['timeslots'].items(),
+                                        key=lambda item: (item[1].day_of_week, item[1].period)))
+    all_data['timeslot_lookup'] = {(ts.day_of_week, ts.period): ts.id for ts in all_data['timeslots'].values()}
+    all_data['classroom_buildings'] = {_snapshot_value(row['classroom_id']): _snapshot_value(row.get('building'))
+                                       for row in tables.get('classroom_buildings', [])}
+    all_data['approved_avoid_preferences'] = {
+        (_snapshot_value(row['teacher_id']), _snapshot_value(row['timeslot_id']), _snapshot_value(row['semester_id']))
+        for row in tables.get('approved_avoid_preferences', [])}
+    pinned_entries = [TimetableEntry(**{field: _snapshot_value(row.get(field)) for field in TimetableEntry._fields})
+                      for row in tables.get('pinned_entries', [])]
+    return all_data, pinned_entries
+
+def save_data_snapshot(path, all_data, pinned_entries=()):
+    """写快照: 以 .parquet 结尾的路径写成 Parquet 目录，其余写成 JSON 文件。"""
+    tables = data_to_snapshot_tables(all_data, pinned_entries)
+    if path.endswith('.parquet'):
+        os.makedirs(path, exist_ok=True)
+        for name, rows in tables.items():
+            pd.DataFrame.from_records(rows).to_parquet(os.path.join(path, f"{name}.parquet"), index=False)
+        return
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'format': SNAPSHOT_FORMAT, 'version': SNAPSHOT_VERSION, 'tables': tables},
+                  f, ensure_ascii=False, default=str)
+
+def load_data_snapshot(path):
+    """读快照 (JSON 文件或 Parquet 目录)，返回 (all_data, 固定条目列表)。格式不对时抛出 ValueError。"""
+    if os.path.isdir(path):
+        tables = {}
+        for file_name in os.listdir(path):
+            if file_name.endswith('.parquet'):
+                frame = pd.read_parquet(os.path.join(path, file_name))
+                tables[file_name[:-len('.parquet')]] = frame.astype(object).to_dict('records')
+    else:
+        with open(path, encoding='utf-8') as f:
+            snapshot = json.load(f)
+        if snapshot.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError(f"{path} 不是排课数据快照")
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(f"不支持的快照版本: {snapshot.get('version')}")
+        tables = snapshot['tables']
+    missing = [name for name in SNAPSHOT_TABLES if name not in tables]
+    if missing:
+        raise ValueError(f"快照缺少数据表: {', '.join(missing)}")
+    return data_from_snapshot_tables(tables)
+
+
 # ==================================
 # 4. 辅助函数 (保持不变)
 # ==================================
 def find_timeslot_id(day_str, period_num, all_data):
     return all_data['timeslot_lookup'].get((day_str, period_num))
 
-def check_constraints(timetable_state, assignment, week, timeslot_id, classroom_id, all_data):
+def check_constraints(timetable_state, assignment, week, timeslot_id, classroom_id, all_data, stats=None):
+    # stats: 可选的 SchedulerStats，记录调用次数和按原因分类的失败次数
+    # 返回 (是否可排, 冲突原因)，冲突原因为 CONFLICT_* 常量 (见 2.2)，文字说明用 conflict_reason_text() 生成
     teacher_id = assignment.teacher_id
     major_id = assignment.major_id
     semester_id = assignment.semester_id # 获取学期 ID
+    if stats is not None:
+        stats.count('check_constraints.calls')
 
     # --- 新增：检查教师的“避免安排”偏好 ---
     if (teacher_id, timeslot_id, semester_id) in all_data.get('approved_avoid_preferences', set()):
         # print(f"[CONFLICT] Teacher {teacher_id} has 'avoid' preference for timeslot {timeslot_id} in semester {semester_id}")
-        return False, "教师偏好 (避免安排)"
+        if stats is not None: stats.count('check_constraints.failed.avoid_preference')
+        return False, CONFLICT_AVOID_PREFERENCE
     # --- 新增结束 ---
 
     # 检查全局状态中教师、教室、专业是否已被占用
     if (teacher_id, week, timeslot_id) in timetable_state['teacher_schedule']:
         # print(f"[CONFLICT] Teacher {teacher_id} busy week {week} slot {timeslot_id}")
-        return False, "教师冲突 (已安排其它课程)"
+        if stats is not None: stats.count('check_constraints.failed.teacher_busy')
+        return False, CONFLICT_TEACHER_BUSY
     if (classroom_id, week, timeslot_id) in timetable_state['classroom_schedule']:
         # print(f"[CONFLICT] Classroom {classroom_id} busy week {week} slot {timeslot_id}")
-        return False, "教室冲突 (已被占用)"
+        if stats is not None: stats.count('check_constraints.failed.classroom_busy')
+        return False, CONFLICT_CLASSROOM_BUSY
     if (major_id, week, timeslot_id) in timetable_state['major_schedule']:
         # print(f"[CONFLICT] Major {major_id} busy week {week} slot {timeslot_id}")
-        return False, "专业冲突 (已安排其它课程)"
+        if stats is not None: stats.count('check_constraints.failed.major_busy')
+        return False, CONFLICT_MAJOR_BUSY
 
     return True, None # 没有冲突
 
-def find_available_classroom(timetable_state, assignment, week, timeslot_id, all_data):
+def find_available_classroom(timetable_state, assignment, week, timeslot_id, all_data, stats=None, rng=None):
+    # stats: 可选的 SchedulerStats，记录调用次数、扫描的占用记录数和教室数
+    # rng: 本次排课的 random.Random 实例 (None 时用全局 random)，从候选教室中随机选一间
+    if rng is None:
+        rng = random
     required_capacity = assignment.expected_students
     course = all_data['courses'].get(assignment.course_id)
     is_lab_course = course and course.course_type == '实验课'
@@ -202,15 +643,26 @@ def find_available_classroom(timetable_state, assignment, week, timeslot_id, all
         else:
             other_type_available.append(classroom_id)
 
-    if preferred_type_available: return random.choice(preferred_type_available)
-    if other_type_available: return random.choice(other_type_available)
+    if stats is not None:
+        stats.count('find_available_classroom.calls')
+        stats.count('find_available_classroom.occupancy_scanned', len(timetable_state['classroom_schedule']))
+        stats.count('find_available_classroom.rooms_scanned', len(all_data['classrooms']))
+        if not preferred_type_available:
+            stats.count('find_available_classroom.fallback_type' if other_type_available
+                        else 'find_available_classroom.no_room')
+
+    if preferred_type_available: return rng.choice(preferred_type_available)
+    if other_type_available: return rng.choice(other_type_available)
     return None
 
 # ==================================
 # 5. 自动生成初始模板函数 (保持不变)
 # ==================================
-def generate_initial_template(assignments_dict, all_data):
+def generate_initial_template(assignments_dict, all_data, rng=None):
     # print("SCHEDULER:   正在根据可用任务自动生成初始周模板...")
+    # rng: 本次排课的 random.Random 实例 (None 时用全局 random)，用于同优先级任务的随机次序
+    if rng is None:
+        rng = random
     day_order = ['周一', '周二', '周三', '周四', '周五', '周六', '周日']
     template_structure = [
         ('周一', 1, '理论课', 'MonWed1'), ('周一', 2, '理论课', 'MonWed2'), ('周一', 3, None, None),
@@ -266,7 +718,7 @@ def generate_initial_template(assignments_dict, all_data):
 
     def get_priority(assign_id, assign):
         course = all_data['courses'].get(assign.course_id)
-        return (assign.is_core_course, -(course.total_sessions if course else 0), random.random())
+        return (assign.is_core_course, -(course.total_sessions if course else 0), rng.random())
 
     all_assignments_sorted = sorted(
          ((get_priority(assign_id, assign), assign_id) for assign_id, assign in assignments_dict.items()),
@@ -305,8 +757,20 @@ def generate_initial_template(assignments_dict, all_data):
 # 6. 基于模板的排课执行函数 (**核心修改**)
 # ==================================
 def schedule_with_generated_template(assignments_for_major, current_semester, current_major, all_data, initial_template_dp, # initial_template is (day, period) map
-                                     unscheduled_pool_ids, global_timetable_state):
-    print(f"\nSCHEDULER: ===== 开始为专业 '{current_major.name}' 排课 (学期: {current_semester.name}, {current_semester.total_weeks} 周) - 采用固定周模板策略 =====")
+                                     unscheduled_pool_ids, global_timetable_state, pinned_sessions=None,
+                                     progress_callback=None, stats=None, rng=None):
+    # pinned_sessions: {assignment_id: 已固定的课时数}，这些课时已在 global_timetable_state 中占位，只排剩余课时
+    # progress_callback: 接收本专业的阶段/进度事件 (见 emit_progress)
+    # stats: 可选的 SchedulerStats，记录第一周/复制阶段的耗时和热点计数
+    # rng: 本次排课的 random.Random 实例 (None 时用全局 random)。同一进程内并发的排课各用各的实例，互不干扰
+    if rng is None:
+        rng = random
+    logger.info("开始为专业 '%s' 排课 (学期: %s, %s 周) - 采用固定周模板策略",
+                current_major.name, current_semester.name, current_semester.total_weeks,
+                extra={"event": "major.started", "semester_id": current_semester.id, "major_id": current_major.id,
+                       "total_weeks": current_semester.total_weeks})
+    # 逐时段跟踪只在 DEBUG 级别开启，关闭时每个时段只多一次局部变量判断
+    trace = logger.isEnabledFor(logging.DEBUG)
     total_weeks = current_semester.total_weeks
     if not total_weeks or total_weeks <= 0:
         unscheduled_details_on_error = []
@@ -319,15 +783,18 @@ def schedule_with_generated_template(assignments_for_major, current_semester, cu
                 'teacher_name': teacher.name if teacher else '未知教师',
                 'remaining_sessions': course.total_sessions if course else 0
             })
-        return {'schedule': [], 'unscheduled_details': unscheduled_details_on_error, 'conflicts': []}
+        return {'schedule': [], 'unscheduled_details': unscheduled_details_on_error, 'conflicts': ConflictLog()}
 
     assignment_sessions_remaining = {}
     for assign_id, assign in assignments_for_major.items():
         course = all_data['courses'].get(assign.course_id)
         assignment_sessions_remaining[assign_id] = course.total_sessions if course else 0
+        if pinned_sessions:
+            assignment_sessions_remaining[assign_id] = max(
+                0, assignment_sessions_remaining[assign_id] - pinned_sessions.get(assign_id, 0))
 
-    final_schedule = []
-    conflicts_log_week1 = [] # 只记录第一周生成模板时的冲突
+    final_schedule = ScheduleFrame()  # 列式存储，见 2.1
+    conflicts_log_week1 = ConflictLog() # 第一周生成模板时的冲突和模板复制冲突 (按周次范围合并)
     week1_schedule_entries = [] # 存储第一周成功排课的条目
     week1_fixed_template = {} # 新增：存储第一周成功排课的固定模板 {timeslot_id: (assignment_id, classroom_id)}
 
@@ -346,11 +813,13 @@ def schedule_with_generated_template(assignments_for_major, current_semester, cu
     for dp, assign_id in initial_template_dp.items():
         if assign_id not in dynamic_unscheduled_assignments_week1 and assignment_sessions_remaining.get(assign_id, 0) > 0:
             dynamic_unscheduled_assignments_week1.append(assign_id)
-    random.shuffle(dynamic_unscheduled_assignments_week1)
+    rng.shuffle(dynamic_unscheduled_assignments_week1)
 
 
     # --- Phase 1: 排列第一周 (Week 1) 并生成固定模板 ---
-    print(f"SCHEDULER:   - 正在排列第 1 周并生成固定模板...")
+    logger.debug("正在排列第 1 周并生成固定模板", extra={"event": "major.week1.started", "major_id": current_major.id})
+    emit_progress(progress_callback, 'major_phase', major_id=current_major.id, phase='week1', status='started')
+    phase_started = SchedulerStats.clock()
     week = 1
     assignments_tried_this_week = set() # 避免重复尝试
 
@@ -393,11 +862,13 @@ def schedule_with_generated_template(assignments_for_major, current_semester, cu
             if not assignment: continue
 
             # 找教室
-            suitable_classroom_id = find_available_classroom(global_timetable_state, assignment, week, timeslot_id, all_data)
+            suitable_classroom_id = find_available_classroom(global_timetable_state, assignment, week, timeslot_id, all_data,
+                                                             stats=stats, rng=rng)
 
             if suitable_classroom_id:
                 # 检查约束
-                is_possible, conflict_reason = check_constraints(global_timetable_state, assignment, week, timeslot_id, suitable_classroom_id, all_data)
+                is_possible, conflict_reason = check_constraints(global_timetable_state, assignment, week, timeslot_id, suitable_classroom_id, all_data,
+                                                                 stats=stats)
 
                 if is_possible:
                     # 成功安排第一周！
@@ -416,7 +887,12 @@ def schedule_with_generated_template(assignments_for_major, current_semester, cu
 
                     # 减少剩余课时
                     assignment_sessions_remaining[assignment_to_attempt_id] -= 1
-                    # print(f"  SUCCESS W1: {day_str}-{period_num} assigned {assignment_to_attempt_id} in C{suitable_classroom_id}. Remaining: {assignment_sessions_remaining[assignment_to_attempt_id]}")
+                    if trace:
+                        logger.debug("第 1 周排入", extra={"event": "slot.placed", "major_id": current_major.id, "week": week,
+                                                          "timeslot_id": timeslot_id,
+                                                          "assignment_id": assignment_to_attempt_id,
+                                                          "classroom_id": suitable_classroom_id,
+                                                          "remaining": assignment_sessions_remaining[assignment_to_attempt_id]})
 
                     # 如果任务完成，从动态池移除 (如果它在里面)
                     if assignment_sessions_remaining[assignment_to_attempt_id] == 0:
@@ -426,36 +902,55 @@ def schedule_with_generated_template(assignments_for_major, current_semester, cu
 
                 else:
                     # 第一周约束冲突，记录
-                    conflicts_log_week1.append(
-                        {'major_id': assignment.major_id, 'week': week, 'day': day_str, 'period': period_num,
-                         'assignment_id': assignment_to_attempt_id, 'reason': f"W1约束冲突: {conflict_reason}"})
-                    # print(f"  CONFLICT W1: {day_str}-{period_num} attempt {assignment_to_attempt_id} failed: {conflict_reason}")
+                    conflicts_log_week1.add(assignment.major_id, assignment_to_attempt_id, timeslot_id, week,
+                                            conflict_reason)
+                    if trace:
+                        logger.debug("第 1 周约束冲突", extra={"event": "slot.conflict", "major_id": current_major.id,
+                                                            "week": week, "timeslot_id": timeslot_id,
+                                                            "assignment_id": assignment_to_attempt_id,
+                                                            "reason": conflict_reason_codes(conflict_reason)})
                     # 如果是从池里拿出来的，放回去
                     if assignment_source == 'pool':
                         if assignment_sessions_remaining.get(assignment_to_attempt_id, 0) > 0: # 只有还有课时才放回
                            dynamic_unscheduled_assignments_week1.append(assignment_to_attempt_id)
-                           random.shuffle(dynamic_unscheduled_assignments_week1)
+                           rng.shuffle(dynamic_unscheduled_assignments_week1)
+                           if stats is not None: stats.count('week1.pool_reshuffles')
 
             else:
                 # 第一周找不到教室，记录
-                conflicts_log_week1.append(
-                    {'major_id': assignment.major_id, 'week': week, 'day': day_str, 'period': period_num,
-                     'assignment_id': assignment_to_attempt_id,
-                     'reason': f"W1找不到容量({assignment.expected_students})教室"})
-                # print(f"  NOCLASSROOM W1: {day_str}-{period_num} attempt {assignment_to_attempt_id} failed: No suitable classroom.")
+                conflicts_log_week1.add(assignment.major_id, assignment_to_attempt_id, timeslot_id, week,
+                                        CONFLICT_NO_CLASSROOM)
+                if trace:
+                    logger.debug("第 1 周找不到教室", extra={"event": "slot.no_classroom", "major_id": current_major.id,
+                                                         "week": week, "timeslot_id": timeslot_id,
+                                                         "assignment_id": assignment_to_attempt_id})
                 # 如果是从池里拿出来的，放回去
                 if assignment_source == 'pool':
                      if assignment_sessions_remaining.get(assignment_to_attempt_id, 0) > 0:
                         dynamic_unscheduled_assignments_week1.append(assignment_to_attempt_id)
-                        random.shuffle(dynamic_unscheduled_assignments_week1)
+                        rng.shuffle(dynamic_unscheduled_assignments_week1)
+                        if stats is not None: stats.count('week1.pool_reshuffles')
         # else:
             # print(f"  W1, {day_str}-{period_num}: No suitable assignment found or all tried/finished.")
 
 
     # --- Phase 2: 复制固定模板到后续周次 (Weeks 2 to N) ---
-    print(f"SCHEDULER:   - 第 1 周模板生成完毕 (排入 {len(week1_fixed_template)} 个时段)。开始复制到后续周...")
+    if stats is not None:
+        stats.record('week1', phase_started, major_id=current_major.id)
+        stats.count('week1.placed', len(final_schedule))
+    logger.debug("第 1 周模板生成完毕 (排入 %s 个时段)，开始复制到后续周", len(week1_fixed_template),
+                 extra={"event": "major.week1.finished", "major_id": current_major.id,
+                        "template_slots": len(week1_fixed_template)})
+    emit_progress(progress_callback, 'major_phase', major_id=current_major.id, phase='week1', status='finished',
+                  template_slots=len(week1_fixed_template), placed=len(final_schedule),
+                  conflicts=conflicts_log_week1.weeks())
+    emit_progress(progress_callback, 'major_phase', major_id=current_major.id, phase='replicate', status='started',
+                  total_weeks=total_weeks)
+    phase_started = SchedulerStats.clock()
+    week1_placed = len(final_schedule)
     if not week1_fixed_template:
-         print(f"SCHEDULER:   - 警告：专业 '{current_major.name}' 未能在第 1 周排入任何课程，无法生成固定模板。")
+         logger.warning("专业 '%s' 未能在第 1 周排入任何课程，无法生成固定模板", current_major.name,
+                        extra={"event": "major.empty_template", "major_id": current_major.id})
     else:
         for week in range(2, total_weeks + 1):
             # print(f"SCHEDULER:     - 正在复制模板到第 {week} 周...")
@@ -473,26 +968,28 @@ def schedule_with_generated_template(assignments_for_major, current_semester, cu
 
                     if teacher_busy or classroom_busy or major_busy:
                          # 记录潜在的周间冲突（通常是由于其他专业抢占了资源）
-                         reason = []
-                         if teacher_busy: reason.append("教师已被占用")
-                         if classroom_busy: reason.append("教室已被占用")
-                         if major_busy: reason.append("专业时段已被占用")
+                         if stats is not None:
+                             stats.count('replicate.conflicts')
+                             if teacher_busy: stats.count('replicate.conflicts.teacher_busy')
+                             if classroom_busy: stats.count('replicate.conflicts.classroom_busy')
+                             if major_busy: stats.count('replicate.conflicts.major_busy')
+                         reason = ((CONFLICT_TEACHER_BUSY if teacher_busy else 0)
+                                   | (CONFLICT_CLASSROOM_BUSY if classroom_busy else 0)
+                                   | (CONFLICT_MAJOR_BUSY if major_busy else 0))
                          # 这里选择记录冲突并跳过，还是强制覆盖？目前选择跳过以避免硬冲突
-                         ts_info = all_data['timeslots'].get(timeslot_id)
-                         day_str = ts_info.day_of_week if ts_info else '?'
-                         period_num = ts_info.period if ts_info else '?'
-                         conflicts_log_week1.append( # 把周间冲突也加入日志
-                             {'major_id': assignment.major_id, 'week': week, 'day': day_str, 'period': period_num,
-                              'assignment_id': assignment_id,
-                              'reason': f"W{week}模板复制冲突: {', '.join(reason)} (被其他专业占用?)"})
-                         # print(f"  SKIP W{week}: Template slot {day_str}-{period_num} for {assignment_id} skipped due to conflict: {', '.join(reason)}")
+                         # 把周间冲突也加入日志，相邻周次的相同冲突合并为一条
+                         conflicts_log_week1.add(assignment.major_id, assignment_id, timeslot_id, week, reason)
+                         if trace:
+                             logger.debug("模板复制冲突，跳过", extra={"event": "slot.conflict", "major_id": current_major.id,
+                                                                   "week": week, "timeslot_id": timeslot_id,
+                                                                   "assignment_id": assignment_id,
+                                                                   "reason": conflict_reason_codes(reason)})
                          continue # 跳过这个时段的复制
 
-                    # 创建排课条目 (直接使用模板信息)
-                    entry = TimetableEntry(None, current_semester.id, assignment.major_id, assignment.course_id,
-                                           assignment.teacher_id, classroom_id, timeslot_id, week,
-                                           assignment_id)
-                    final_schedule.append(entry)
+                    # 创建排课条目 (直接使用模板信息，直接写入列数组，不构造中间元组)
+                    final_schedule.append_row(current_semester.id, assignment.major_id, assignment.course_id,
+                                              assignment.teacher_id, classroom_id, timeslot_id, week,
+                                              assignment_id)
 
                     # 更新全局状态 (重要！通知其他专业此资源已占用)
                     global_timetable_state['teacher_schedule'].add((assignment.teacher_id, week, timeslot_id))
@@ -501,7 +998,17 @@ def schedule_with_generated_template(assignments_for_major, current_semester, cu
 
                     # 减少剩余课时
                     assignment_sessions_remaining[assignment_id] -= 1
-                    # print(f"  REPLICATED W{week}: Slot {day_str}-{period_num} assigned {assignment_id} in C{classroom_id}. Remaining: {assignment_sessions_remaining[assignment_id]}")
+                    if trace:
+                        logger.debug("模板复制排入", extra={"event": "slot.placed", "major_id": current_major.id, "week": week,
+                                                          "timeslot_id": timeslot_id, "assignment_id": assignment_id,
+                                                          "classroom_id": classroom_id,
+                                                          "remaining": assignment_sessions_remaining[assignment_id]})
+            emit_progress(progress_callback, 'week', major_id=current_major.id, week=week, total_weeks=total_weeks,
+                          placed=len(final_schedule), conflicts=conflicts_log_week1.weeks())
+
+    if stats is not None:
+        stats.record('replicate', phase_started, major_id=current_major.id)
+        stats.count('replicate.placed', len(final_schedule) - week1_placed)
 
     # --- Final Check: 未完成的任务 ---
     unscheduled_final = []
@@ -518,7 +1025,14 @@ def schedule_with_generated_template(assignments_for_major, current_semester, cu
                 {'assignment_id': assign_id, 'course_name': course_name, 'teacher_name': teacher_name,
                  'remaining_sessions': remaining})
 
-    print(f"SCHEDULER: ===== 专业 '{current_major.name}' 固定模板排课完成。总生成课表条目: {len(final_schedule)}, 第一周冲突记录: {len(conflicts_log_week1)}, 最终未完成任务数: {len(unscheduled_final)} =====")
+    emit_progress(progress_callback, 'major_phase', major_id=current_major.id, phase='replicate', status='finished',
+                  placed=len(final_schedule), conflicts=conflicts_log_week1.weeks(), uncompleted=len(unscheduled_final))
+    logger.info("专业 '%s' 固定模板排课完成。总生成课表条目: %s, 冲突: %s次 (%s条记录), 最终未完成任务数: %s",
+                current_major.name, len(final_schedule), conflicts_log_week1.weeks(), len(conflicts_log_week1),
+                len(unscheduled_final),
+                extra={"event": "major.finished", "semester_id": current_semester.id, "major_id": current_major.id,
+                       "entries": len(final_schedule), "conflicts": conflicts_log_week1.weeks(), "conflict_records": len(conflicts_log_week1),
+                       "uncompleted": len(unscheduled_final)})
     # 返回结果，冲突只包含第一周生成模板时的冲突
     return {'schedule': final_schedule, 'unscheduled_details': unscheduled_final, 'conflicts': conflicts_log_week1}
 
@@ -651,7 +1165,7 @@ def format_semester_sheet_for_export(worksheet, total_weeks, periods_count):
                         first_cell.border = thin_border
 
                     except Exception as merge_e:
-                         print(f"SCHEDULER: 警告：合并单元格 (周数 {week}) 时发生未知错误: {merge_e}")
+                         logger.warning("合并单元格 (周数 %s) 时发生未知错误: %s", week, merge_e, extra={"event": "export.format_failed"})
                          # Fallback: set value in the first cell
                          first_cell = worksheet.cell(row=start_row, column=1)
                          if first_cell.value != f"第 {week} 周": first_cell.value = f"第 {week} 周"
@@ -660,14 +1174,24 @@ def format_semester_sheet_for_export(worksheet, total_weeks, periods_count):
                          first_cell.border = thin_border
 
     except Exception as format_e:
-        print(f"SCHEDULER: 警告：在调整工作表 '{worksheet.title}' 格式时发生错误: {format_e}")
+        logger.warning("在调整工作表 '%s' 格式时发生错误: %s", worksheet.title, format_e, extra={"event": "export.format_failed"})
         # import traceback; traceback.print_exc() # Debugging help
 
+def _export_profile_label(schedule_entries, all_data, semester, target_major_id=None, target_teacher_id=None):
+    scope = (f"专业 {target_major_id}" if target_major_id is not None
+             else f"教师 {target_teacher_id}" if target_teacher_id is not None else "全学期")
+    return f"导出 Excel 学期 {getattr(semester, 'id', None)} {scope}"
+
+# 管理员布置了 'export' 分析时，下一次导出在分析器下执行 (见 profiling.py)
+@profiling.profiled('export', _export_profile_label)
 def generate_excel_report_for_send_file(schedule_entries, all_data, semester,
                                         target_major_id=None, target_teacher_id=None):
     if not OPENPYXL_AVAILABLE:
         raise ImportError("缺少 openpyxl 库，无法导出 Excel 课表。")
 
+    # 压缩存储的 TimetableSeries 在这里才按周展开
+    schedule_entries = list(iter_expanded_entries(schedule_entries))
+
     # Handle cases where there's absolutely no data or filter yields nothing
     create_empty_excel = False
     empty_message = "没有排课数据可导出。"
@@ -702,7 +1226,7 @@ def generate_excel_report_for_send_file(schedule_entries, all_data, semester,
                 # Format the single cell? Maybe not necessary.
             output_buffer_empty.seek(0)
         except Exception as empty_excel_e:
-            print(f"SCHEDULER: 生成空 Excel 文件时出错: {empty_excel_e}")
+            logger.error("生成空 Excel 文件时出错: %s", empty_excel_e, extra={"event": "export.failed"})
             return io.BytesIO() # Return truly empty buffer on error
         return output_buffer_empty
 
@@ -718,7 +1242,7 @@ def generate_excel_report_for_send_file(schedule_entries, all_data, semester,
             total_weeks = semester.total_weeks
 
             if total_weeks <= 0:
-                print("SCHEDULER: 错误：学期总周数无效，无法生成学期课表。")
+                logger.error("学期总周数无效，无法生成学期课表", extra={"event": "export.failed"})
                 df_error = pd.DataFrame([["学期总周数无效，无法生成课表"]])
                 df_error.to_excel(writer, sheet_name="错误", index=False, header=False)
                 output_buffer.seek(0)
@@ -744,7 +1268,7 @@ def generate_excel_report_for_send_file(schedule_entries, all_data, semester,
             # If after filtering, no entries remain (this check is redundant if handled above, but safe)
             if not filtered_entries and (target_major_id or target_teacher_id):
                  # This case should have been handled by create_empty_excel logic
-                 print("SCHEDULER: 逻辑错误 - 筛选后无数据，但未生成空Excel。")
+                 logger.error("逻辑错误 - 筛选后无数据，但未生成空Excel", extra={"event": "export.failed"})
                  return io.BytesIO() # Return empty
 
             # --- Generate Sheet(s) ---
@@ -853,7 +1377,7 @@ def generate_excel_report_for_send_file(schedule_entries, all_data, semester,
         return output_buffer
 
     except Exception as e:
-        print(f"SCHEDULER: 生成 Excel 文件时出错: {e}")
+        logger.error("生成 Excel 文件时出错: %s", e, extra={"event": "export.failed"})
         # import traceback; traceback.print_exc() # For debugging
         # Try to return a buffer with an error message
         error_output = io.BytesIO()
@@ -862,7 +1386,7 @@ def generate_excel_report_for_send_file(schedule_entries, all_data, semester,
                  pd.DataFrame([["生成Excel时出错:", str(e)]]).to_excel(writer_error, sheet_name="错误", index=False, header=False)
              error_output.seek(0)
         except Exception as inner_e:
-             print(f"SCHEDULER: 写入Excel错误信息时也出错: {inner_e}")
+             logger.error("写入Excel错误信息时也出错: %s", inner_e, extra={"event": "export.failed"})
              return io.BytesIO() # Return empty buffer if even error logging fails
         return error_output # Return buffer with error message
 
@@ -877,27 +1401,32 @@ def clear_db_for_semester(semester_id, get_connection_func):
         conn = get_connection_func()
         cur = conn.cursor()
         # print(f"SCHEDULER: 正在清空数据库中 学期 ID={semester_id} 的旧排课记录...")
-        delete_query = "DELETE FROM timetable_entries WHERE semester_id = %s"
-        cur.execute(delete_query, (semester_id,))
-        deleted_count = cur.rowcount
+        if is_timetable_partitioned(cur):
+            # 分区表: 直接 TRUNCATE 该学期的分区，代替逐行 DELETE
+            deleted_count = truncate_semester_partition(cur, semester_id)
+        else:
+            delete_query = "DELETE FROM timetable_entries WHERE semester_id = %s"
+            cur.execute(delete_query, (semester_id,))
+            deleted_count = cur.rowcount
+        deleted_count += _replace_series_rows(cur, semester_id, [])[0]
         conn.commit()
         cur.close()
         # print(f"SCHEDULER: 成功删除 {deleted_count} 条旧记录。")
         return True, deleted_count
     except psycopg2.Error as e:
-        print(f"SCHEDULER: 清空学期 {semester_id} 的数据库记录时出错: {e}")
+        logger.error("清空学期 %s 的数据库记录时出错: %s", semester_id, e, extra={"event": "db.clear_failed", "semester_id": semester_id})
         if conn: conn.rollback()
         # import traceback; traceback.print_exc()
         raise  # Re-raise
     except Exception as e:
-        print(f"SCHEDULER: 清空记录过程中发生未知错误: {e}")
+        logger.error("清空记录过程中发生未知错误: %s", e, extra={"event": "db.clear_failed", "semester_id": semester_id})
         if conn: conn.rollback()
         raise
     finally:
         if cur: cur.close()
         if conn: conn.close()
 
-def save_schedule_to_db(schedule_entries, get_connection_func):
+def save_schedule_to_db(schedule_entries, get_connection_func, table_name='timetable_entries'):
     if not schedule_entries:
         # print("SCHEDULER: 没有排课条目需要保存。")
         return 0
@@ -908,34 +1437,21 @@ def save_schedule_to_db(schedule_entries, get_connection_func):
         conn_save = get_connection_func()
         cur_save = conn_save.cursor()
 
-        insert_query = """
-            INSERT INTO timetable_entries
-            (semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number, assignment_id)
-            VALUES %s
-        """
-
-        data_to_insert = [
-            (e.semester_id, e.major_id, e.course_id, e.teacher_id, e.classroom_id, e.timeslot_id, e.week_number,
-             e.assignment_id)
-            for e in schedule_entries
-        ]
-
-        from psycopg2.extras import execute_values
-        execute_values(cur_save, insert_query, data_to_insert, page_size=max(100, len(data_to_insert)//10))
-
-        inserted_count = len(data_to_insert) # Assume all attempted rows are inserted if no error
+        # 列式 COPY 写入，不再先构造整张元组列表
+        frame = schedule_entries if isinstance(schedule_entries, ScheduleFrame) else ScheduleFrame.from_entries(schedule_entries)
+        inserted_count = frame.copy_into(cur_save, table_name)
         conn_save.commit()
 
         cur_save.close()
         # print(f"SCHEDULER: 成功保存 {inserted_count} 条排课记录到数据库。")
         return inserted_count
     except psycopg2.Error as e:
-        print(f"SCHEDULER: 保存排课结果到数据库时出错: {e}")
+        logger.error("保存排课结果到数据库时出错: %s", e, extra={"event": "db.save_failed"})
         if conn_save: conn_save.rollback()
         # import traceback; traceback.print_exc()
         raise  # Re-raise
     except Exception as e:
-         print(f"SCHEDULER: 保存记录过程中发生未知错误: {e}")
+         logger.error("保存记录过程中发生未知错误: %s", e, extra={"event": "db.save_failed"})
          if conn_save: conn_save.rollback()
          raise
     finally:
@@ -943,6 +1459,1429 @@ def save_schedule_to_db(schedule_entries, get_connection_func):
         if conn_save: conn_save.close()
 
 
+# ==================================
+# 8.1 流式写入线程
+# ==================================
+class ScheduleStreamWriter:
+    """
+    后台写库线程。排课时每完成一个专业就把它的条目放入有界队列，
+    由后台线程在同一个事务内持续写入数据库，结束时统一提交 (出错则整体回滚)。
+    队列满时 put() 会阻塞，从而限制内存中待写入条目的数量。
+    """
+    _STOP = object()
+
+    def __init__(self, get_connection_func, max_pending_batches=4, table_name='timetable_entries'):
+        self._get_connection_func = get_connection_func
+        self._table_name = table_name
+        self._queue = queue.Queue(maxsize=max_pending_batches)
+        self._conn = None
+        self._thread = None
+        self._error = None
+        self.inserted_count = 0
+
+    def start(self):
+        # 在调用线程上建立连接，连接失败直接抛给调用方
+        self._conn = self._get_connection_func()
+        self._thread = threading.Thread(target=self._drain, name="schedule-stream-writer", daemon=True)
+        self._thread.start()
+        return self
+
+    def _drain(self):
+        cur = None
+        try:
+            cur = self._conn.cursor()
+            while True:
+                batch = self._queue.get()
+                if batch is self._STOP:
+                    break
+                self.inserted_count += batch.copy_into(cur, self._table_name)
+        except Exception as e:
+            logger.error("流式写入线程出错: %s", e, extra={"event": "stream_writer.failed"})
+            self._error = e
+        finally:
+            if cur: cur.close()
+
+    def _put_checked(self, item):
+        # 写入线程已失败时不能无限阻塞在满队列上
+        while True:
+            if self._error is not None:
+                raise RuntimeError(f"流式写入线程已失败: {self._error}") from self._error
+            try:
+                self._queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                if not self._thread.is_alive():
+                    raise RuntimeError("流式写入线程已意外退出。")
+
+    def put(self, schedule_entries):
+        """提交一批条目 (例如一个专业的全部条目)，以 ScheduleFrame 形式入队，写库线程用 COPY 写入。"""
+        if not schedule_entries:
+            return
+        if not isinstance(schedule_entries, ScheduleFrame):
+            schedule_entries = ScheduleFrame.from_entries(schedule_entries)
+        self._put_checked(schedule_entries)
+
+    def close(self):
+        """等待队列写完并提交事务，返回写入的条目数。"""
+        try:
+            self._put_checked(self._STOP)
+            self._thread.join()
+            if self._error is not None:
+                raise RuntimeError(f"流式写入线程已失败: {self._error}") from self._error
+            self._conn.commit()
+            return self.inserted_count
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            if self._conn:
+                self._conn.close()
+                self._conn = None
+
+    def abort(self):
+        """放弃本次写入: 停止线程并回滚事务。"""
+        if self._thread is not None and self._thread.is_alive():
+            # 丢弃尚未写入的批次，给停止信号腾出位置
+            try:
+                while True: self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            self._queue.put(self._STOP)
+            self._thread.join()
+        if self._conn:
+            try: self._conn.rollback()
+            except Exception: pass
+            try: self._conn.close()
+            except Exception: pass
+            self._conn = None
+
+
+# ==================================
+# 8.2 暂存表与原子替换
+# ==================================
+TIMETABLE_ENTRY_DB_COLUMNS = ['semester_id', 'major_id', 'course_id', 'teacher_id', 'classroom_id', 'timeslot_id',
+                              'week_number', 'assignment_id']
+
+def create_staging_table(semester_id, get_connection_func):
+    """
+    为本次排课创建一张暂存表 (结构同 timetable_entries，UNLOGGED、无索引，写入更快)。
+    排课结果先写进暂存表，最后由 swap_staging_into_place 一次性替换，
+    这样排课期间读接口始终看到旧课表，中途失败也不会留下空学期。
+    timetable_entries 已分区时，暂存表建成可以直接挂载为该学期分区的普通表。
+    """
+    staging_table = f"timetable_entries_stage_{semester_id}_{uuid.uuid4().hex[:8]}"
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        # INCLUDING DEFAULTS 会带上 id 的序列默认值，暂存行的 id 与正式表共用同一个序列
+        if is_timetable_partitioned(cur):
+            # 带上 CHECK (semester_id = N)，ATTACH PARTITION 时不必再全表校验分区约束
+            cur.execute(pgsql.SQL("""
+                CREATE TABLE {stage} (LIKE timetable_entries INCLUDING DEFAULTS INCLUDING CONSTRAINTS,
+                                      CONSTRAINT {check_name} CHECK (semester_id IS NOT NULL AND semester_id = {sid}))
+            """).format(stage=pgsql.Identifier(staging_table),
+                        check_name=pgsql.Identifier(f"{staging_table}_semester_check"),
+                        sid=pgsql.Literal(semester_id)))
+        else:
+            cur.execute(pgsql.SQL("CREATE UNLOGGED TABLE {} (LIKE timetable_entries INCLUDING DEFAULTS)").format(
+                pgsql.Identifier(staging_table)))
+        conn.commit()
+        return staging_table
+    except Exception as e:
+        logger.error("创建学期 %s 的暂存表时出错: %s", semester_id, e, extra={"event": "staging.create_failed", "semester_id": semester_id})
+        if conn: conn.rollback()
+        raise
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+def swap_staging_into_place(semester_id, staging_table, get_connection_func, series_entries=(),
+                            assignment_fingerprints=None, version_source=None):
+    """
+    在一个事务内用暂存表的内容替换该学期的正式课表，并删除暂存表。
+    同一事务内也替换该学期的压缩课表 (timetable_entry_series)，series_entries 为空即清空。
+    assignment_fingerprints 不为 None 时一并更新增量排课用的教学任务快照。
+    version_source 不为 None 时在同一事务内记录课表版本 (见 8.7)。
+    提交前其他连接看到的一直是旧数据。返回 (删除的旧记录数, 写入的新记录数, 版本 ID)，记录数为两张表合计，
+    没有记录版本时版本 ID 为 None。
+    """
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        if is_timetable_partitioned(cur):
+            conn.commit()
+            return _swap_staging_partition(conn, cur, semester_id, staging_table, series_entries,
+                                           assignment_fingerprints, version_source)
+        columns = pgsql.SQL(', ').join(pgsql.Identifier(col) for col in ['id'] + TIMETABLE_ENTRY_DB_COLUMNS)
+        previous_keys = _begin_version(cur, semester_id) if version_source else None
+        # 固定 (pinned) 的条目保留，只替换其余条目
+        cur.execute("DELETE FROM timetable_entries WHERE semester_id = %s" + _unpinned_filter(cur), (semester_id,))
+        deleted_count = cur.rowcount
+        cur.execute(pgsql.SQL("INSERT INTO timetable_entries ({cols}) SELECT {cols} FROM {stage}").format(
+            cols=columns, stage=pgsql.Identifier(staging_table)))
+        inserted_count = cur.rowcount
+        cur.execute(pgsql.SQL("DROP TABLE {}").format(pgsql.Identifier(staging_table)))
+        series_deleted, series_inserted = _replace_series_rows(cur, semester_id, series_entries)
+        if assignment_fingerprints is not None:
+            _replace_assignment_snapshot(cur, semester_id, assignment_fingerprints)
+        version_id = _finish_version(cur, semester_id, previous_keys, version_source)
+        conn.commit()
+        return deleted_count + series_deleted, inserted_count + series_inserted, version_id
+    except Exception as e:
+        logger.error("替换学期 %s 的课表时出错: %s", semester_id, e, extra={"event": "staging.swap_failed", "semester_id": semester_id})
+        if conn: conn.rollback()
+        raise
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+def drop_staging_table(staging_table, get_connection_func):
+    """排课失败时清理暂存表，清理本身出错只打印，不覆盖原始异常。"""
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        cur.execute(pgsql.SQL("DROP TABLE IF EXISTS {}").format(pgsql.Identifier(staging_table)))
+        conn.commit()
+    except Exception as e:
+        logger.error("删除暂存表 %s 时出错: %s", staging_table, e, extra={"event": "staging.drop_failed"})
+        if conn: conn.rollback()
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+
+# ==================================
+# 8.3 表结构管理 (按学期分区)
+# ==================================
+TIMETABLE_DEFAULT_PARTITION = "timetable_entries_default"
+
+def semester_partition_name(semester_id):
+    return f"timetable_entries_s{semester_id}"
+
+def is_timetable_partitioned(cur):
+    """timetable_entries 是否已经是按 semester_id 的声明式分区表。"""
+    cur.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('timetable_entries')")
+    return cur.fetchone() is not None
+
+def _table_exists(cur, table_name):
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (table_name,))
+    return cur.fetchone()[0]
+
+def _unpinned_filter(cur):
+    """is_pinned 列存在时返回排除固定条目的 WHERE 片段，否则返回空串 (旧表结构没有固定条目)。"""
+    cur.execute("""
+        SELECT 1 FROM pg_attribute
+        WHERE attrelid = to_regclass('timetable_entries') AND attname = 'is_pinned' AND NOT attisdropped
+    """)
+    return " AND NOT is_pinned" if cur.fetchone() else ""
+
+def ensure_semester_partition(cur, semester_id):
+    """为学期创建分区 (已存在则跳过)。调用方负责提交。"""
+    cur.execute(pgsql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF timetable_entries FOR VALUES IN ({})").format(
+        pgsql.Identifier(semester_partition_name(semester_id)), pgsql.Literal(semester_id)))
+
+def truncate_semester_partition(cur, semester_id):
+    """清空一个学期的分区 (包括误落在默认分区里的行)，返回删除的行数。调用方负责提交。"""
+    partition = semester_partition_name(semester_id)
+    deleted_count = 0
+    if _table_exists(cur, partition):
+        cur.execute(pgsql.SQL("SELECT count(*) FROM {}").format(pgsql.Identifier(partition)))
+        deleted_count = cur.fetchone()[0]
+        cur.execute(pgsql.SQL("TRUNCATE {}").format(pgsql.Identifier(partition)))
+    if _table_exists(cur, TIMETABLE_DEFAULT_PARTITION):
+        cur.execute(pgsql.SQL("DELETE FROM {} WHERE semester_id = %s").format(
+            pgsql.Identifier(TIMETABLE_DEFAULT_PARTITION)), (semester_id,))
+        deleted_count += cur.rowcount
+    return deleted_count
+
+def _swap_staging_partition(conn, cur, semester_id, staging_table, series_entries=(), assignment_fingerprints=None,
+                            version_source=None):
+    """
+    分区表的替换: 先在暂存表上建好与父表一致的主键、索引和外键 (此时不持有父表的锁)，
+    再在一个短事务里 DETACH 旧分区、DROP，并把暂存表改名后 ATTACH 为新分区。
+    """
+    stage = pgsql.Identifier(staging_table)
+    partition = semester_partition_name(semester_id)
+
+    # 1. 准备阶段 (暂存表对读接口不可见，耗时操作都放在这里)
+    cur.execute(pgsql.SQL("ALTER TABLE {} ADD PRIMARY KEY (id, semester_id)").format(stage))
+    cur.execute(pgsql.SQL("CREATE INDEX ON {} (major_id, week_number)").format(stage))
+    cur.execute(pgsql.SQL("CREATE INDEX ON {} (teacher_id, week_number)").format(stage))
+    cur.execute("""
+        SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE conrelid = 'timetable_entries'::regclass AND contype = 'f' AND conparentid = 0
+    """)
+    for conname, condef in cur.fetchall():
+        cur.execute(pgsql.SQL("ALTER TABLE {} ADD CONSTRAINT {} ").format(stage, pgsql.Identifier(conname))
+                    + pgsql.SQL(condef))
+    cur.execute(pgsql.SQL("SELECT count(*) FROM {}").format(stage))
+    inserted_count = cur.fetchone()[0]
+    conn.commit()
+
+    # 2. 替换阶段 (短事务)
+    previous_keys = _begin_version(cur, semester_id) if version_source else None
+    # 固定 (pinned) 的条目先复制进暂存表，随新分区一起保留
+    pinned_count = 0
+    if _unpinned_filter(cur):
+        cur.execute(pgsql.SQL("INSERT INTO {} SELECT * FROM timetable_entries WHERE semester_id = %s AND is_pinned")
+                    .format(stage), (semester_id,))
+        pinned_count = cur.rowcount
+    deleted_count = truncate_semester_partition(cur, semester_id) - pinned_count
+    if _table_exists(cur, partition):
+        cur.execute(pgsql.SQL("ALTER TABLE timetable_entries DETACH PARTITION {}").format(pgsql.Identifier(partition)))
+        cur.execute(pgsql.SQL("DROP TABLE {}").format(pgsql.Identifier(partition)))
+    cur.execute(pgsql.SQL("ALTER TABLE {} RENAME TO {}").format(stage, pgsql.Identifier(partition)))
+    cur.execute(pgsql.SQL("ALTER TABLE timetable_entries ATTACH PARTITION {} FOR VALUES IN ({})").format(
+        pgsql.Identifier(partition), pgsql.Literal(semester_id)))
+    series_deleted, series_inserted = _replace_series_rows(cur, semester_id, series_entries)
+    if assignment_fingerprints is not None:
+        _replace_assignment_snapshot(cur, semester_id, assignment_fingerprints)
+    version_id = _finish_version(cur, semester_id, previous_keys, version_source)
+    conn.commit()
+    return deleted_count + series_deleted, inserted_count + series_inserted, version_id
+
+def migrate_timetable_entries_to_partitioned(get_connection_func):
+    """
+    把普通的 timetable_entries 表一次性迁移为 PARTITION BY LIST (semester_id) 的分区表:
+    每个学期一个分区 (timetable_entries_s<学期ID>)，另有一个默认分区兜底。
+    主键改为 (id, semester_id) (分区表的唯一约束必须包含分区键)，外键和 id 序列保持不变。
+    已经是分区表时直接返回 False。整个迁移在一个事务内完成，失败则原表不变。
+    """
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        if is_timetable_partitioned(cur):
+            return False
+
+        cur.execute("""
+            SELECT a.attidentity, pg_get_serial_sequence('timetable_entries', 'id')
+            FROM pg_attribute a
+            WHERE a.attrelid = 'timetable_entries'::regclass AND a.attname = 'id'
+        """)
+        id_identity, id_sequence = cur.fetchone()
+        if id_identity or not id_sequence:
+            raise RuntimeError("timetable_entries.id 不是 SERIAL 列，无法自动迁移为分区表。")
+
+        legacy_table = "timetable_entries_unpartitioned"
+        cur.execute(pgsql.SQL("ALTER TABLE timetable_entries RENAME TO {}").format(pgsql.Identifier(legacy_table)))
+        cur.execute(pgsql.SQL("""
+            SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+            WHERE conrelid = {}::regclass AND contype = 'f'
+        """).format(pgsql.Literal(legacy_table)))
+        foreign_keys = cur.fetchall()
+
+        cur.execute(pgsql.SQL("""
+            CREATE TABLE timetable_entries
+            (LIKE {legacy} INCLUDING DEFAULTS INCLUDING CONSTRAINTS, PRIMARY KEY (id, semester_id))
+            PARTITION BY LIST (semester_id)
+        """).format(legacy=pgsql.Identifier(legacy_table)))
+        for conname, condef in foreign_keys:
+            cur.execute(pgsql.SQL("ALTER TABLE timetable_entries ADD CONSTRAINT {} ").format(pgsql.Identifier(conname))
+                        + pgsql.SQL(condef))
+        # 读接口常见的过滤条件: 专业/教师 + 周次 (学期由分区裁剪)
+        cur.execute("CREATE INDEX ON timetable_entries (major_id, week_number)")
+        cur.execute("CREATE INDEX ON timetable_entries (teacher_id, week_number)")
+        cur.execute(pgsql.SQL("CREATE TABLE {} PARTITION OF timetable_entries DEFAULT").format(
+            pgsql.Identifier(TIMETABLE_DEFAULT_PARTITION)))
+
+        cur.execute(pgsql.SQL("""
+            SELECT id FROM semesters
+            UNION SELECT DISTINCT semester_id FROM {legacy} WHERE semester_id IS NOT NULL
+        """).format(legacy=pgsql.Identifier(legacy_table)))
+        for (semester_id,) in cur.fetchall():
+            ensure_semester_partition(cur, semester_id)
+
+        cur.execute(pgsql.SQL("INSERT INTO timetable_entries SELECT * FROM {}").format(pgsql.Identifier(legacy_table)))
+        migrated_count = cur.rowcount
+        # 序列原本属于旧表的 id 列，先转给新表再删除旧表
+        cur.execute(pgsql.SQL("ALTER SEQUENCE {} OWNED BY timetable_entries.id").format(pgsql.SQL(id_sequence)))
+        cur.execute(pgsql.SQL("DROP TABLE {}").format(pgsql.Identifier(legacy_table)))
+        conn.commit()
+        logger.info("timetable_entries 已迁移为按学期分区的表，迁移记录 %s 条", migrated_count,
+                    extra={"event": "schema.partition_migrated", "rows": migrated_count})
+        return True
+    except Exception as e:
+        logger.error("迁移 timetable_entries 为分区表时出错: %s", e, extra={"event": "schema.partition_migration_failed"})
+        if conn: conn.rollback()
+        raise
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+def ensure_schedule_schema(get_connection_func, partition_timetable=False):
+    """
+    排课相关表结构的初始化入口，可以重复调用。
+    partition_timetable=True 时把 timetable_entries 迁移为分区表，并为新学期补建分区。
+    """
+    if partition_timetable:
+        migrate_timetable_entries_to_partitioned(get_connection_func)
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS timetable_entry_series (
+                id SERIAL PRIMARY KEY,
+                semester_id INTEGER NOT NULL,
+                major_id INTEGER NOT NULL,
+                course_id INTEGER NOT NULL,
+                teacher_id INTEGER NOT NULL,
+                classroom_id INTEGER,
+                timeslot_id INTEGER NOT NULL,
+                weeks INTEGER[] NOT NULL,
+                assignment_id INTEGER REFERENCES course_assignments(id) ON DELETE CASCADE
+            )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS timetable_entry_series_semester_major_idx "
+                    "ON timetable_entry_series (semester_id, major_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS timetable_entry_series_semester_teacher_idx "
+                    "ON timetable_entry_series (semester_id, teacher_id)")
+        # 手动调整后的条目可以固定，重新排课时保留
+        cur.execute("ALTER TABLE timetable_entries ADD COLUMN IF NOT EXISTS is_pinned BOOLEAN NOT NULL DEFAULT FALSE")
+        # 课表版本: 每个版本只存相对父版本的增量
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schedule_versions (
+                id SERIAL PRIMARY KEY,
+                semester_id INTEGER NOT NULL,
+                parent_id INTEGER REFERENCES schedule_versions(id) ON DELETE CASCADE,
+                source VARCHAR(20) NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT now(),
+                added_count INTEGER NOT NULL DEFAULT 0,
+                removed_count INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS schedule_versions_semester_idx ON schedule_versions (semester_id)")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schedule_version_deltas (
+                version_id INTEGER NOT NULL REFERENCES schedule_versions(id) ON DELETE CASCADE,
+                op CHAR(1) NOT NULL CHECK (op IN ('+', '-')),
+                major_id INTEGER,
+                course_id INTEGER,
+                teacher_id INTEGER,
+                classroom_id INTEGER,
+                timeslot_id INTEGER,
+                week_number INTEGER,
+                assignment_id INTEGER
+            )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS schedule_version_deltas_version_idx "
+                    "ON schedule_version_deltas (version_id)")
+        # 增量排课: 记录上次排课时每个教学任务的输入指纹
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS scheduling_assignment_snapshots (
+                semester_id INTEGER NOT NULL,
+                assignment_id INTEGER NOT NULL,
+                major_id INTEGER NOT NULL,
+                fingerprint TEXT NOT NULL,
+                PRIMARY KEY (semester_id, assignment_id)
+            )
+        """)
+        if is_timetable_partitioned(cur):
+            cur.execute("SELECT id FROM semesters")
+            for (semester_id,) in cur.fetchall():
+                ensure_semester_partition(cur, semester_id)
+        conn.commit()
+    except Exception as e:
+        logger.error("初始化排课表结构时出错: %s", e, extra={"event": "schema.init_failed"})
+        if conn: conn.rollback()
+        raise
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+
+# ==================================
+# 8.4 压缩存储 (按周重复的条目合并存储，读取时展开)
+# ==================================
+# 读接口统一从这个子查询取课表: 普通条目 (含手动调整产生的例外行) + 压缩条目按 weeks 展开。
+# 压缩条目展开后 id 为 NULL，用 series_id 标识来源。
+EXPANDED_TIMETABLE_SQL = """(
+    SELECT id, NULL::integer AS series_id, semester_id, major_id, course_id, teacher_id, classroom_id,
+           timeslot_id, week_number, assignment_id, is_pinned
+    FROM timetable_entries
+    UNION ALL
+    SELECT NULL::integer, tes.id, tes.semester_id, tes.major_id, tes.course_id, tes.teacher_id, tes.classroom_id,
+           tes.timeslot_id, w.week_number, tes.assignment_id, FALSE
+    FROM timetable_entry_series tes CROSS JOIN LATERAL unnest(tes.weeks) AS w(week_number)
+)"""
+
+def compress_schedule_entries(schedule_entries):
+    """把逐周条目合并为 TimetableSeries (同专业、课程、教师、教室、时段、任务的各周合成一条)。"""
+    weeks_by_key = defaultdict(list)
+    for e in schedule_entries:
+        key = (e.semester_id, e.major_id, e.course_id, e.teacher_id, e.classroom_id, e.timeslot_id, e.assignment_id)
+        weeks_by_key[key].append(e.week_number)
+    return [
+        TimetableSeries(None, semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id,
+                        sorted(weeks), assignment_id)
+        for (semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, assignment_id), weeks
+        in weeks_by_key.items()
+    ]
+
+def iter_expanded_entries(items):
+    """按需展开: TimetableEntry 原样返回，TimetableSeries 按 weeks 逐周生成 TimetableEntry (id 为 None)。"""
+    for item in items:
+        if isinstance(item, TimetableSeries):
+            for week in item.weeks:
+                yield TimetableEntry(None, item.semester_id, item.major_id, item.course_id, item.teacher_id,
+                                     item.classroom_id, item.timeslot_id, week, item.assignment_id)
+        else:
+            yield item
+
+def _replace_series_rows(cur, semester_id, series_entries):
+    """删除学期原有的压缩条目并写入新的，返回 (删除数, 写入数)。表不存在时视为空。调用方负责提交。"""
+    if not _table_exists(cur, 'timetable_entry_series'):
+        if series_entries:
+            raise RuntimeError("timetable_entry_series 表不存在，请先执行 ensure_schedule_schema。")
+        return 0, 0
+    cur.execute("DELETE FROM timetable_entry_series WHERE semester_id = %s", (semester_id,))
+    deleted_count = cur.rowcount
+    if series_entries:
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO timetable_entry_series
+            (semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, weeks, assignment_id)
+            VALUES %s
+        """, [(s.semester_id, s.major_id, s.course_id, s.teacher_id, s.classroom_id, s.timeslot_id, list(s.weeks),
+               s.assignment_id) for s in series_entries], page_size=max(100, len(series_entries)))
+    return deleted_count, len(series_entries)
+
+def load_schedule_entries(conn, semester_id, major_id=None, teacher_id=None):
+    """
+    读取学期课表供导出使用: 普通条目转为 TimetableEntry，压缩条目保持 TimetableSeries 不展开，
+    由 generate_excel_report_for_send_file 按需展开。
+    """
+    cur = conn.cursor()
+    conditions = ["semester_id = %s"]
+    params = [semester_id]
+    if major_id is not None:
+        conditions.append("major_id = %s")
+        params.append(major_id)
+    if teacher_id is not None:
+        conditions.append("teacher_id = %s")
+        params.append(teacher_id)
+    where_clause = " AND ".join(conditions)
+
+    cur.execute(f"""
+        SELECT id, semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number, assignment_id
+        FROM timetable_entries WHERE {where_clause}
+        ORDER BY week_number, timeslot_id
+    """, tuple(params))
+    items = [TimetableEntry(*row) for row in cur.fetchall()]
+    if _table_exists(cur, 'timetable_entry_series'):
+        cur.execute(f"""
+            SELECT id, semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, weeks, assignment_id
+            FROM timetable_entry_series WHERE {where_clause}
+        """, tuple(params))
+        items.extend(TimetableSeries(*row) for row in cur.fetchall())
+    cur.close()
+    return items
+
+
+# ==================================
+# 8.5 增量排课 (只重排受变更影响的专业)
+# ==================================
+def compute_assignment_fingerprints(assignments, all_data):
+    """
+    计算每个教学任务影响排课结果的输入指纹: {assignment_id: (major_id, fingerprint)}。
+    包括任务本身、课程的课时/类型以及教师在该学期的"避免安排"偏好，课程名称等不影响排课的字段不计入。
+    """
+    avoid_by_teacher = defaultdict(list)
+    for teacher_id, timeslot_id, semester_id in all_data.get('approved_avoid_preferences', set()):
+        avoid_by_teacher[(teacher_id, semester_id)].append(timeslot_id)
+
+    fingerprints = {}
+    for assign_id, assign in assignments.items():
+        course = all_data['courses'].get(assign.course_id)
+        raw = "|".join(str(v) for v in (
+            assign.major_id, assign.course_id, assign.teacher_id, assign.is_core_course, assign.expected_students,
+            course.total_sessions if course else None, course.course_type if course else None,
+            sorted(avoid_by_teacher.get((assign.teacher_id, assign.semester_id), [])),
+        ))
+        fingerprints[assign_id] = (assign.major_id, hashlib.md5(raw.encode('utf-8')).hexdigest())
+    return fingerprints
+
+def _replace_assignment_snapshot(cur, semester_id, fingerprints):
+    """用本次排课的指纹替换学期快照，快照表不存在时跳过。调用方负责提交。"""
+    if not _table_exists(cur, 'scheduling_assignment_snapshots'):
+        return
+    cur.execute("DELETE FROM scheduling_assignment_snapshots WHERE semester_id = %s", (semester_id,))
+    if fingerprints:
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO scheduling_assignment_snapshots (semester_id, assignment_id, major_id, fingerprint) VALUES %s
+        """, [(semester_id, assign_id, major_id, fp) for assign_id, (major_id, fp) in fingerprints.items()])
+
+def load_assignment_snapshot(get_connection_func, semester_id):
+    """读取学期的指纹快照，格式同 compute_assignment_fingerprints。从未排过 (或快照表不存在) 时返回 None。"""
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        if not _table_exists(cur, 'scheduling_assignment_snapshots'):
+            return None
+        cur.execute("""
+            SELECT assignment_id, major_id, fingerprint FROM scheduling_assignment_snapshots WHERE semester_id = %s
+        """, (semester_id,))
+        rows = cur.fetchall()
+        return {assign_id: (major_id, fp) for assign_id, major_id, fp in rows} or None
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+def find_affected_majors(previous_fingerprints, current_fingerprints):
+    """对比两次指纹，返回需要重排的专业集合 (任务新增、删除、改动所在的专业，改了专业的新旧专业都算)。"""
+    affected = set()
+    for assign_id in previous_fingerprints.keys() | current_fingerprints.keys():
+        previous = previous_fingerprints.get(assign_id)
+        current = current_fingerprints.get(assign_id)
+        if previous != current:
+            # 新增或删除的任务只有一侧有指纹
+            affected.update(fingerprint[0] for fingerprint in (previous, current) if fingerprint is not None)
+    return affected
+
+def seed_timetable_state(timetable_state, schedule_entries):
+    """把已有的课表条目登记到占用状态中，后续排课会绕开这些时段。"""
+    for e in schedule_entries:
+        timetable_state['teacher_schedule'].add((e.teacher_id, e.week_number, e.timeslot_id))
+        timetable_state['classroom_schedule'].add((e.classroom_id, e.week_number, e.timeslot_id))
+        timetable_state['major_schedule'].add((e.major_id, e.week_number, e.timeslot_id))
+
+def replace_major_rows(semester_id, major_ids, schedule_entries, series_entries, assignment_fingerprints,
+                       get_connection_func, version_source=None):
+    """
+    增量排课的写回: 在一个事务内删除指定专业在该学期的旧条目 (普通表和压缩表，固定条目除外)，写入新条目并更新指纹快照。
+    其他专业的行不动。version_source 不为 None 时在同一事务内记录课表版本。返回 (删除数, 写入数, 版本 ID)。
+    """
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        previous_keys = _begin_version(cur, semester_id) if version_source else None
+        major_id_list = sorted(major_ids)
+        cur.execute("DELETE FROM timetable_entries WHERE semester_id = %s AND major_id = ANY(%s)"
+                    + _unpinned_filter(cur), (semester_id, major_id_list))
+        deleted_count = cur.rowcount
+        if _table_exists(cur, 'timetable_entry_series'):
+            cur.execute("DELETE FROM timetable_entry_series WHERE semester_id = %s AND major_id = ANY(%s)",
+                        (semester_id, major_id_list))
+            deleted_count += cur.rowcount
+        if schedule_entries:
+            frame = schedule_entries if isinstance(schedule_entries, ScheduleFrame) else ScheduleFrame.from_entries(schedule_entries)
+            frame.copy_into(cur, 'timetable_entries')
+        if series_entries:
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO timetable_entry_series
+                (semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, weeks, assignment_id)
+                VALUES %s
+            """, [(se.semester_id, se.major_id, se.course_id, se.teacher_id, se.classroom_id, se.timeslot_id,
+                   list(se.weeks), se.assignment_id) for se in series_entries])
+        _replace_assignment_snapshot(cur, semester_id, assignment_fingerprints)
+        version_id = _finish_version(cur, semester_id, previous_keys, version_source)
+        conn.commit()
+        return deleted_count, len(schedule_entries) + len(series_entries), version_id
+    except Exception as e:
+        logger.error("写回学期 %s 专业 %s 的课表时出错: %s", semester_id, sorted(major_ids), e,
+                     extra={"event": "db.replace_majors_failed", "semester_id": semester_id})
+        if conn: conn.rollback()
+        raise
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+
+# ==================================
+# 8.6 固定条目 (重新排课时保留)
+# ==================================
+def load_pinned_entries(get_connection_func, semester_id):
+    """读取学期内被固定的条目 (TimetableEntry 列表)。表结构还没有 is_pinned 列时返回空列表。"""
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        if not _unpinned_filter(cur):
+            return []
+        cur.execute("""
+            SELECT id, semester_id, major_id, course_id, teacher_id, classroom_id, timeslot_id, week_number, assignment_id
+            FROM timetable_entries WHERE semester_id = %s AND is_pinned
+            ORDER BY id
+        """, (semester_id,))
+        return [TimetableEntry(*row) for row in cur.fetchall()]
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+def count_pinned_sessions(pinned_entries):
+    """按教学任务统计已固定的课时数，供 schedule_with_generated_template 扣减。"""
+    pinned_sessions = defaultdict(int)
+    for e in pinned_entries:
+        if e.assignment_id is not None:
+            pinned_sessions[e.assignment_id] += 1
+    return pinned_sessions
+
+
+# ==================================
+# 8.7 课表版本 (按父版本存增量)
+# ==================================
+# 每次排课 (以及手动调整、回滚) 记为一个版本，只存相对父版本新增 (+) / 删除 (-) 的课时。
+# 一节课时用下面这些列组成的键标识；版本内容 = 从根版本到该版本路径上所有增量之和。
+# 同一个键可以出现多次 (完全相同的重复课时)，所以键集合都用 Counter (键 → 课时数)，增量按次数记录。
+# 版本必须与课表在同一事务内写入: 改动课表的事务先取 schedule_versions 锁 (lock_schedule_versions)，
+# 再改动行并记录版本。排课写回由 swap_staging_into_place / replace_major_rows 的 version_source 参数完成。
+VERSION_KEY_COLUMNS = ['major_id', 'course_id', 'teacher_id', 'classroom_id', 'timeslot_id', 'week_number',
+                       'assignment_id']
+VERSION_KEY_SQL = ", ".join(VERSION_KEY_COLUMNS)
+
+def key_counter(keys):
+    """把课时键序列转换为 Counter (键 → 课时数)；已经是 Counter 时原样返回。"""
+    if isinstance(keys, Counter):
+        return keys
+    return Counter(tuple(k) for k in keys)
+
+def _fetch_schedule_keys(cur, semester_id):
+    cur.execute(f"SELECT {VERSION_KEY_SQL} FROM timetable_entries WHERE semester_id = %s", (semester_id,))
+    keys = Counter(cur.fetchall())
+    if _table_exists(cur, 'timetable_entry_series'):
+        cur.execute(f"""
+            SELECT {VERSION_KEY_SQL.replace('week_number', 'w.week_number')}
+            FROM timetable_entry_series CROSS JOIN LATERAL unnest(weeks) AS w(week_number)
+            WHERE semester_id = %s
+        """, (semester_id,))
+        keys.update(cur.fetchall())
+    return keys
+
+def load_schedule_keys(get_connection_func, semester_id):
+    """读取学期当前课表 (含压缩条目展开) 的课时键 Counter。"""
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        return _fetch_schedule_keys(cur, semester_id)
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+def lock_schedule_versions(cur, semester_id):
+    """
+    取学期的版本锁 (事务级)。所有改动课表并记录版本的事务都要在改动行之前调用，
+    保证版本链按提交顺序记录，且与排课写回的加锁顺序一致 (先版本锁、后行锁)，不会互相死锁。
+    """
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext('schedule_versions'), %s)", (semester_id,))
+
+def lock_schedule_versions_for_row(cur, table_name, row_id):
+    """按 timetable_entries / timetable_entry_series 中一行所属的学期取版本锁，行不存在时不加锁。"""
+    # 调用方可能传入 RealDictCursor，这里在同一连接 (同一事务) 上另开普通游标
+    plain_cur = cur.connection.cursor()
+    try:
+        plain_cur.execute(pgsql.SQL("SELECT semester_id FROM {} WHERE id = %s").format(pgsql.Identifier(table_name)),
+                          (row_id,))
+        row = plain_cur.fetchone()
+        if row:
+            lock_schedule_versions(plain_cur, row[0])
+    finally:
+        plain_cur.close()
+
+def _head_version_id(cur, semester_id):
+    if not _table_exists(cur, 'schedule_versions'):
+        return None
+    cur.execute("SELECT max(id) FROM schedule_versions WHERE semester_id = %s", (semester_id,))
+    return cur.fetchone()[0]
+
+def _insert_version(cur, semester_id, parent_id, source, removed_keys, added_keys):
+    """写入一个版本及其增量 (重复的课时按次数各记一行)，返回新版本 ID。调用方负责提交。"""
+    removed_keys, added_keys = key_counter(removed_keys), key_counter(added_keys)
+    cur.execute("""
+        INSERT INTO schedule_versions (semester_id, parent_id, source, added_count, removed_count)
+        VALUES (%s, %s, %s, %s, %s) RETURNING id
+    """, (semester_id, parent_id, source, sum(added_keys.values()), sum(removed_keys.values())))
+    version_id = cur.fetchone()[0]
+    rows = ([(version_id, '+') + k for k in added_keys.elements()]
+            + [(version_id, '-') + k for k in removed_keys.elements()])
+    if rows:
+        psycopg2.extras.execute_values(cur, f"""
+            INSERT INTO schedule_version_deltas (version_id, op, {VERSION_KEY_SQL}) VALUES %s
+        """, rows, page_size=max(100, len(rows) // 10))
+    return version_id
+
+def _begin_version(cur, semester_id):
+    """
+    写回课表的事务开始时调用: 取版本锁并读取改动前的课时键。版本表不存在时返回 None (不记录版本)。
+    与 _finish_version 在同一事务内配对使用。
+    """
+    if not _table_exists(cur, 'schedule_versions'):
+        return None
+    lock_schedule_versions(cur, semester_id)
+    return _fetch_schedule_keys(cur, semester_id)
+
+def _finish_version(cur, semester_id, previous_keys, source):
+    """
+    写回课表之后、提交之前调用: 对比改动前后的课时键，把差异记为当前最新版本的子版本，返回版本 ID。
+    学期还没有任何版本而旧课表非空时，先把旧课表整体记为一个基线版本。previous_keys 为 None 时返回 None。
+    """
+    if previous_keys is None:
+        return None
+    current_keys = _fetch_schedule_keys(cur, semester_id)
+    parent_id = _head_version_id(cur, semester_id)
+    if parent_id is None and previous_keys:
+        parent_id = _insert_version(cur, semester_id, None, 'baseline', (), previous_keys)
+    return _insert_version(cur, semester_id, parent_id, source,
+                           previous_keys - current_keys, current_keys - previous_keys)
+
+def record_schedule_version(get_connection_func, semester_id, source, apply_change):
+    """
+    在一个事务内执行 apply_change(cur) 改动课表并记录版本，返回版本 ID (版本表不存在时为 None)。
+    用于排课写回以外直接写 timetable_entries 的场景 (导入、维护脚本)。
+    """
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        previous_keys = _begin_version(cur, semester_id)
+        apply_change(cur)
+        version_id = _finish_version(cur, semester_id, previous_keys, source)
+        conn.commit()
+        return version_id
+    except Exception as e:
+        logger.error("记录学期 %s 的课表版本时出错: %s", semester_id, e, extra={"event": "version.record_failed", "semester_id": semester_id})
+        if conn: conn.rollback()
+        raise
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+def record_manual_schedule_change(cur, semester_id, removed_keys=(), added_keys=()):
+    """
+    手动调整课表时在同一事务内调用，记一个 'manual' 版本，保证版本链与实际课表一致。
+    调用方应在改动行之前先调用 lock_schedule_versions。
+    学期还没有版本时不记录 (下次排课会先记基线)。返回版本 ID 或 None。调用方负责提交。
+    """
+    removed_keys, added_keys = key_counter(removed_keys), key_counter(added_keys)
+    removed_keys, added_keys = removed_keys - added_keys, added_keys - removed_keys
+    if not removed_keys and not added_keys:
+        return None
+    # 调用方可能传入 RealDictCursor，这里在同一连接 (同一事务) 上另开普通游标
+    cur = cur.connection.cursor()
+    try:
+        if not _table_exists(cur, 'schedule_versions'):
+            return None
+        lock_schedule_versions(cur, semester_id)
+        parent_id = _head_version_id(cur, semester_id)
+        if parent_id is None:
+            return None
+        return _insert_version(cur, semester_id, parent_id, 'manual', removed_keys, added_keys)
+    finally:
+        cur.close()
+
+def _version_path(parents, version_id):
+    """从版本回溯到根的版本 ID 列表 (含自身)。"""
+    path = []
+    while version_id is not None:
+        path.append(version_id)
+        version_id = parents[version_id]
+    return path
+
+def _net_version_delta(cur, semester_id, from_version_id, to_version_id):
+    """
+    计算从 from 版本变到 to 版本的净增量 (removed, added 两个键 Counter)。
+    先找两版本的最近公共祖先，只汇总两条支路上的增量: to 一侧按原符号、from 一侧取反，净值非零的键即差异。
+    """
+    cur.execute("SELECT id, parent_id FROM schedule_versions WHERE semester_id = %s", (semester_id,))
+    parents = dict(cur.fetchall())
+    for version_id in (from_version_id, to_version_id):
+        if version_id not in parents:
+            raise ValueError(f"学期 {semester_id} 中不存在版本 {version_id}")
+    from_path = _version_path(parents, from_version_id)
+    to_path = _version_path(parents, to_version_id)
+    common = set(from_path) & set(to_path)
+    from_side = [v for v in from_path if v not in common]
+    to_side = [v for v in to_path if v not in common]
+    if not from_side and not to_side:
+        return Counter(), Counter()
+
+    cur.execute(f"""
+        SELECT {VERSION_KEY_SQL},
+               sum(CASE WHEN op = '+' THEN 1 ELSE -1 END * CASE WHEN version_id = ANY(%s) THEN 1 ELSE -1 END) AS net
+        FROM schedule_version_deltas
+        WHERE version_id = ANY(%s)
+        GROUP BY {VERSION_KEY_SQL}
+        HAVING sum(CASE WHEN op = '+' THEN 1 ELSE -1 END * CASE WHEN version_id = ANY(%s) THEN 1 ELSE -1 END) <> 0
+    """, (to_side, from_side + to_side, to_side))
+    removed, added = Counter(), Counter()
+    for row in cur.fetchall():
+        if row[-1] > 0:
+            added[tuple(row[:-1])] = row[-1]
+        else:
+            removed[tuple(row[:-1])] = -row[-1]
+    return removed, added
+
+def diff_schedule_versions(get_connection_func, semester_id, from_version_id, to_version_id):
+    """
+    比较两个版本，返回 {'added': [...], 'removed': [...], 'moved': [...]}。
+    同一教学任务同一周的一删一增视为调课 (moved)，记录原时间/教室和新时间/教室。
+    """
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        removed, added = _net_version_delta(cur, semester_id, from_version_id, to_version_id)
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+    return summarize_session_diff(removed, added)
+
+def summarize_session_diff(removed, added):
+    """
+    把删除/新增的课时键 (Counter 或键序列) 整理为 {'added', 'removed', 'moved'}，
+    同一教学任务同一周的一删一增视为调课。
+    """
+    def as_dict(key):
+        return dict(zip(VERSION_KEY_COLUMNS, key))
+
+    added_by_session = defaultdict(list)
+    for key in sorted(key_counter(added).elements(), key=lambda k: tuple(-1 if v is None else v for v in k)):
+        added_by_session[(key[6], key[5])].append(key)  # (assignment_id, week_number)
+    moved, removed_only = [], []
+    for key in sorted(key_counter(removed).elements(), key=lambda k: tuple(-1 if v is None else v for v in k)):
+        candidates = added_by_session.get((key[6], key[5]))
+        if candidates:
+            new_key = candidates.pop(0)
+            moved.append({'assignment_id': key[6], 'week_number': key[5], 'major_id': key[0],
+                          'course_id': key[1], 'teacher_id': key[2],
+                          'from': {'timeslot_id': key[4], 'classroom_id': key[3]},
+                          'to': {'timeslot_id': new_key[4], 'classroom_id': new_key[3]}})
+        else:
+            removed_only.append(as_dict(key))
+    added_only = [as_dict(k) for keys in added_by_session.values() for k in keys]
+    return {'added': added_only, 'removed': removed_only, 'moved': moved}
+
+def rollback_schedule_to_version(get_connection_func, semester_id, target_version_id):
+    """
+    把学期课表回滚到指定版本: 只按两版本间的净增量删除/插入相应课时 (O(增量))，不重新排课。
+    回滚本身记为一个 'rollback' 版本。返回 (新版本 ID, 删除数, 插入数)。
+    """
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        try_semester_xact_lock(cur, semester_id)  # 不与正在进行的排课交错写入
+        lock_schedule_versions(cur, semester_id)
+        head_id = _head_version_id(cur, semester_id)
+        if head_id is None:
+            raise ValueError(f"学期 {semester_id} 还没有课表版本")
+        removed, added = _net_version_delta(cur, semester_id, head_id, target_version_id)
+        has_series = _table_exists(cur, 'timetable_entry_series')
+        for key in removed.elements():
+            params = dict(zip(VERSION_KEY_COLUMNS, key))
+            # ctid 只在单个分区内唯一，分区表上必须同时按 tableoid 和 semester_id 定位
+            cur.execute("""
+                DELETE FROM timetable_entries
+                WHERE semester_id = %(semester_id)s AND (tableoid, ctid) = (
+                    SELECT tableoid, ctid FROM timetable_entries
+                    WHERE semester_id = %(semester_id)s AND major_id = %(major_id)s AND course_id = %(course_id)s
+                      AND teacher_id = %(teacher_id)s AND classroom_id IS NOT DISTINCT FROM %(classroom_id)s
+                      AND timeslot_id = %(timeslot_id)s AND week_number = %(week_number)s
+                      AND assignment_id IS NOT DISTINCT FROM %(assignment_id)s
+                    LIMIT 1)
+            """, dict(params, semester_id=semester_id))
+            if cur.rowcount == 0 and has_series:
+                cur.execute("""
+                    UPDATE timetable_entry_series SET weeks = array_remove(weeks, %(week_number)s)
+                    WHERE semester_id = %(semester_id)s AND major_id = %(major_id)s AND course_id = %(course_id)s
+                      AND teacher_id = %(teacher_id)s AND classroom_id IS NOT DISTINCT FROM %(classroom_id)s
+                      AND timeslot_id = %(timeslot_id)s AND assignment_id IS NOT DISTINCT FROM %(assignment_id)s
+                      AND %(week_number)s = ANY(weeks)
+                """, dict(params, semester_id=semester_id))
+        if has_series and removed:
+            cur.execute("DELETE FROM timetable_entry_series WHERE semester_id = %s AND cardinality(weeks) = 0",
+                        (semester_id,))
+        if added:
+            psycopg2.extras.execute_values(cur, f"""
+                INSERT INTO timetable_entries (semester_id, {VERSION_KEY_SQL}) VALUES %s
+            """, [(semester_id,) + k for k in added.elements()])
+        version_id = _insert_version(cur, semester_id, head_id, 'rollback', removed, added)
+        conn.commit()
+        return version_id, sum(removed.values()), sum(added.values())
+    except Exception as e:
+        logger.error("回滚学期 %s 到版本 %s 时出错: %s", semester_id, target_version_id, e,
+                     extra={"event": "version.rollback_failed", "semester_id": semester_id})
+        if conn: conn.rollback()
+        raise
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+def list_schedule_versions(get_connection_func, semester_id):
+    """列出学期的所有版本 (新到旧)，表不存在时返回空列表。"""
+    conn = None
+    cur = None
+    try:
+        conn = get_connection_func()
+        cur = conn.cursor()
+        if not _table_exists(cur, 'schedule_versions'):
+            return []
+        cur.execute("""
+            SELECT id, parent_id, source, created_at, added_count, removed_count
+            FROM schedule_versions WHERE semester_id = %s ORDER BY id DESC
+        """, (semester_id,))
+        columns = [desc[0] for desc in cur.description]
+        return [dict(zip(columns, row)) for row in cur.fetchall()]
+    finally:
+        if cur: cur.close()
+        if conn: conn.close()
+
+
+# ==================================
+# 8.8 进度事件与取消
+# ==================================
+class SchedulingCancelled(Exception):
+    """排课被调用方通过 cancel_event 取消。"""
+
+def emit_progress(progress_callback, event_type, **fields):
+    """向进度回调发送一条结构化事件 (dict)。回调出错只打印，不影响排课。"""
+    if progress_callback is None:
+        return
+    try:
+        progress_callback(dict(type=event_type, time=time.time(), **fields))
+    except Exception as e:
+        logger.warning("进度回调出错: %s", e, extra={"event": "progress.callback_failed"})
+
+def check_cancelled(cancel_event):
+    """协作式取消点: cancel_event 已被设置时抛出 SchedulingCancelled。"""
+    if cancel_event is not None and cancel_event.is_set():
+        raise SchedulingCancelled("排课已被取消")
+
+
+# ==================================
+# 8.9 学期排课锁 (同一学期同时只允许一个排课/回滚)
+# ==================================
+# 会话级 advisory lock 挂在一个专用连接上: 跨进程、跨 Web 实例生效，持锁进程崩溃时连接断开锁即释放。
+SEMESTER_LOCK_NAMESPACE = 'scheduling_run'
+
+class SemesterBusy(Exception):
+    """同一学期已有排课或回滚正在进行。"""
+
+def acquire_semester_lock(get_connection_func, semester_id):
+    """尝试获取学期排课锁 (不等待)。成功返回持锁的连接，锁已被占用返回 None。"""
+    conn = get_connection_func()
+    cur = None
+    try:
+        conn.autocommit = True
+        cur = conn.cursor()
+        cur.execute("SELECT pg_try_advisory_lock(hashtext(%s), %s)", (SEMESTER_LOCK_NAMESPACE, semester_id))
+        locked = cur.fetchone()[0]
+    except Exception:
+        conn.close()
+        raise
+    finally:
+        if cur: cur.close()
+    if not locked:
+        conn.close()
+        return None
+    return conn
+
+def release_semester_lock(lock_conn, semester_id):
+    """释放学期排课锁并关闭持锁连接。"""
+    cur = None
+    try:
+        cur = lock_conn.cursor()
+        cur.execute("SELECT pg_advisory_unlock(hashtext(%s), %s)", (SEMESTER_LOCK_NAMESPACE, semester_id))
+    except Exception as e:
+        logger.warning("释放学期 %s 排课锁时出错 (关闭连接后自动释放): %s", semester_id, e,
+                       extra={"event": "lock.release_failed", "semester_id": semester_id})
+    finally:
+        if cur: cur.close()
+        lock_conn.close()
+
+def try_semester_xact_lock(cur, semester_id):
+    """在当前事务内尝试获取学期排课锁 (事务结束自动释放)，被占用时抛出 SemesterBusy。"""
+    cur.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s), %s)", (SEMESTER_LOCK_NAMESPACE, semester_id))
+    if not cur.fetchone()[0]:
+        raise SemesterBusy(f"学期 {semester_id} 正在排课，请稍后再试")
+
+
+# ==================================
+# 8.10 检查点 (断点续排)
+# ==================================
+# 排课过程中定期把已完成专业的结果、占用状态和随机数状态写到本地文件 (gzip + JSON，不用 pickle:
+# 读取检查点不会执行任何代码)。目录必须是只有当前用户可访问的私有目录 (见 private_storage)。
+# 进程中途退出后再次排课时，若输入数据未变 (指纹一致) 就从最近的检查点继续，结果与一次排完相同。
+SCHEDULING_CHECKPOINT_DIR = (os.environ.get('SCHEDULING_CHECKPOINT_DIR')
+                             or private_storage.default_directory('checkpoints'))
+DEFAULT_CHECKPOINT_INTERVAL = float(os.environ.get('SCHEDULING_CHECKPOINT_INTERVAL', '30'))  # 秒，0 表示不写检查点
+CHECKPOINT_FORMAT_VERSION = 3  # 2: 冲突改为 ConflictLog；3: gzip + JSON
+
+def _result_to_checkpoint(result):
+    if result is None:
+        return None
+    schedule = result.get('schedule')
+    if not isinstance(schedule, ScheduleFrame):
+        schedule = ScheduleFrame.from_entries(schedule or [])
+    return {'schedule': schedule.to_column_lists(),
+            'unscheduled_details': result.get('unscheduled_details', []),
+            'conflicts': [list(record) for record in result.get('conflicts') or ()]}
+
+def _result_from_checkpoint(data):
+    if data is None:
+        return None
+    return {'schedule': ScheduleFrame.from_column_lists(data['schedule']),
+            'unscheduled_details': data['unscheduled_details'],
+            'conflicts': ConflictLog.from_records(data['conflicts'])}
+
+def _rng_state_to_checkpoint(state):
+    version, internal_state, gauss_next = state
+    return [version, list(internal_state), gauss_next]
+
+def _rng_state_from_checkpoint(data):
+    version, internal_state, gauss_next = data
+    return version, tuple(internal_state), gauss_next
+
+def compute_run_fingerprint(semester, sorted_major_ids, assignment_fingerprints, all_data, timetable_state,
+                            storage_mode):
+    """
+    排课输入的指纹: 学期、专业顺序、教学任务指纹、教室、时间段和排课前的占用状态 (固定条目/增量保留的课表)。
+    任一项变化时旧检查点作废。
+    """
+    digest = hashlib.md5()
+    for part in (
+            (semester.id, semester.total_weeks, storage_mode),
+            tuple(sorted_major_ids),
+            sorted((aid, fp) for aid, fp in assignment_fingerprints.items()),
+            sorted((c.id, c.capacity, c.type) for c in all_data['classrooms'].values()),
+            sorted(all_data['timeslots'].keys()),
+            sorted((key, sorted(values)) for key, values in timetable_state.items())):
+        digest.update(repr(part).encode('utf-8'))
+    return digest.hexdigest()
+
+class SchedulingCheckpoint:
+    """
+    一个学期的排课检查点目录: 每次保存追加一个结果分段 (只含上次保存后完成的专业)，
+    再原子替换 state 文件 (指纹、分段数、占用状态、随机数状态)。state 没有引用的分段会被忽略。
+    """
+
+    def __init__(self, semester_id, fingerprint, interval=DEFAULT_CHECKPOINT_INTERVAL, directory=None, rng=None):
+        self.root = directory or SCHEDULING_CHECKPOINT_DIR
+        self.rng = rng if rng is not None else random  # 本次排课的随机数生成器，保存其状态
+        self.directory = os.path.join(self.root, f"semester_{semester_id}")
+        self.fingerprint = fingerprint
+        self.interval = interval
+        self._pending = []  # 上次保存之后完成的专业结果
+        self._segments = 0
+        self._completed = 0
+        self._last_saved = time.monotonic()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _ensure_directory(self):
+        """检查 (并创建) 私有根目录和本学期目录；根目录不安全时抛出 PermissionError。"""
+        private_storage.ensure_private_directory(self.root)
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+
+    def _read(self, name):
+        with gzip.open(self._path(name), 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _write(self, name, obj):
+        tmp_path = self._path(name + '.tmp')
+        with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=1) as f:
+            json.dump(obj, f, separators=(',', ':'))
+        os.replace(tmp_path, self._path(name))
+
+    def load(self):
+        """读取检查点。返回 (已完成专业结果列表, 占用状态, 随机数状态)；没有可用检查点 (不存在/损坏/指纹不符) 返回 None。"""
+        try:
+            if not os.path.isdir(self.directory):
+                return None
+            self._ensure_directory()
+            state = self._read('state.json.gz')
+            if state.get('format') != CHECKPOINT_FORMAT_VERSION or state.get('fingerprint') != self.fingerprint:
+                logger.warning("检查点 %s 与当前输入不一致，忽略", self.directory, extra={"event": "checkpoint.mismatch"})
+                return None
+            completed = []
+            for i in range(state['segments']):
+                completed.extend((major_id, major_name, _result_from_checkpoint(result))
+                                 for major_id, major_name, result in self._read(f'segment_{i:05d}.json.gz'))
+            timetable_state = {key: set(map(tuple, values)) for key, values in state['timetable_state'].items()}
+            rng_state = _rng_state_from_checkpoint(state['rng_state'])
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning("读取检查点 %s 失败，忽略: %s", self.directory, e, extra={"event": "checkpoint.read_failed"})
+            return None
+        self._segments = state['segments']
+        self._completed = len(completed)
+        logger.info("从检查点恢复，已完成专业 %s 个", len(completed), extra={"event": "checkpoint.resumed",
+                                                                   "completed_majors": len(completed)})
+        return completed, timetable_state, rng_state
+
+    def record(self, major_id, major_name, schedule_result_obj, timetable_state, force=False):
+        """登记一个刚完成的专业；距上次保存超过 interval 秒 (或 force) 时保存检查点。"""
+        self._pending.append((major_id, major_name, schedule_result_obj))
+        if force or time.monotonic() - self._last_saved >= self.interval:
+            self.save(timetable_state)
+
+    def save(self, timetable_state):
+        if not self._pending:
+            return
+        try:
+            self._ensure_directory()
+            self._write(f'segment_{self._segments:05d}.json.gz',
+                        [[major_id, major_name, _result_to_checkpoint(result)]
+                         for major_id, major_name, result in self._pending])
+            self._write('state.json.gz', {
+                'format': CHECKPOINT_FORMAT_VERSION,
+                'fingerprint': self.fingerprint,
+                'segments': self._segments + 1,
+                'completed': self._completed + len(self._pending),
+                'timetable_state': {key: [list(item) for item in values] for key, values in timetable_state.items()},
+                # 必须紧跟在专业完成之后保存，中间不能再消耗随机数
+                'rng_state': _rng_state_to_checkpoint(self.rng.getstate()),
+                'saved_at': time.time(),
+            })
+        except Exception as e:
+            # 检查点只是加速恢复，写失败不影响本次排课
+            logger.warning("写检查点 %s 失败: %s", self.directory, e, extra={"event": "checkpoint.write_failed"})
+            return
+        self._segments += 1
+        self._completed += len(self._pending)
+        self._pending = []
+        self._last_saved = time.monotonic()
+
+    def discard(self):
+        """排课完成或取消后删除检查点目录。"""
+        if not os.path.isdir(self.directory):
+            return
+        try:
+            self._ensure_directory()
+        except PermissionError as e:
+            logger.warning("检查点目录不安全，不做清理: %s", e, extra={"event": "checkpoint.unsafe_directory"})
+            return
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+        try:
+            os.rmdir(self.directory)
+        except OSError:
+            pass
+
+
+# ==================================
+# 8.11 排课统计 (分阶段耗时与热点计数)
+# ==================================
+class SchedulerStats:
+    """
+    一次排课的统计: 每个阶段/每个专业的墙钟时间和 CPU 时间 (当前线程)，以及热点函数的调用计数
+    (check_constraints 按失败原因、find_available_classroom 的扫描量、候选池重新洗牌次数等)。
+    计数只是整数累加，开销可以忽略；结果通过 to_dict() 放进排课摘要。
+    memory (MemoryTracker) 不为 None 时，顶层阶段 (MEMORY_PHASES) 额外记录内存峰值和留存增量，
+    每个专业记录排完后留存的内存增量。
+    """
+
+    def __init__(self, memory=None):
+        self.phases = {}
+        self.majors = {}
+        self.counters = defaultdict(int)
+        self.memory = memory
+
+    @staticmethod
+    def clock():
+        """返回 (墙钟, CPU, tracemalloc 当前字节数) 起点，交给 record() 计算耗时。"""
+        return time.perf_counter(), time.thread_time(), tracemalloc.get_traced_memory()[0]
+
+    def record(self, name, started, major_id=None, major_name=None):
+        """把从 started 到现在的耗时计入阶段 name；给出 major_id 时同时计入该专业的分阶段耗时。"""
+        wall = time.perf_counter() - started[0]
+        cpu = time.thread_time() - started[1]
+        target = self.phases.setdefault(name, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "calls": 0})
+        target["wall_seconds"] += wall
+        target["cpu_seconds"] += cpu
+        target["calls"] += 1
+        if self.memory is not None and name in MEMORY_PHASES:
+            peak_bytes, retained_bytes = self.memory.end_phase(started[2])
+            target["peak_mb"] = round(max(target.get("peak_mb", 0.0), peak_bytes / 2 ** 20), 3)
+            target["retained_mb"] = round(target.get("retained_mb", 0.0) + retained_bytes / 2 ** 20, 3)
+        if major_id is not None:
+            major = self.majors.setdefault(major_id, {"name": major_name, "wall_seconds": 0.0, "cpu_seconds": 0.0,
+                                                      "phases": {}})
+            if major_name is not None:
+                major["name"] = major_name
+            if name == 'major':
+                major["wall_seconds"] += wall
+                major["cpu_seconds"] += cpu
+                if self.memory is not None:
+                    major["retained_mb"] = round((tracemalloc.get_traced_memory()[0] - started[2]) / 2 ** 20, 3)
+            else:
+                major["phases"][name] = round(major["phases"].get(name, 0.0) + wall, 6)
+        return wall, cpu
+
+    @contextlib.contextmanager
+    def phase(self, name, major_id=None, major_name=None):
+        started = self.clock()
+        try:
+            yield
+        finally:
+            self.record(name, started, major_id=major_id, major_name=major_name)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def to_dict(self):
+        def rounded(d):
+            return {k: (round(v, 6) if isinstance(v, float) else v) for k, v in d.items()}
+        return {
+            "phases": {name: rounded(v) for name, v in self.phases.items()},
+            "majors": {str(major_id): rounded(v) for major_id, v in self.majors.items()},
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+
+# ==================================
+# 8.12 内存统计与预算
+# ==================================
+# 用 tracemalloc 统计排课过程中 Python 对象占用的内存: 各顶层阶段的峰值、每个专业留存的增量，
+# 以及内存占用最高时的主要分配位置 (代码行)。tracemalloc 只统计开始跟踪之后的 Python 分配 (不含解释器
+# 本身、C 扩展的私有分配和预先加载好的 all_data)，数值比进程 RSS 小，但能定位到具体代码。
+# 跟踪会让内存分配明显变慢 (约 1.5-3 倍)，只在要求统计 (track_memory) 或设置了内存预算时开启。
+# 设置预算后: 超过 MEMORY_SOFT_RATIO 时改为流式写库 (已排好的条目立即写入暂存表并释放)；
+# 超过 MEMORY_ABORT_RATIO 时中止排课，正式课表不变，检查点保留 (提高预算后可以续排)。
+# tracemalloc 是整个进程共享的: 同一进程里同时统计的几次排课共用一次跟踪 (引用计数，最后一个结束时才停止)，
+# 统计到的是进程内所有线程的分配。因此内存预算只应在独立的排课进程里设置 (后台任务子进程、命令行)，
+# Web 进程内的同步排课 (?wait=1) 不接受预算，只能统计 (track_memory，数值包含其他请求的分配)。
+DEFAULT_MEMORY_BUDGET_MB = float(os.environ.get('SCHEDULING_MEMORY_BUDGET_MB', '0'))  # 0 表示不设预算
+MEMORY_SOFT_RATIO = 0.6
+MEMORY_ABORT_RATIO = 0.9
+MEMORY_TOP_SITES = 10  # 摘要中列出的分配位置数
+MEMORY_PHASES = ('load_data', 'prepare', 'solve', 'write')
+
+
+class MemoryBudgetExceeded(Exception):
+    """排课占用的内存接近预算，主动中止。"""
+
+
+_tracing_lock = threading.Lock()
+_tracing_users = 0  # 正在统计的 MemoryTracker 数
+_tracing_started_here = False  # 跟踪是否由 MemoryTracker 开启 (PYTHONTRACEMALLOC 等外部开启的跟踪不由这里停止)
+
+
+def _acquire_tracing():
+    global _tracing_users, _tracing_started_here
+    with _tracing_lock:
+        if _tracing_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracing_started_here = True
+        _tracing_users += 1
+
+
+def _release_tracing():
+    global _tracing_users, _tracing_started_here
+    with _tracing_lock:
+        _tracing_users -= 1
+        if _tracing_users == 0 and _tracing_started_here:
+            tracemalloc.stop()
+            _tracing_started_here = False
+
+
+class MemoryTracker:
+    """
+    一次排课的 tracemalloc 统计和预算检查。start()/stop() 对进程内的跟踪做引用计数，
+    同时进行的几次统计互不关闭对方的跟踪；阶段峰值在并发统计时会互相影响，只作参考。
+    """
+
+    def __init__(self, budget_mb=None, top_sites=MEMORY_TOP_SITES):
+        self.budget_bytes = int(budget_mb * 2 ** 20) if budget_mb else None
+        self.top_sites = top_sites
+        self.peak_bytes = 0
+        self.actions = []  # 预算触发的降级措施
+        self.budget_exceeded = False
+        self._top_allocations = []
+        self._snapshot_bytes = -1
+        self._tracing = False
+
+    def start(self):
+        if not self._tracing:
+            _acquire_tracing()
+            self._tracing = True
+        tracemalloc.reset_peak()
+        return self
+
+    def stop(self):
+        if self._tracing:
+            self._tracing = False
+            _release_tracing()
+
+    def end_phase(self, started_bytes):
+        """顶层阶段结束: 返回 (阶段内峰值, 留存增量) 字节数。留存最多时拍一次快照，用于列出分配位置。"""
+        current, peak = tracemalloc.get_traced_memory()
+        self.peak_bytes = max(self.peak_bytes, peak)
+        self._take_snapshot(current)
+        tracemalloc.reset_peak()  # 顶层阶段依次执行，下一阶段的峰值从这里算起 (不含拍快照的临时内存)
+        return peak, current - started_bytes
+
+    def _take_snapshot(self, current):
+        """当前留存超过上次快照时重新统计分配位置。只保留前 top_sites 条，快照本身随即释放，不计入后续阶段。"""
+        if current <= self._snapshot_bytes or not tracemalloc.is_tracing():
+            return
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        self._top_allocations = [
+            {"site": f"{os.path.basename(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+             "size_mb": round(stat.size / 2 ** 20, 3), "count": stat.count}
+            for stat in snapshot.statistics('lineno')[:self.top_sites]]
+        self._snapshot_bytes = current
+
+    def check(self):
+        """
+        预算检查: 当前占用超过中止线时拍快照并抛出 MemoryBudgetExceeded，超过软限制时返回 True。
+        没有设置预算时总是返回 False。
+        """
+        if self.budget_bytes is None:
+            return False
+        current, peak = tracemalloc.get_traced_memory()
+        self.peak_bytes = max(self.peak_bytes, peak)
+        if current >= self.budget_bytes * MEMORY_ABORT_RATIO:
+            self.budget_exceeded = True
+            self._take_snapshot(current)
+            raise MemoryBudgetExceeded(
+                f"排课占用内存 {current / 2 ** 20:.1f} MB，已接近内存预算 {self.budget_bytes / 2 ** 20:.1f} MB "
+                f"(中止线 {MEMORY_ABORT_RATIO:.0%})，排课已中止，正式课表保持不变。")
+        return current >= self.budget_bytes * MEMORY_SOFT_RATIO
+
+    def note_action(self, action):
+        if action not in self.actions:
+            self.actions.append(action)
+            logger.warning("内存占用超过预算的 %.0f%%，%s", MEMORY_SOFT_RATIO * 100, action, extra={"event": "memory.degraded",
+                                                                                   "action": action})
+
+    def to_dict(self):
+        return {
+            "budget_mb": round(self.budget_bytes / 2 ** 20, 1) if self.budget_bytes else None,
+            "peak_mb": round(self.peak_bytes / 2 ** 20, 3),
+            "snapshot_mb": round(max(self._snapshot_bytes, 0) / 2 ** 20, 3),
+            "actions": list(self.actions),
+            "budget_exceeded": self.budget_exceeded,
+            "top_allocations": list(self._top_allocations),  # 留存最多时 (或中止时) 的主要分配位置
+        }
+
+
 # ==================================
 # 9. 主排课流程函数 (保持不变)
 # ==================================
@@ -951,34 +2890,189 @@ import random
 # Assume necessary classes (Course, Major, etc.) and functions are defined elsewhere and correctly imported.
 # Assume get_connection_func returns a standard DB-API 2 connection object.
 
-def run_full_scheduling_process(target_semester_id, get_connection_func):
+def sort_major_ids(major_ids, all_data):
+    """按专业名称排序 (排课顺序)，找不到的专业排在按 ID 生成的占位名处。"""
+    def get_major_sort_key(major_id):
+        major = all_data['majors'].get(major_id)
+        return (major.name if major else f"未知专业ID_{major_id}", major_id)  # 重名时按 ID，保证顺序确定
+    return sorted(list(major_ids), key=get_major_sort_key)
+
+def solve_majors_in_memory(all_data, current_semester, assignments_by_major, major_ids, timetable_state,
+                           pinned_sessions=None, progress_callback=None, stats=None, rng=None):
     """
-    主排课流程函数，被 Flask API 调用。
+    按给定顺序逐个专业排课，只在内存中进行 (不读写数据库)，timetable_state 会被更新。
+    逐个产出 (major_id, major_name, 排课结果)，专业没有教学任务时排课结果为 None。
+    stats (SchedulerStats) 记录每个专业的模板生成/第一周/复制耗时和热点计数，不包含调用方处理产出结果的时间。
+    rng 为本次排课的 random.Random 实例，各专业依次消耗其随机数。
+    """
+    for major_id in major_ids:
+        current_major = all_data['majors'].get(major_id)
+        assignments_for_this_major = assignments_by_major.get(major_id, {})
+        major_name = current_major.name if current_major else f"未知专业ID_{major_id}"
+        if not assignments_for_this_major:
+            yield major_id, major_name, None
+            continue
+
+        major_started = SchedulerStats.clock()
+        template_started = SchedulerStats.clock()
+        initial_template_dp, unscheduled_pool = generate_initial_template(assignments_for_this_major, all_data, rng=rng)
+        if stats is not None:
+            stats.record('template', template_started, major_id=major_id, major_name=major_name)
+        major_obj_for_scheduling = current_major if current_major else type('MajorDummy', (object,), {'id': major_id, 'name': major_name})()
+
+        # Call the MODIFIED scheduling function
+        schedule_result_obj = schedule_with_generated_template(
+            assignments_for_this_major, current_semester,
+            major_obj_for_scheduling,
+            all_data, initial_template_dp, unscheduled_pool,
+            timetable_state,  # Pass and update global state
+            pinned_sessions=pinned_sessions,
+            progress_callback=progress_callback,
+            stats=stats,
+            rng=rng
+        )
+        if stats is not None:
+            stats.record('major', major_started, major_id=major_id, major_name=major_name)
+        yield major_id, major_name, schedule_result_obj
+
+def accumulate_major_result(summary, major_id, major_name, schedule_result_obj):
+    """把一个专业的排课结果计入摘要 (条目数、冲突数、未完成任务数和明细)。"""
+    num_scheduled_major = len(schedule_result_obj.get('schedule', []))
+    conflicts_major = schedule_result_obj.get('conflicts') or ConflictLog()
+    num_conflicts_major = conflicts_major.weeks() # 冲突周次数 (第一周模板和模板复制)
+    num_uncompleted_major = len(schedule_result_obj.get('unscheduled_details', []))
+
+    summary["processed_majors"] += 1
+    summary["total_scheduled_entries"] += num_scheduled_major
+    summary["total_conflicts"] += num_conflicts_major
+    summary["conflict_records"] += len(conflicts_major)
+    summary["conflicts"].extend(conflicts_major)
+    summary["total_uncompleted_tasks"] += num_uncompleted_major
+
+    major_detail_msg = f"专业 '{major_name}' (ID: {major_id}): 生成课表 {num_scheduled_major}条, 记录冲突 {num_conflicts_major}次。"
+    if num_uncompleted_major > 0:
+         major_detail_msg += f" 未完成任务 {num_uncompleted_major}个。"
+    summary["details"].append(major_detail_msg)
+
+def run_full_scheduling_process(target_semester_id, get_connection_func, streaming=False, storage_mode='rows',
+                                incremental=False, progress_callback=None, cancel_event=None,
+                                checkpoint_interval=None, resume=True, all_data=None, profile=None,
+                                memory_budget_mb=None, track_memory=False, seed=None):
+    """
+    主排课流程入口: 先获取学期排课锁，同一学期已有排课在进行 (任何进程) 时直接返回 status='busy'，
+    不会重复清理/写入课表。拿到锁后执行 _run_full_scheduling_process_locked。
+    profile 为 profiling.arm() 返回的分析请求 (后台任务由 Web 进程取走后传入)；为 None 时使用本进程中
+    布置的 'scheduling' 分析 (没有布置则不分析)。
+    执行了的排课在摘要中附带 duration_seconds (拿到锁之后的总耗时)。
+    """
+    try:
+        lock_conn = acquire_semester_lock(get_connection_func, target_semester_id)
+    except Exception as e:
+        logger.error("获取学期 %s 排课锁失败: %s", target_semester_id, e,
+                     extra={"event": "lock.acquire_failed", "semester_id": target_semester_id})
+        return {"status": "error", "message": f"获取学期排课锁失败: {e}", "details": []}
+    if lock_conn is None:
+        logger.info("学期 %s 已有排课正在进行，本次请求未执行", target_semester_id,
+                    extra={"event": "run.busy", "semester_id": target_semester_id})
+        return {"status": "busy", "message": f"学期 {target_semester_id} 已有排课正在进行，请稍后再试。",
+                "details": []}
+    run_kwargs = dict(streaming=streaming, storage_mode=storage_mode, incremental=incremental,
+                      progress_callback=progress_callback, cancel_event=cancel_event,
+                      checkpoint_interval=checkpoint_interval, resume=resume, all_data=all_data,
+                      memory_budget_mb=memory_budget_mb, track_memory=track_memory, seed=seed)
+    started = time.perf_counter()
+    try:
+        if profile is None:
+            profile = profiling.take('scheduling')  # 拿到锁之后再取，busy 的请求不会用掉布置的分析
+        if profile is not None:
+            summary = profiling.run_profiled(profile, f"排课 学期 {target_semester_id}",
+                                             _run_full_scheduling_process_locked, target_semester_id,
+                                             get_connection_func, **run_kwargs)
+        else:
+            summary = _run_full_scheduling_process_locked(target_semester_id, get_connection_func, **run_kwargs)
+        summary["duration_seconds"] = round(time.perf_counter() - started, 3)
+        logger.info("学期 %s 排课结束，状态 %s", target_semester_id, summary.get('status'),
+                    extra={"event": "run.finished", "semester_id": target_semester_id, "status": summary.get("status"),
+                           "mode": summary.get("mode"), "duration_seconds": summary["duration_seconds"],
+                           "entries": summary.get("total_scheduled_entries"),
+                           "uncompleted": summary.get("total_uncompleted_tasks")})
+        return summary
+    finally:
+        release_semester_lock(lock_conn, target_semester_id)
+
+
+def _run_full_scheduling_process_locked(target_semester_id, get_connection_func, streaming=False,
+                                        storage_mode='rows', incremental=False, progress_callback=None,
+                                        cancel_event=None, checkpoint_interval=None, resume=True, all_data=None,
+                                        memory_budget_mb=None, track_memory=False, seed=None):
+    """
+    主排课流程函数 (调用方已持有学期排课锁)。
     返回一个包含排课结果摘要的字典。
     在排课完成后（无论成功或失败）尝试更新所有教师偏好状态。
+    streaming=True 时每排完一个专业就交给后台写库线程写入 (同一事务)，
+    不再在内存中累积整个学期的课表。
+    storage_mode='series' 时按模板时段压缩存储 (每个时段一行 + 周次列表)，读取时再展开。
+    incremental=True 时与上次排课的教学任务快照对比，只重排受影响的专业，其余专业的课表原样保留
+    (并作为占用状态参与约束检查)；没有快照时退回完整排课。
+    progress_callback(event_dict) 接收阶段/专业进度事件；cancel_event (threading/multiprocessing Event)
+    被设置后在下一个检查点停止，正式课表保持不变，返回 status='cancelled'。
+    checkpoint_interval 秒写一次检查点 (None 取 DEFAULT_CHECKPOINT_INTERVAL，0 不写)；resume=True 时
+    若有输入一致的检查点 (上次排课中途退出)，已完成的专业直接复用，从检查点继续排课。
+    all_data 为调用方预先加载的基础数据 (批量排课时各学期共用，只读)，为 None 时从数据库加载。
+    摘要中的 stats 为分阶段/分专业的耗时和热点计数 (见 SchedulerStats)。
+    memory_budget_mb 为内存预算 (None 取 DEFAULT_MEMORY_BUDGET_MB，0 不设预算)，track_memory=True 时
+    不设预算也统计内存；两者之一生效时摘要中附带 memory (峰值、降级措施、主要分配位置，见 MemoryTracker)，
+    超出预算中止时 status='memory_budget_exceeded'。
+    seed 为本次排课专用的 random.Random 的种子 (None 时不可复现)，检查点保存并恢复该实例的状态。
     """
-    print(f"SCHEDULER: 开始执行学期 ID {target_semester_id} 的自动排课程序...")
+    logger.info("开始执行学期 ID %s 的自动排课程序", target_semester_id,
+                extra={"event": "run.started", "semester_id": target_semester_id, "incremental": incremental,
+                       "storage_mode": storage_mode, "streaming": streaming})
     summary = {
         "status": "failure",
         "message": "",
         "processed_majors": 0,
         "total_scheduled_entries": 0,
-        "total_conflicts": 0, # Note: Conflicts now primarily reflect Week 1 issues or inter-major conflicts during replication
+        "total_conflicts": 0, # 冲突周次数 (第一周模板和模板复制)
+        "conflict_records": 0, # 合并周次范围后的冲突记录条数
         "total_uncompleted_tasks": 0,
         "db_records_cleared": 0,
         "db_records_saved": 0,
-        "details": []  # For per-major messages or errors
+        "storage_mode": storage_mode,
+        "mode": "full",
+        "rescheduled_majors": [],
+        "resumed_majors": 0,
+        "details": [],  # For per-major messages or errors
+        "conflicts": []  # ConflictRecord 列表，文字说明由 describe_conflicts() 按需生成
     }
 
-    all_data = None
     all_assignments_in_semester = defaultdict(dict)
+    stream_writer = None
+    staging_table = None
+    checkpoint = None
+    solve_finished = False
+    if checkpoint_interval is None:
+        checkpoint_interval = DEFAULT_CHECKPOINT_INTERVAL
+    if memory_budget_mb is None:
+        memory_budget_mb = DEFAULT_MEMORY_BUDGET_MB
+    memory = MemoryTracker(memory_budget_mb).start() if memory_budget_mb or track_memory else None
+    stats = SchedulerStats(memory=memory)
+    rng = random.Random(seed)  # 本次排课专用，不与进程内其他排课共享全局随机数状态
 
     try:
-        all_data = load_data_from_db(get_connection_func)
+        emit_progress(progress_callback, 'phase', phase='load_data', status='started', preloaded=all_data is not None)
+        if all_data is None:
+            with stats.phase('load_data'):
+                all_data = load_data_from_db(get_connection_func)
         if not all_data:
             summary["message"] = "数据加载失败。"
             return summary # Finally block will still run
+        emit_progress(progress_callback, 'phase', phase='load_data', status='finished')
+        check_cancelled(cancel_event)
+        if memory is not None:
+            memory.check()
 
+        phase_started = SchedulerStats.clock()  # prepare: 分组、指纹、固定条目、增量对比、检查点
         current_semester = all_data['semesters'].get(target_semester_id)
         if not current_semester:
             summary["message"] = f"未找到 ID 为 {target_semester_id} 的学期信息。"
@@ -998,83 +3092,202 @@ def run_full_scheduling_process(target_semester_id, get_connection_func):
             summary["status"] = "success_no_tasks"
             return summary # Finally block will still run
 
-        clear_success, cleared_count = clear_db_for_semester(target_semester_id, get_connection_func)
-        summary["db_records_cleared"] = cleared_count
-        if not clear_success:
-             summary["message"] = "清空旧排课记录失败。"
-             summary["status"] = "error"
-             return summary # Finally block will still run
-
-        all_final_schedule_entries_for_semester = []
+        current_fingerprints = compute_assignment_fingerprints(
+            {aid: a for major_assigns in all_assignments_in_semester.values() for aid, a in major_assigns.items()},
+            all_data)
         master_global_timetable_state = {'teacher_schedule': set(), 'classroom_schedule': set(), 'major_schedule': set()}
 
-        # Define a safe sort key function
-        def get_major_sort_key(major_id):
-            major = all_data['majors'].get(major_id)
-            return major.name if major else f"未知专业ID_{major_id}"
-
-        sorted_major_ids = sorted(list(majors_in_semester), key=get_major_sort_key)
-
-        for major_id in sorted_major_ids:
-            current_major = all_data['majors'].get(major_id)
-            assignments_for_this_major = all_assignments_in_semester.get(major_id, {})
-            major_name = current_major.name if current_major else f"未知专业ID_{major_id}"
-
-            major_detail_msg = f"专业 '{major_name}' (ID: {major_id}): "
-            if not assignments_for_this_major:
-                major_detail_msg += "没有教学任务，跳过。"
-                summary["details"].append(major_detail_msg)
+        # 固定条目先占位，排课只处理剩余课时
+        pinned_entries = load_pinned_entries(get_connection_func, target_semester_id)
+        seed_timetable_state(master_global_timetable_state, pinned_entries)
+        pinned_sessions = count_pinned_sessions(pinned_entries)
+        summary["pinned_entries"] = len(pinned_entries)
+
+        affected_majors = None  # None 表示完整排课
+        if incremental:
+            previous_fingerprints = load_assignment_snapshot(get_connection_func, target_semester_id)
+            if previous_fingerprints is None:
+                logger.info("学期 %s 没有上次排课的快照，改为完整排课", target_semester_id,
+                            extra={"event": "run.incremental_fallback", "semester_id": target_semester_id})
+                summary["details"].append("没有上次排课的快照，已执行完整排课。")
+            else:
+                affected_majors = find_affected_majors(previous_fingerprints, current_fingerprints)
+                summary["mode"] = "incremental"
+                if not affected_majors:
+                    summary["status"] = "success"
+                    summary["message"] = f"学期 {target_semester_id} 的教学任务自上次排课以来没有变化，课表保持不变。"
+                    return summary # Finally block will still run
+                # 未受影响专业的现有课表 (含手动调整) 保持不动，先登记到占用状态中
+                seed_conn = get_connection_func()
+                try:
+                    existing_entries = load_schedule_entries(seed_conn, target_semester_id)
+                finally:
+                    seed_conn.close()
+                seed_timetable_state(master_global_timetable_state,
+                                     (e for e in iter_expanded_entries(existing_entries)
+                                      if e.major_id not in affected_majors))
+                logger.info("增量排课，需要重排的专业: %s", sorted(affected_majors),
+                            extra={"event": "run.incremental", "semester_id": target_semester_id,
+                                   "affected_majors": len(affected_majors)})
+
+        all_final_schedule_entries_for_semester = ScheduleFrame()
+        series_entries_for_semester = []  # storage_mode='series' 时使用
+        if affected_majors is None:
+            # 不再先清空旧课表: 结果写入暂存表，全部完成后再原子替换
+            staging_table = create_staging_table(target_semester_id, get_connection_func)
+            if streaming and storage_mode != 'series':
+                stream_writer = ScheduleStreamWriter(get_connection_func, table_name=staging_table).start()
+
+        majors_to_schedule = majors_in_semester if affected_majors is None else majors_in_semester & affected_majors
+        sorted_major_ids = sort_major_ids(majors_to_schedule, all_data)
+        summary["rescheduled_majors"] = sorted_major_ids
+
+        resumed_results = []
+        if checkpoint_interval > 0:
+            checkpoint = SchedulingCheckpoint(target_semester_id, compute_run_fingerprint(
+                current_semester, sorted_major_ids, current_fingerprints, all_data, master_global_timetable_state,
+                storage_mode), interval=checkpoint_interval, rng=rng)
+            restored = checkpoint.load() if resume else None
+            if restored is None:
+                checkpoint.discard()  # 清掉过期的检查点，避免新旧分段混在一起
+            else:
+                resumed_results, master_global_timetable_state, rng_state = restored
+                rng.setstate(rng_state)
+                summary["resumed_majors"] = len(resumed_results)
+                summary["details"].append(f"从检查点恢复，复用已完成的专业 {len(resumed_results)} 个。")
+        remaining_major_ids = sorted_major_ids[len(resumed_results):]
+        stats.record('prepare', phase_started)
+        if memory is not None:
+            memory.check()
+
+        emit_progress(progress_callback, 'phase', phase='solve', status='started', total_majors=len(sorted_major_ids),
+                      resumed=len(resumed_results))
+        solved_majors = 0
+        phase_started = SchedulerStats.clock()
+        for major_id, major_name, schedule_result_obj in itertools.chain(resumed_results, solve_majors_in_memory(
+                all_data, current_semester, all_assignments_in_semester, remaining_major_ids,
+                master_global_timetable_state, pinned_sessions=pinned_sessions,
+                progress_callback=progress_callback, stats=stats, rng=rng)):  # Global state is updated inside
+            solved_majors += 1
+            if checkpoint is not None and solved_majors > len(resumed_results):
+                with stats.phase('checkpoint'):
+                    checkpoint.record(major_id, major_name, schedule_result_obj, master_global_timetable_state)
+            if schedule_result_obj is not None:
+                major_stats = stats.majors.get(major_id, {})  # 从检查点恢复的专业没有耗时
+                emit_progress(progress_callback, 'major', index=solved_majors, total=len(sorted_major_ids),
+                              major_id=major_id, major_name=major_name,
+                              scheduled=len(schedule_result_obj.get('schedule', [])),
+                              conflicts=(schedule_result_obj.get('conflicts') or ConflictLog()).weeks(),
+                              uncompleted=len(schedule_result_obj.get('unscheduled_details', [])),
+                              wall_seconds=round(major_stats.get('wall_seconds', 0.0), 6),
+                              cpu_seconds=round(major_stats.get('cpu_seconds', 0.0), 6))
+            check_cancelled(cancel_event)  # 每排完一个专业检查一次
+            if schedule_result_obj is None:
+                summary["details"].append(f"专业 '{major_name}' (ID: {major_id}): 没有教学任务，跳过。")
                 continue
 
-            initial_template_dp, unscheduled_pool = generate_initial_template(assignments_for_this_major, all_data)
-            major_obj_for_scheduling = current_major if current_major else type('MajorDummy', (object,), {'id': major_id, 'name': major_name})()
-
-            # Call the MODIFIED scheduling function
-            schedule_result_obj = schedule_with_generated_template(
-                assignments_for_this_major, current_semester,
-                major_obj_for_scheduling,
-                all_data, initial_template_dp, unscheduled_pool,
-                master_global_timetable_state  # Pass and update global state
-            )
-
             major_schedule = schedule_result_obj.get('schedule', [])
-            all_final_schedule_entries_for_semester.extend(major_schedule)
-            # Global state is updated inside the function now
-
-            num_scheduled_major = len(major_schedule)
-            major_conflicts_log = schedule_result_obj.get('conflicts', []) # Now reflects W1/replication conflicts
-            num_conflicts_major = len(major_conflicts_log)
-            major_unscheduled_details = schedule_result_obj.get('unscheduled_details', [])
-            num_uncompleted_major = len(major_unscheduled_details)
-
-            summary["processed_majors"] += 1
-            summary["total_scheduled_entries"] += num_scheduled_major
-            summary["total_conflicts"] += num_conflicts_major
-            summary["total_uncompleted_tasks"] += num_uncompleted_major
-
-            major_detail_msg += f"生成课表 {num_scheduled_major}条, 记录冲突 {num_conflicts_major}次。"
-            if num_uncompleted_major > 0:
-                 major_detail_msg += f" 未完成任务 {num_uncompleted_major}个。"
-            summary["details"].append(major_detail_msg)
-
-        if all_final_schedule_entries_for_semester:
-            saved_count_total = save_schedule_to_db(all_final_schedule_entries_for_semester, get_connection_func)
-            summary["db_records_saved"] = saved_count_total
+            if storage_mode == 'series':
+                series_entries_for_semester.extend(compress_schedule_entries(major_schedule))
+            elif stream_writer:
+                stream_writer.put(major_schedule)  # 队列满时在此阻塞，等待写库线程
+            else:
+                all_final_schedule_entries_for_semester.extend(major_schedule)
+            accumulate_major_result(summary, major_id, major_name, schedule_result_obj)
+
+            # 内存预算: 接近中止线时抛出 MemoryBudgetExceeded；超过软限制时把内存中累积的条目改为流式写库
+            if memory is not None and memory.check() and staging_table and storage_mode != 'series' \
+                    and stream_writer is None:
+                stream_writer = ScheduleStreamWriter(get_connection_func, table_name=staging_table).start()
+                stream_writer.put(all_final_schedule_entries_for_semester)
+                all_final_schedule_entries_for_semester = ScheduleFrame()
+                memory.note_action("已改为流式写库")
+                emit_progress(progress_callback, 'memory', action='streaming',
+                              current_mb=round(tracemalloc.get_traced_memory()[0] / 2 ** 20, 3))
+
+        solve_finished = True
+        stats.record('solve', phase_started)
+        emit_progress(progress_callback, 'phase', phase='solve', status='finished',
+                      scheduled=summary["total_scheduled_entries"], conflicts=summary["total_conflicts"])
+        check_cancelled(cancel_event)  # 写库 (替换正式课表) 之后不再响应取消
+
+        emit_progress(progress_callback, 'phase', phase='write', status='started')
+        phase_started = SchedulerStats.clock()
+        if affected_majors is not None:
+            # 增量排课: 只替换受影响专业的行
+            with stats.phase('write.replace_majors'):
+                cleared_count, saved_count_total, version_id = replace_major_rows(
+                    target_semester_id, affected_majors, all_final_schedule_entries_for_semester,
+                    series_entries_for_semester, current_fingerprints, get_connection_func,
+                    version_source=summary["mode"])
+        else:
+            with stats.phase('write.flush'):
+                if stream_writer:
+                    stream_writer.close()
+                    stream_writer = None
+                elif all_final_schedule_entries_for_semester:
+                    save_schedule_to_db(all_final_schedule_entries_for_semester, get_connection_func,
+                                        table_name=staging_table)
+
+            with stats.phase('write.swap'):
+                cleared_count, saved_count_total, version_id = swap_staging_into_place(
+                    target_semester_id, staging_table, get_connection_func,
+                    series_entries=series_entries_for_semester, assignment_fingerprints=current_fingerprints,
+                    version_source=summary["mode"])
+            staging_table = None
+        stats.record('write', phase_started)
+        summary["db_records_cleared"] = cleared_count
+        summary["db_records_saved"] = saved_count_total
+        summary["version_id"] = version_id  # 与课表在同一事务内记录
+        emit_progress(progress_callback, 'phase', phase='write', status='finished', saved=saved_count_total)
 
+        if checkpoint is not None:
+            checkpoint.discard()
         summary["status"] = "success"
         summary["message"] = f"学期 {target_semester_id} 排课完成 (采用固定周模板策略)。"
+        if affected_majors is not None:
+            summary["message"] += f" 增量模式，重排专业 {len(affected_majors)} 个。"
         if summary["total_conflicts"] > 0:
             summary["message"] += f" 总记录冲突: {summary['total_conflicts']}次。"
 
+    except SchedulingCancelled as e:
+        logger.info("学期 %s 的排课已取消", target_semester_id, extra={"event": "run.cancelled", "semester_id": target_semester_id})
+        summary["message"] = str(e)
+        summary["status"] = "cancelled"
+        if checkpoint is not None:
+            checkpoint.discard()  # 主动取消不需要续排
+        if stream_writer:
+            stream_writer.abort()
+        if staging_table:
+            drop_staging_table(staging_table, get_connection_func)
+
+    except MemoryBudgetExceeded as e:
+        logger.warning("学期 %s %s", target_semester_id, e, extra={"event": "run.memory_budget_exceeded",
+                                                              "semester_id": target_semester_id})
+        summary["message"] = str(e)
+        summary["status"] = "memory_budget_exceeded"
+        if checkpoint is not None:
+            checkpoint.save(master_global_timetable_state)  # 已排完的专业写入检查点，提高预算后可续排
+        if stream_writer:
+            stream_writer.abort()
+        if staging_table:
+            drop_staging_table(staging_table, get_connection_func)
+
     except Exception as e:
-        print(f"SCHEDULER: 排课主流程发生严重错误: {e}")
-        import traceback; traceback.print_exc() # Keep traceback for debugging errors
+        logger.error("排课主流程发生严重错误: %s", e, exc_info=True,
+                     extra={"event": "run.failed", "semester_id": target_semester_id})
         summary["message"] = f"排课过程中发生错误: {str(e)}"
         summary["status"] = "error"
+        if checkpoint is not None and solve_finished:
+            checkpoint.save(master_global_timetable_state)  # 写库失败时保留完整结果，重试不必重新排课
+        if stream_writer:
+            stream_writer.abort()  # 回滚流式写入的事务
+        if staging_table:
+            drop_staging_table(staging_table, get_connection_func)  # 正式课表保持原样
 
     finally:
         # --- START: Update teacher preference status ---
-        print("SCHEDULER: 排课流程结束，尝试更新所有教师偏好状态...")
+        logger.debug("排课流程结束，尝试更新所有教师偏好状态", extra={"event": "preferences.updating"})
         update_conn = None
         update_cursor = None
         try:
@@ -1090,16 +3303,17 @@ def run_full_scheduling_process(target_semester_id, get_connection_func):
             # Execute the query - pass status as a tuple even if only one value
             update_cursor.execute(update_query, (new_status_value,))
             update_conn.commit()
-            print(f"SCHEDULER: 已尝试更新数据库中所有教师偏好状态为 '{new_status_value}'。影响行数: {update_cursor.rowcount}") # rowcount might work
+            logger.info("已尝试更新数据库中所有教师偏好状态为 '%s'。影响行数: %s", new_status_value, update_cursor.rowcount,
+                        extra={"event": "preferences.updated", "rows": update_cursor.rowcount})
 
         except Exception as update_e:
-            print(f"SCHEDULER: 在 finally 块中更新教师偏好状态时发生错误: {update_e}")
+            logger.error("在 finally 块中更新教师偏好状态时发生错误: %s", update_e, extra={"event": "preferences.update_failed"})
             if update_conn:
                 try:
                     update_conn.rollback()
-                    print("SCHEDULER: 教师偏好状态更新事务已回滚。")
+                    logger.info("教师偏好状态更新事务已回滚", extra={"event": "preferences.rolled_back"})
                 except Exception as rb_e:
-                    print(f"SCHEDULER: 回滚教师偏好状态更新事务时发生错误: {rb_e}")
+                    logger.error("回滚教师偏好状态更新事务时发生错误: %s", rb_e, extra={"event": "preferences.rollback_failed"})
         finally:
             if update_cursor:
                 try: update_cursor.close()
@@ -1109,6 +3323,334 @@ def run_full_scheduling_process(target_semester_id, get_connection_func):
                 except: pass
             # --- END: Update teacher preference status ---
 
+        summary["stats"] = stats.to_dict()
+        if memory is not None:
+            summary["memory"] = memory.to_dict()
+            memory.stop()
         return summary
 
+
+# ==================================
+# 9.1 多学期批量排课
+# ==================================
+# 基础数据只加载一次，各学期在独立的工作进程中并行排课 (学期之间占用状态互不相交)。
+# 工作进程用 spawn 启动，自己按 db_params 建立数据库连接；基础数据在进程初始化时传入一次。
+# 整批的取消事件 (multiprocessing Event) 也在初始化时传入，各学期在自己的取消点检查。
+_batch_worker_context = {}
+
+def _init_batch_worker(db_params, all_data, batch_cancel_event=None):
+    structured_logging.configure()  # spawn 启动的工作进程不继承父进程的日志配置
+    _batch_worker_context['db_params'] = db_params
+    _batch_worker_context['all_data'] = all_data
+    _batch_worker_context['cancel_event'] = batch_cancel_event
+
+class _AnyEvent:
+    """任一事件被设置即视为已设置 (只提供 check_cancelled 用到的 is_set)。"""
+
+    def __init__(self, *events):
+        self._events = [event for event in events if event is not None]
+
+    def is_set(self):
+        return any(event.is_set() for event in self._events)
+
+def _batch_worker_connection():
+    return psycopg2.connect(**_batch_worker_context['db_params'])
+
+def _run_batch_semester(semester_id, options, seed=None, time_budget=None):
+    """工作进程中排一个学期，返回 (学期 ID, 排课摘要, 耗时)。time_budget 秒后取消该学期的排课。"""
+    started_wall = time.perf_counter()
+    started_cpu = time.process_time()
+    cancel_event = threading.Event()
+    budget_timer = threading.Timer(time_budget, cancel_event.set) if time_budget else None
+    if budget_timer:
+        budget_timer.start()
+    try:
+        summary = run_full_scheduling_process(semester_id, _batch_worker_connection,
+                                              all_data=_batch_worker_context['all_data'],
+                                              cancel_event=_AnyEvent(cancel_event,
+                                                                     _batch_worker_context.get('cancel_event')),
+                                              seed=seed, **options)  # 每个学期用同一个种子，结果与单独排该学期一致
+    finally:
+        if budget_timer:
+            budget_timer.cancel()
+    timings = {
+        "wall_seconds": round(time.perf_counter() - started_wall, 3),
+        "cpu_seconds": round(time.process_time() - started_cpu, 3),
+        "worker_pid": os.getpid(),
+    }
+    return semester_id, summary_without_conflicts(summary), timings  # 冲突明细不传回主进程
+
+def run_batch_scheduling(semester_ids, db_params, max_workers=None, seed=None, time_budget=None,
+                         progress_callback=None, cancel_event=None, **options):
+    """
+    批量排多个学期。db_params 为 psycopg2.connect 的参数 (工作进程自行连接)，
+    options 原样传给 run_full_scheduling_process (streaming、storage_mode、incremental 等)。
+    seed 为各学期排课的随机种子；time_budget 为每个学期的最长排课秒数，超时的学期取消且课表不变。
+    progress_callback 在每个学期结束时收到 'semester' 事件；cancel_event (multiprocessing Event)
+    被设置后，正在排和尚未开始的学期都会取消。
+    返回合并摘要: 整体状态、各学期摘要和耗时。
+    """
+    semester_ids = list(dict.fromkeys(semester_ids))  # 去重并保持顺序
+    batch_summary = {
+        "status": "failure",
+        "message": "",
+        "semester_ids": semester_ids,
+        "workers": 0,
+        "load_seconds": 0.0,
+        "total_seconds": 0.0,
+        "semesters": {},
+        "timings": {},
+    }
+    if not semester_ids:
+        batch_summary["message"] = "没有指定要排课的学期。"
+        return batch_summary
+
+    batch_started = time.perf_counter()
+    logger.info("开始批量排课，学期: %s", semester_ids, extra={"event": "batch.started", "semesters": len(semester_ids)})
+    all_data = load_data_from_db(lambda: psycopg2.connect(**db_params))
+    batch_summary["load_seconds"] = round(time.perf_counter() - batch_started, 3)
+
+    workers = max(1, min(max_workers or os.cpu_count() or 1, len(semester_ids)))
+    batch_summary["workers"] = workers
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=_init_batch_worker,
+                                                initargs=(db_params, all_data, cancel_event)) as executor:
+        futures = {executor.submit(_run_batch_semester, semester_id, options, seed, time_budget): semester_id
+                   for semester_id in semester_ids}
+        for future in concurrent.futures.as_completed(futures):
+            semester_id = futures[future]
+            try:
+                _, summary, timings = future.result()
+            except Exception as e:
+                # 工作进程异常退出等情况，不影响其他学期
+                logger.error("批量排课中学期 %s 失败: %s", semester_id, e, extra={"event": "batch.semester_failed",
+                                                                           "semester_id": semester_id})
+                summary, timings = {"status": "error", "message": f"排课进程出错: {e}", "details": []}, {}
+            batch_summary["semesters"][semester_id] = summary
+            batch_summary["timings"][semester_id] = timings
+            logger.info("批量排课学期 %s 结束，状态 %s，耗时 %s 秒", semester_id, summary.get('status'), timings.get('wall_seconds'),
+                        extra={"event": "batch.semester_finished", "semester_id": semester_id,
+                               "status": summary.get("status"), "duration_seconds": timings.get("wall_seconds")})
+            emit_progress(progress_callback, 'semester', semester_id=semester_id, status=summary.get("status"),
+                          index=len(batch_summary["semesters"]), total=len(semester_ids),
+                          wall_seconds=timings.get("wall_seconds"))
+
+    batch_summary["total_seconds"] = round(time.perf_counter() - batch_started, 3)
+    succeeded = [sid for sid in semester_ids
+                 if str(batch_summary["semesters"][sid].get("status", "")).startswith("success")]
+    if len(succeeded) == len(semester_ids):
+        batch_summary["status"] = "success"
+    elif succeeded:
+        batch_summary["status"] = "partial_success"
+    batch_summary["message"] = (f"批量排课完成: {len(succeeded)}/{len(semester_ids)} 个学期成功，"
+                                f"总耗时 {batch_summary['total_seconds']} 秒。")
+    return batch_summary
+
+
+# ==================================
+# 10. 模拟排课 (what-if，不写数据库)
+# ==================================
+def schedule_entry_key(entry):
+    """TimetableEntry 对应的课时键 (与课表版本使用的键一致)。"""
+    return tuple(getattr(entry, col) for col in VERSION_KEY_COLUMNS)
+
+def _override_fields(record, changes, allowed_fields, label):
+    unknown = set(changes) - set(allowed_fields) - {'id'}
+    if unknown:
+        raise ValueError(f"{label} 不支持修改字段: {', '.join(sorted(unknown))}")
+    return record._replace(**{k: v for k, v in changes.items() if k != 'id'})
+
+def apply_simulation_overrides(all_data, semester_id, overrides):
+    """
+    在 all_data 的副本上应用模拟覆盖，原 all_data 不变。支持的覆盖项:
+      closed_buildings: [教学楼名]             closed_classrooms: [教室ID]
+      classroom_changes: [{id, capacity, type}]  course_changes: [{id, total_sessions, course_type}]
+      add_assignments: [{major_id, course_id, teacher_id, expected_students, is_core_course}]
+      update_assignments: [{id, major_id, course_id, teacher_id, expected_students, is_core_course}]
+      remove_assignments: [任务ID]
+      add_avoid_preferences / remove_avoid_preferences: [{teacher_id, timeslot_id}]
+    引用不存在的 ID 时抛出 ValueError。
+    """
+    overrides = overrides or {}
+    sim_data = dict(all_data)
+    classrooms = dict(all_data['classrooms'])
+    courses = dict(all_data['courses'])
+    assignments = dict(all_data['course_assignments'])
+    avoid_preferences = set(all_data.get('approved_avoid_preferences', set()))
+
+    closed_buildings = set(overrides.get('closed_buildings', []))
+    if closed_buildings:
+        buildings = all_data.get('classroom_buildings', {})
+        for classroom_id in [cid for cid in classrooms if buildings.get(cid) in closed_buildings]:
+            del classrooms[classroom_id]
+    for classroom_id in overrides.get('closed_classrooms', []):
+        if classrooms.pop(classroom_id, None) is None and classroom_id not in all_data['classrooms']:
+            raise ValueError(f"教室 {classroom_id} 不存在")
+    for change in overrides.get('classroom_changes', []):
+        if change.get('id') not in classrooms:
+            raise ValueError(f"教室 {change.get('id')} 不存在或已关闭")
+        classrooms[change['id']] = _override_fields(classrooms[change['id']], change, ('capacity', 'type'), "教室")
+
+    for change in overrides.get('course_changes', []):
+        if change.get('id') not in courses:
+            raise ValueError(f"课程 {change.get('id')} 不存在")
+        courses[change['id']] = _override_fields(courses[change['id']], change, ('total_sessions', 'course_type'),
+                                                 "课程")
+
+    assignment_fields = ('major_id', 'course_id', 'teacher_id', 'expected_students', 'is_core_course')
+    for assign_id in overrides.get('remove_assignments', []):
+        if assignments.pop(assign_id, None) is None:
+            raise ValueError(f"教学任务 {assign_id} 不存在")
+    for change in overrides.get('update_assignments', []):
+        if change.get('id') not in assignments:
+            raise ValueError(f"教学任务 {change.get('id')} 不存在")
+        assignments[change['id']] = _override_fields(assignments[change['id']], change, assignment_fields, "教学任务")
+    for index, new_assign in enumerate(overrides.get('add_assignments', []), start=1):
+        missing = [f for f in ('major_id', 'course_id', 'teacher_id') if new_assign.get(f) is None]
+        if missing:
+            raise ValueError(f"新增教学任务缺少字段: {', '.join(missing)}")
+        if new_assign['course_id'] not in courses:
+            raise ValueError(f"课程 {new_assign['course_id']} 不存在")
+        # 模拟新增的任务用负数 ID，不会与数据库中的任务冲突
+        assignments[-index] = CourseAssignment(
+            id=-index, major_id=new_assign['major_id'], course_id=new_assign['course_id'],
+            teacher_id=new_assign['teacher_id'], semester_id=semester_id,
+            is_core_course=bool(new_assign.get('is_core_course', False)),
+            expected_students=int(new_assign.get('expected_students', 0)))
+
+    for pref in overrides.get('add_avoid_preferences', []):
+        avoid_preferences.add((pref['teacher_id'], pref['timeslot_id'], semester_id))
+    for pref in overrides.get('remove_avoid_preferences', []):
+        avoid_preferences.discard((pref['teacher_id'], pref['timeslot_id'], semester_id))
+
+    sim_data['classrooms'] = classrooms
+    sim_data['courses'] = courses
+    sim_data['course_assignments'] = assignments
+    sim_data['approved_avoid_preferences'] = avoid_preferences
+    return sim_data
+
+def schedule_semester_in_memory(all_data, target_semester_id, pinned_entries=(), seed=None, deadline=None,
+                                progress_callback=None):
+    """
+    只在内存中排一个学期 (不连数据库)，固定条目先占位。返回 (排课摘要, 新排出的 TimetableEntry 列表)。
+    seed 为本次排课随机数生成器的种子 (None 时不可复现)，不影响全局 random；deadline (time.monotonic() 时刻) 到了之后不再开始新的专业，
+    摘要中 budget_exhausted=True，skipped_majors 为没来得及排的专业；stats 为分阶段耗时和热点计数。
+    """
+    current_semester = all_data['semesters'].get(target_semester_id)
+    if not current_semester:
+        raise ValueError(f"未找到 ID 为 {target_semester_id} 的学期信息。")
+    summary = {
+        "processed_majors": 0,
+        "total_scheduled_entries": 0,
+        "total_conflicts": 0,
+        "conflict_records": 0,
+        "total_uncompleted_tasks": 0,
+        "details": [],
+        "conflicts": []
+    }
+    assignments_by_major = defaultdict(dict)
+    for assign_id, assign in all_data['course_assignments'].items():
+        if assign.semester_id == target_semester_id:
+            assignments_by_major[assign.major_id][assign_id] = assign
+
+    timetable_state = {'teacher_schedule': set(), 'classroom_schedule': set(), 'major_schedule': set()}
+    seed_timetable_state(timetable_state, pinned_entries)
+    sorted_major_ids = sort_major_ids(assignments_by_major, all_data)
+    schedule_entries = ScheduleFrame()
+    stats = SchedulerStats()
+
+    solved = 0
+    for major_id, major_name, result in solve_majors_in_memory(
+            all_data, current_semester, assignments_by_major, sorted_major_ids,
+            timetable_state, pinned_sessions=count_pinned_sessions(pinned_entries),
+            progress_callback=progress_callback, stats=stats, rng=random.Random(seed)):
+        solved += 1
+        if result is not None:
+            schedule_entries.extend(result.get('schedule', []))
+            accumulate_major_result(summary, major_id, major_name, result)
+        if deadline is not None and time.monotonic() >= deadline and solved < len(sorted_major_ids):
+            summary["budget_exhausted"] = True
+            summary["skipped_majors"] = sorted_major_ids[solved:]
+            break
+    summary["stats"] = stats.to_dict()
+    return summary, schedule_entries
+
+def validate_schedule(all_data, semester_id, schedule_entries):
+    """
+    检查一个学期的课表 (TimetableEntry 可迭代对象)，返回课时完成情况和硬约束违规数:
+    同一周同一时段的教师/教室/专业重复占用、教室容量不足、排进教师避免的时段。
+    教室类型不符 (实验课进普通教室或反之) 是排课允许的退路，只统计不算违规。
+    """
+    required = sum(all_data['courses'][a.course_id].total_sessions
+                   for a in all_data['course_assignments'].values()
+                   if a.semester_id == semester_id and a.course_id in all_data['courses'])
+    seen = {'teacher': set(), 'classroom': set(), 'major': set()}
+    double_booked = dict.fromkeys(seen, 0)
+    capacity_violations = avoid_violations = type_mismatches = placed = 0
+    avoid = all_data.get('approved_avoid_preferences', set())
+    for entry in schedule_entries:
+        placed += 1
+        for kind, resource_id in (('teacher', entry.teacher_id), ('classroom', entry.classroom_id),
+                                  ('major', entry.major_id)):
+            key = (resource_id, entry.week_number, entry.timeslot_id)
+            if key in seen[kind]:
+                double_booked[kind] += 1
+            seen[kind].add(key)
+        assignment = all_data['course_assignments'].get(entry.assignment_id)
+        classroom = all_data['classrooms'].get(entry.classroom_id)
+        if assignment and classroom:
+            if classroom.capacity < (assignment.expected_students or 0):
+                capacity_violations += 1
+            course = all_data['courses'].get(assignment.course_id)
+            if course and (course.course_type == '实验课') != (classroom.type == '实验室'):
+                type_mismatches += 1
+        if (entry.teacher_id, entry.timeslot_id, entry.semester_id) in avoid:
+            avoid_violations += 1
+    return {
+        "required_sessions": required,
+        "placed_sessions": placed,
+        "placement_rate": round(placed / required, 4) if required else 1.0,
+        "double_booked": double_booked,
+        "capacity_violations": capacity_violations,
+        "avoid_violations": avoid_violations,
+        "hard_violations": sum(double_booked.values()) + capacity_violations + avoid_violations,
+        "room_type_mismatches": type_mismatches,
+    }
+
+def simulate_scheduling(target_semester_id, get_connection_func, overrides=None, seed=None, all_data=None,
+                        max_diff_items=500, conflict_details=False):
+    """
+    what-if 模拟: 读取学期数据 (或直接使用传入的 all_data)，应用 overrides 后只在内存中排课，
+    不写任何数据库表 (也不更新教师偏好状态)。返回 {'summary': 排课摘要, 'diff': 与当前课表的差异}。
+    固定条目照常保留，但位于被关闭教室中的固定条目会被释放重排。seed 用于复现同一次模拟。
+    conflict_details 为 True 时摘要中附带冲突说明 (最多 max_diff_items 条)，否则只有冲突计数。
+    """
+    if all_data is None:
+        all_data = load_data_from_db(get_connection_func)
+    current_semester = all_data['semesters'].get(target_semester_id)
+    if not current_semester:
+        raise ValueError(f"未找到 ID 为 {target_semester_id} 的学期信息。")
+    sim_data = apply_simulation_overrides(all_data, target_semester_id, overrides)
+
+    pinned_entries = [e for e in load_pinned_entries(get_connection_func, target_semester_id)
+                      if e.classroom_id is None or e.classroom_id in sim_data['classrooms']]
+    summary, schedule_entries = schedule_semester_in_memory(sim_data, target_semester_id, pinned_entries, seed=seed)
+    simulated_keys = Counter(schedule_entry_key(e) for e in pinned_entries)
+    simulated_keys.update(schedule_entry_key(e) for e in schedule_entries)
+
+    current_keys = load_schedule_keys(get_connection_func, target_semester_id)
+    diff = summarize_session_diff(current_keys - simulated_keys, simulated_keys - current_keys)
+    diff_counts = {name: len(items) for name, items in diff.items()}
+    diff = {name: items[:max_diff_items] for name, items in diff.items()}
+    diff['counts'] = diff_counts
+    diff['truncated'] = any(count > max_diff_items for count in diff_counts.values())
+    summary["current_entries"] = sum(current_keys.values())
+    summary["simulated_entries"] = sum(simulated_keys.values())
+    if conflict_details:
+        summary["conflicts"] = describe_conflicts(summary["conflicts"], sim_data, limit=max_diff_items)
+    else:
+        summary = summary_without_conflicts(summary)
+    return {'summary': summary, 'diff': diff}
+
 # --- End of scheduler_module.py ---
@@ -0,0 +1,303 @@
+# scheduling_jobs.py
+# -*- coding: utf-8 -*-
+# 排课后台任务队列: 排课在独立的子进程中执行 (不占用 Flask 请求线程，也不与 Web 进程争抢 GIL)，
+# 子进程通过队列回传进度事件和最终结果，取消通过共享的 Event 协作完成。
+# 任务记录保存在 Web 进程内存中，只适用于单进程部署 (多进程部署需要把任务表放到数据库或 Redis)。
+import collections
+import multiprocessing
+import threading
+import time
+import traceback
+import uuid
+
+import metrics
+
+# 子进程使用 spawn 启动: 不继承父进程的数据库连接、锁和 Flask 状态
+_MP_CONTEXT = multiprocessing.get_context("spawn")
+
+JOB_STATUS_QUEUED = "queued"
+JOB_STATUS_RUNNING = "running"
+JOB_STATUS_SUCCEEDED = "succeeded"
+JOB_STATUS_FAILED = "failed"
+JOB_STATUS_CANCELLED = "cancelled"
+FINISHED_STATUSES = (JOB_STATUS_SUCCEEDED, JOB_STATUS_FAILED, JOB_STATUS_CANCELLED)
+
+
+def _run_job_in_child(job_id, semester_id, db_params, options, event_queue, cancel_event):
+    """子进程入口: 自己建立数据库连接并运行排课，进度和结果都放进 event_queue。"""
+    import psycopg2
+    import scheduler_module
+    import structured_logging
+
+    structured_logging.configure()  # spawn 启动的子进程不继承父进程的日志配置
+
+    def get_connection():
+        return psycopg2.connect(**db_params)
+
+    def on_progress(event):
+        event_queue.put(("progress", job_id, event))
+
+    try:
+        summary = scheduler_module.run_full_scheduling_process(
+            semester_id, get_connection, progress_callback=on_progress, cancel_event=cancel_event, **options)
+        event_queue.put(("result", job_id, summary))
+    except Exception as e:
+        event_queue.put(("error", job_id, f"{e}\n{traceback.format_exc()}"))
+
+
+def _run_batch_job_in_child(job_id, semester_ids, db_params, options, event_queue, cancel_event):
+    """批量任务的子进程入口: 运行 run_batch_scheduling (它再为各学期启动工作进程池)。"""
+    import scheduler_module
+    import structured_logging
+
+    structured_logging.configure()
+
+    def on_progress(event):
+        event_queue.put(("progress", job_id, event))
+
+    try:
+        summary = scheduler_module.run_batch_scheduling(semester_ids, db_params, progress_callback=on_progress,
+                                                        cancel_event=cancel_event, **options)
+        event_queue.put(("result", job_id, summary))
+    except Exception as e:
+        event_queue.put(("error", job_id, f"{e}\n{traceback.format_exc()}"))
+
+
+class SchedulingJob:
+    """
+    一个排课任务的状态，由 SchedulingJobManager 在持锁时更新。
+    批量任务 (semester_ids 不为 None) 的 semester_id 为 None，摘要为 run_batch_scheduling 的合并摘要。
+    """
+
+    def __init__(self, semester_id, options, max_events=1000, semester_ids=None):
+        self.id = uuid.uuid4().hex
+        self.semester_id = semester_id
+        self.semester_ids = list(semester_ids) if semester_ids is not None else None
+        self.options = dict(options)
+        self.status = JOB_STATUS_QUEUED
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.phase = None
+        self.progress = {}
+        self.events = collections.deque(maxlen=max_events)
+        self.event_count = 0  # 累计事件数，events 只保留最近 max_events 条
+        self.summary = None
+        self.error = None
+        self.cancel_event = _MP_CONTEXT.Event()
+        self.process = None
+        self.done = threading.Event()
+
+    def to_dict(self, include_events=False):
+        data = {
+            "job_id": self.id,
+            "kind": "batch" if self.is_batch else "semester",
+            "semester_id": self.semester_id,
+            "semester_ids": self.semester_ids,
+            "options": self.options,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "phase": self.phase,
+            "progress": self.progress,
+            # 冲突明细 (ConflictRecord 列表) 不放进状态，由 /api/schedule/jobs/<id>/conflicts 按需展开
+            "summary": ({key: value for key, value in self.summary.items() if key != "conflicts"}
+                        if isinstance(self.summary, dict) else self.summary),
+            "error": self.error,
+        }
+        if include_events:
+            data["events"] = list(self.events)
+        return data
+
+    @property
+    def is_batch(self):
+        return self.semester_ids is not None
+
+    def covers(self, semester_id):
+        return semester_id in self.semester_ids if self.is_batch else self.semester_id == semester_id
+
+
+class SchedulingJobManager:
+    """
+    本地排课任务队列。submit() 立即返回任务，max_workers 个调度线程依次取任务，
+    每个任务启动一个子进程执行 run_full_scheduling_process 并等待其结束。
+    submit_batch() 提交多学期批量任务，子进程执行 run_batch_scheduling。
+    """
+
+    def __init__(self, db_params, max_workers=1, max_finished_jobs=100):
+        self._db_params = dict(db_params)
+        self._max_workers = max_workers
+        self._max_finished_jobs = max_finished_jobs
+        self._jobs = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)  # 任务有新事件或状态变化时通知等待者
+        self._pending = None
+        self._event_queue = None
+        self._started = False
+
+    def _ensure_started(self):
+        # 第一次提交任务时才启动线程和事件队列，导入本模块本身没有副作用
+        if self._started:
+            return
+        self._pending = collections.deque()
+        self._pending_ready = threading.Semaphore(0)
+        self._event_queue = _MP_CONTEXT.Queue()
+        threading.Thread(target=self._drain_events, name="scheduling-job-events", daemon=True).start()
+        for i in range(self._max_workers):
+            threading.Thread(target=self._dispatch, name=f"scheduling-job-worker-{i}", daemon=True).start()
+        self._started = True
+
+    def submit(self, semester_id, **options):
+        """提交一个排课任务，options 原样传给 run_full_scheduling_process (streaming、storage_mode 等)。"""
+        with self._lock:
+            job = self._enqueue(SchedulingJob(semester_id, options))
+        self._pending_ready.release()
+        return job
+
+    def submit_batch(self, semester_ids, **options):
+        """提交一个批量排课任务，options 原样传给 run_batch_scheduling (max_workers、streaming 等)。"""
+        with self._lock:
+            job = self._enqueue(SchedulingJob(None, options, semester_ids=semester_ids))
+        self._pending_ready.release()
+        return job
+
+    def submit_or_join(self, semester_id, **options):
+        """
+        同一学期、相同参数的任务还在排队或运行时直接返回该任务 (合并重复请求)，否则提交新任务。
+        返回 (job, joined)。
+        """
+        with self._lock:
+            for job in self._jobs.values():
+                if (not job.is_batch and job.semester_id == semester_id and job.options == options
+                        and job.status not in FINISHED_STATUSES and not job.cancel_event.is_set()):
+                    return job, True
+            job = self._enqueue(SchedulingJob(semester_id, options))
+        self._pending_ready.release()
+        return job, False
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def snapshot(self, job_id, include_events=False):
+        """返回任务状态的字典副本，任务不存在时返回 None。"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job.to_dict(include_events) if job else None
+
+    def list_jobs(self, semester_id=None):
+        with self._lock:
+            return [job.to_dict() for job in reversed(self._jobs.values())
+                    if semester_id is None or job.covers(semester_id)]
+
+    def cancel(self, job_id):
+        """请求取消任务: 排队中的任务直接取消，运行中的任务在下一个检查点停止。返回 False 表示任务已结束或不存在。"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED_STATUSES:
+                return False
+            job.cancel_event.set()
+            if job.status == JOB_STATUS_QUEUED:
+                self._finish(job, JOB_STATUS_CANCELLED, error="任务在开始前被取消")
+            return True
+
+    def wait_for_events(self, job_id, after_count, timeout=None):
+        """
+        等待任务产生第 after_count 条之后的事件或结束。返回 (新事件列表, 当前事件总数, 任务状态字典)。
+        事件缓冲只保留最近的事件，落后太多的调用方会跳过中间被丢弃的部分。
+        """
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return [], after_count, None
+            self._changed.wait_for(lambda: job.event_count > after_count or job.status in FINISHED_STATUSES,
+                                   timeout=timeout)
+            new_count = job.event_count - after_count
+            events = list(job.events)[-new_count:] if new_count > 0 else []
+            return events, job.event_count, job.to_dict()
+
+    # --- 内部实现 ---
+    def _enqueue(self, job):
+        self._ensure_started()
+        self._jobs[job.id] = job
+        self._pending.append(job)
+        self._prune_finished()
+        return job
+
+    def _dispatch(self):
+        while True:
+            self._pending_ready.acquire()
+            with self._lock:
+                job = self._pending.popleft()
+                if job.status != JOB_STATUS_QUEUED:  # 排队时已被取消
+                    continue
+                job.status = JOB_STATUS_RUNNING
+                job.started_at = time.time()
+                # 批量任务的子进程要再启动工作进程池，daemon 进程不能有子进程，所以不设 daemon
+                job.process = _MP_CONTEXT.Process(
+                    target=_run_batch_job_in_child if job.is_batch else _run_job_in_child,
+                    args=(job.id, job.semester_ids if job.is_batch else job.semester_id, self._db_params,
+                          job.options, self._event_queue, job.cancel_event),
+                    name=f"scheduling-job-{job.id[:8]}", daemon=not job.is_batch)
+                self._changed.notify_all()
+            try:
+                job.process.start()
+                job.process.join()
+            except Exception as e:
+                with self._lock:
+                    self._finish(job, JOB_STATUS_FAILED, error=f"无法启动排课进程: {e}")
+                continue
+            # 子进程退出后等结果事件被取走；超时仍没有结果说明子进程异常退出 (例如被系统杀掉)
+            if not job.done.wait(timeout=5):
+                with self._lock:
+                    self._finish(job, JOB_STATUS_FAILED, error=f"排课进程异常退出 (exitcode={job.process.exitcode})")
+
+    def _drain_events(self):
+        while True:
+            kind, job_id, payload = self._event_queue.get()
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is None or job.status in FINISHED_STATUSES:
+                    continue
+                if kind == "progress":
+                    self._record_event(job, payload)
+                elif kind == "result":
+                    # 子进程的排课指标在 Web 进程中记录
+                    for summary in (payload["semesters"].values() if job.is_batch else (payload,)):
+                        metrics.record_scheduling_run(summary)
+                    status = payload.get("status", "failure")
+                    if status == "cancelled" or (job.is_batch and job.cancel_event.is_set()
+                                                 and not status.startswith("success")):
+                        self._finish(job, JOB_STATUS_CANCELLED, summary=payload)
+                    elif status.startswith("success"):
+                        self._finish(job, JOB_STATUS_SUCCEEDED, summary=payload)
+                    else:
+                        self._finish(job, JOB_STATUS_FAILED, summary=payload, error=payload.get("message"))
+                else:
+                    self._finish(job, JOB_STATUS_FAILED, error=payload)
+
+    def _record_event(self, job, event):
+        job.events.append(event)
+        job.event_count += 1
+        if event.get("type") == "phase":
+            job.phase = event.get("phase")
+        elif event.get("type") == "major":
+            job.progress = {k: event.get(k) for k in ("index", "total", "major_id", "major_name",
+                                                      "wall_seconds", "cpu_seconds")}
+        elif event.get("type") == "semester":
+            job.progress = {k: event.get(k) for k in ("index", "total", "semester_id", "status", "wall_seconds")}
+        self._changed.notify_all()
+
+    def _finish(self, job, status, summary=None, error=None):
+        job.status = status
+        job.summary = summary
+        job.error = error
+        job.finished_at = time.time()
+        self._record_event(job, {"type": "finished", "status": status, "time": job.finished_at})
+        job.done.set()
+
+    def _prune_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in FINISHED_STATUSES]
+        for job_id in finished[:max(0, len(finished) - self._max_finished_jobs)]:
+            del self._jobs[job_id]
@@ -0,0 +1,43 @@
+# singleflight.py
+# -*- coding: utf-8 -*-
+# 进程内请求合并 (single-flight): 同一 key 的并发调用只真正执行一次，其余调用等待并共享同一个结果或异常。
+# 只合并"同时在进行"的调用，调用结束后 key 立即移除，不做缓存。
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """按 key 合并并发调用。key 需要可哈希，例如 ('export', semester_id)。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        """执行 fn() 或等待同 key 的进行中调用，返回 (结果, shared)；shared=True 表示结果来自其他请求的调用。"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
@@ -0,0 +1,144 @@
+# structured_logging.py
+# -*- coding: utf-8 -*-
+# 结构化日志: 每条日志输出为一行 JSON (LOG_FORMAT=text 时为普通文本)。
+# 固定字段: ts, level, logger, event, msg, pid, thread；调用方通过 extra 附加的字段 (semester_id、major_id、
+# duration_ms 等) 原样输出，便于按 event 聚合。例如
+#   logger.info("专业排课完成", extra={"event": "major.finished", "major_id": 3, "entries": 512})
+# 输出链路: 根 logger -> NonBlockingQueueHandler (调用线程只把记录放进队列，队列满时丢弃并计数，不阻塞排课)
+#           -> QueueListener 后台线程 -> StreamHandler (格式化和写 stderr 都在后台线程)。
+# 级别由 LOG_LEVEL 控制 (默认 INFO)；逐时段的 DEBUG 跟踪在调用处用 logger.isEnabledFor(logging.DEBUG)
+# 预先判断，关闭时不构造日志参数。
+# 每个进程 (Web 进程、排课子进程、批量排课工作进程、命令行) 启动时调用一次 configure()。
+import atexit
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()  # json | text
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# LogRecord 自带的属性，其余属性都是调用方通过 extra 附加的字段
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+_listener = None
+_queue_handler = None
+_configure_lock = threading.Lock()
+
+
+def record_fields(record):
+    """调用方通过 extra 附加的字段 (不含 event)。"""
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS and key != "event"}
+
+
+class JsonFormatter(logging.Formatter):
+    """一条记录一行 JSON。"""
+
+    def format(self, record):
+        event = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(
+                timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": getattr(record, "event", None),
+            "msg": record.getMessage(),
+            "pid": record.process,
+            "thread": record.threadName,
+        }
+        event.update(record_fields(record))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            event["exc"] = record.exc_text
+        return json.dumps(event, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """本地调试用: 普通文本，附加字段以 key=value 形式跟在消息后面。"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        text = super().format(record)
+        fields = record_fields(record)
+        if getattr(record, "event", None):
+            fields = {"event": record.event, **fields}
+        if fields:
+            first_line, _, rest = text.partition("\n")
+            text = first_line + " " + " ".join(f"{key}={value}" for key, value in fields.items()) + (
+                "\n" + rest if rest else "")
+        return text
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """队列满时丢弃记录并计数，而不是阻塞调用线程。"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record):
+        # 在调用线程里把消息和异常格式化成字符串 (参数对象之后可能被修改)，附加字段保留给后台线程的格式化器
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+
+def configure(level=None, log_format=None, stream=None):
+    """给根 logger 装上队列处理器并启动后台输出线程。每个进程只生效一次，之后的调用直接返回。"""
+    global _listener, _queue_handler
+    with _configure_lock:
+        if _listener is not None:
+            return
+        output = logging.StreamHandler(stream or sys.stderr)
+        output.setFormatter(TextFormatter() if (log_format or LOG_FORMAT) == "text" else JsonFormatter())
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        _queue_handler = NonBlockingQueueHandler(log_queue)
+        root = logging.getLogger()
+        root.addHandler(_queue_handler)
+        root.setLevel(level or LOG_LEVEL)
+        _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown)
+
+
+def dropped_records():
+    """队列满而丢弃的记录数。"""
+    return _queue_handler.dropped if _queue_handler is not None else 0
+
+
+def shutdown():
+    """停止后台线程 (先写完队列中已有的记录)。进程退出时自动调用。"""
+    global _listener, _queue_handler
+    with _configure_lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        if _queue_handler.dropped:
+            for handler in _listener.handlers:
+                handler.handle(logging.makeLogRecord({
+                    "name": __name__, "levelno": logging.WARNING, "levelname": "WARNING",
+                    "msg": f"日志队列已满，丢弃了 {_queue_handler.dropped} 条日志",
+                    "event": "logging.dropped", "dropped": _queue_handler.dropped}))
+        logging.getLogger().removeHandler(_queue_handler)
+        _listener = None
+        _queue_handler = None
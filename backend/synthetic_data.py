@@ -0,0 +1,157 @@
+# synthetic_data.py
+# -*- coding: utf-8 -*-
+# 合成数据生成器: 按指定规模 (5 ~ 500 个专业) 生成一所"虚拟大学"的基础数据，结构与
+# scheduler_module.load_data_from_db 的返回值相同，可直接交给排课函数，或写成快照供 scheduler_cli 使用:
+#   python synthetic_data.py --majors 50 --seed 1 --output uni50.json
+#   python scheduler_cli.py --snapshot uni50.json --semester 1 --seed 1 --output out.json
+import argparse
+import datetime
+import math
+import random
+import sys
+
+import scheduler_module
+from scheduler_module import (Semester, Major, Teacher, Classroom, Course, TimeSlot, CourseAssignment)
+
+DAYS = ['周一', '周二', '周三', '周四', '周五']
+PERIOD_TIMES = [(datetime.time(8, 0), datetime.time(9, 40)), (datetime.time(10, 0), datetime.time(11, 40)),
+                (datetime.time(14, 0), datetime.time(15, 40)), (datetime.time(16, 0), datetime.time(17, 40))]
+BUILDINGS = ['教学楼A', '教学楼B', '教学楼C', '实验楼']
+CLASSROOM_CAPACITIES = [40, 60, 90, 120, 180]
+LAB_CAPACITIES = [40, 60]
+# 理论课的总课时占学期周数的比例。排课时一个教学任务每周最多排一次 (第一周模板复制到各周)，
+# 总课时超过周数的部分永远排不进去，所以生成的课时数不超过周数，placement_rate 下降即说明排课变差
+COURSE_WEEK_SHARES = [0.5, 0.75, 1.0, 1.0]
+
+
+def generate_university(n_majors=5, seed=0, n_semesters=1, courses_per_major=8, lab_courses_per_major=2,
+                        teacher_ratio=2.5, max_teacher_load=4, classroom_ratio=1.2, lab_ratio=0.3,
+                        avoid_rate=0.1, weeks=16, start_date=datetime.date(2025, 9, 1)):
+    """
+    生成与 load_data_from_db 结构相同的 all_data。规模参数:
+      n_majors            专业数
+      courses_per_major   每个专业每学期的教学任务数，其中 lab_courses_per_major 门为实验课
+      teacher_ratio       教师数 = 专业数 * teacher_ratio，教师在专业间共享，每学期最多 max_teacher_load 个任务
+      classroom_ratio     普通教室数 = 专业数 * classroom_ratio，实验室数 = 专业数 * lab_ratio (至少 1 间)
+      avoid_rate          每位教师提出一个"避免安排"时段的概率
+    同样的参数和 seed 总是生成同样的数据。
+    """
+    if n_majors < 1:
+        raise ValueError("专业数必须大于 0")
+    if lab_courses_per_major > courses_per_major:
+        raise ValueError("实验课数不能超过每个专业的课程数")
+    rnd = random.Random(seed)
+    all_data = {}
+
+    all_data['semesters'] = {}
+    for sid in range(1, n_semesters + 1):
+        begin = start_date + datetime.timedelta(weeks=26 * (sid - 1))
+        end = begin + datetime.timedelta(days=7 * weeks - 1)
+        all_data['semesters'][sid] = Semester(id=sid, name=f"合成学期{sid}", start_date=begin, end_date=end,
+                                              total_weeks=math.ceil(((end - begin).days + 1) / 7))
+
+    all_data['timeslots'] = {}
+    for day in DAYS:
+        for period, (begin, end) in enumerate(PERIOD_TIMES, start=1):
+            ts_id = len(all_data['timeslots']) + 1
+            all_data['timeslots'][ts_id] = TimeSlot(id=ts_id, day_of_week=day, period=period,
+                                                    start_time=begin, end_time=end)
+    all_data['timeslot_lookup'] = {(ts.day_of_week, ts.period): ts.id for ts in all_data['timeslots'].values()}
+
+    all_data['majors'] = {mid: Major(id=mid, name=f"专业{mid:03d}") for mid in range(1, n_majors + 1)}
+
+    n_teachers = max(2, round(n_majors * teacher_ratio))
+    all_data['teachers'] = {tid: Teacher(id=tid, user_id=1000 + tid, name=f"teacher{tid:04d}")
+                            for tid in range(1, n_teachers + 1)}
+
+    all_data['classrooms'] = {}
+    all_data['classroom_buildings'] = {}
+    n_rooms = max(1, round(n_majors * classroom_ratio))
+    n_labs = max(1, round(n_majors * lab_ratio))
+    for index in range(n_rooms + n_labs):
+        cid = index + 1
+        is_lab = index >= n_rooms
+        building = BUILDINGS[-1] if is_lab else BUILDINGS[index % (len(BUILDINGS) - 1)]
+        room_number = f"{100 + index // 3 + 1}{index % 3}"
+        all_data['classroom_buildings'][cid] = building
+        all_data['classrooms'][cid] = Classroom(
+            id=cid, name=f"{building}-{room_number}",
+            capacity=rnd.choice(LAB_CAPACITIES if is_lab else CLASSROOM_CAPACITIES),
+            type='实验室' if is_lab else '普通教室')
+
+    # 教学任务: 每个专业每学期 courses_per_major 门课，教师按剩余负载随机分配 (负载满了才放宽上限)
+    all_data['courses'] = {}
+    all_data['course_assignments'] = {}
+    for sid in all_data['semesters']:
+        teacher_load = {tid: 0 for tid in all_data['teachers']}
+        for mid in all_data['majors']:
+            cohort = rnd.choice([30, 40, 50, 60, 80, 100])
+            for k in range(courses_per_major):
+                is_lab = k >= courses_per_major - lab_courses_per_major
+                course_id = len(all_data['courses']) + 1
+                all_data['courses'][course_id] = Course(
+                    id=course_id, name=f"课程{course_id:05d}",
+                    total_sessions=weeks if is_lab else max(1, round(weeks * rnd.choice(COURSE_WEEK_SHARES))),
+                    course_type='实验课' if is_lab else '理论课')
+                available = [tid for tid, load in teacher_load.items() if load < max_teacher_load]
+                teacher_id = rnd.choice(available or list(teacher_load))
+                teacher_load[teacher_id] += 1
+                assignment_id = len(all_data['course_assignments']) + 1
+                all_data['course_assignments'][assignment_id] = CourseAssignment(
+                    id=assignment_id, major_id=mid, course_id=course_id, teacher_id=teacher_id, semester_id=sid,
+                    is_core_course=k < 3, expected_students=min(cohort, 60) if is_lab else cohort)
+
+    all_data['approved_avoid_preferences'] = set()
+    timeslot_ids = list(all_data['timeslots'])
+    for sid in all_data['semesters']:
+        for tid in all_data['teachers']:
+            if rnd.random() < avoid_rate:
+                all_data['approved_avoid_preferences'].add((tid, rnd.choice(timeslot_ids), sid))
+    return all_data
+
+
+def describe(all_data):
+    """
+    数据规模摘要 (各类记录数和总课时)。placeable_sessions 为按每周最多一次计、学期内能排下的课时数，
+    与 required_sessions 不同时说明数据中有排课算法无法满足的需求 (例如从数据库导出的快照)。
+    """
+    total_weeks = {sid: semester.total_weeks for sid, semester in all_data['semesters'].items()}
+    return {
+        "semesters": len(all_data['semesters']),
+        "majors": len(all_data['majors']),
+        "teachers": len(all_data['teachers']),
+        "classrooms": sum(1 for c in all_data['classrooms'].values() if c.type == '普通教室'),
+        "labs": sum(1 for c in all_data['classrooms'].values() if c.type == '实验室'),
+        "timeslots": len(all_data['timeslots']),
+        "assignments": len(all_data['course_assignments']),
+        "required_sessions": sum(all_data['courses'][a.course_id].total_sessions
+                                 for a in all_data['course_assignments'].values()),
+        "placeable_sessions": sum(min(all_data['courses'][a.course_id].total_sessions,
+                                      total_weeks.get(a.semester_id, 0))
+                                  for a in all_data['course_assignments'].values()),
+        "avoid_preferences": len(all_data['approved_avoid_preferences']),
+    }
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="生成合成排课数据快照 (JSON，或以 .parquet 结尾的目录)")
+    parser.add_argument('--majors', type=int, default=5, help="专业数 (5 ~ 500)")
+    parser.add_argument('--semesters', type=int, default=1)
+    parser.add_argument('--courses-per-major', type=int, default=8)
+    parser.add_argument('--avoid-rate', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', '-o', required=True, help="快照路径")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    all_data = generate_university(args.majors, seed=args.seed, n_semesters=args.semesters,
+                                   courses_per_major=args.courses_per_major, avoid_rate=args.avoid_rate)
+    scheduler_module.save_data_snapshot(args.output, all_data)
+    print(f"SYNTHETIC: 已写入 {args.output}: {describe(all_data)}", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# 冲突记录 (ConflictLog) 的周次合并与 describe_conflicts 展示测试，不需要数据库。
+import os
+import pickle
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from scheduler_module import (  # noqa: E402
+    CONFLICT_AVOID_PREFERENCE, CONFLICT_CLASSROOM_BUSY, CONFLICT_TEACHER_BUSY, ConflictLog, ConflictRecord,
+    describe_conflicts,
+)
+
+TEACHER_AND_ROOM = CONFLICT_TEACHER_BUSY | CONFLICT_CLASSROOM_BUSY
+
+
+def test_adjacent_weeks_with_same_reason_merge():
+    log = ConflictLog()
+    for week in (2, 3, 4):
+        log.add(1, 10, 5, week, TEACHER_AND_ROOM)
+
+    assert list(log) == [ConflictRecord(1, 10, 5, 2, 4, TEACHER_AND_ROOM)]
+    assert len(log) == 1
+    assert log.weeks() == 3
+
+
+def test_gap_or_reason_change_starts_new_record():
+    log = ConflictLog()
+    log.add(1, 10, 5, 2, CONFLICT_TEACHER_BUSY)
+    log.add(1, 10, 5, 3, CONFLICT_TEACHER_BUSY)
+    log.add(1, 10, 5, 5, CONFLICT_TEACHER_BUSY)  # 跳过第 4 周
+    log.add(1, 10, 5, 6, TEACHER_AND_ROOM)  # 原因变了
+    log.add(1, 10, 5, 7, TEACHER_AND_ROOM)
+
+    assert [(r.week_start, r.week_end, r.reason) for r in log] == [
+        (2, 3, CONFLICT_TEACHER_BUSY), (5, 5, CONFLICT_TEACHER_BUSY), (6, 7, TEACHER_AND_ROOM)]
+    assert log.weeks() == 5
+
+
+def test_different_slots_are_tracked_separately():
+    log = ConflictLog()
+    log.add(1, 10, 5, 2, CONFLICT_TEACHER_BUSY)
+    log.add(1, 10, 6, 2, CONFLICT_TEACHER_BUSY)  # 同一任务的另一个时段
+    log.add(1, 11, 5, 2, CONFLICT_TEACHER_BUSY)  # 同一时段的另一个任务
+    log.add(1, 10, 5, 3, CONFLICT_TEACHER_BUSY)
+
+    assert [(r.assignment_id, r.timeslot_id, r.week_start, r.week_end) for r in log] == [
+        (10, 5, 2, 3), (10, 6, 2, 2), (11, 5, 2, 2)]
+
+
+def test_pickle_round_trip_keeps_merging():
+    log = ConflictLog()
+    log.add(1, 10, 5, 2, CONFLICT_TEACHER_BUSY)
+    log.add(1, 10, 5, 3, CONFLICT_TEACHER_BUSY)
+
+    restored = pickle.loads(pickle.dumps(log))
+    assert list(restored) == list(log)
+
+    restored.add(1, 10, 5, 4, CONFLICT_TEACHER_BUSY)
+    assert list(restored) == [ConflictRecord(1, 10, 5, 2, 4, CONFLICT_TEACHER_BUSY)]
+
+
+def test_from_records_accepts_plain_lists():
+    # 检查点中的记录是 JSON 列表
+    log = ConflictLog.from_records([[1, 10, 5, 2, 3, CONFLICT_TEACHER_BUSY]])
+    log.add(1, 10, 5, 4, CONFLICT_TEACHER_BUSY)
+
+    assert list(log) == [ConflictRecord(1, 10, 5, 2, 4, CONFLICT_TEACHER_BUSY)]
+
+
+@pytest.fixture
+def all_data():
+    return {
+        'majors': {1: SimpleNamespace(name="计算机"), 2: SimpleNamespace(name="数学")},
+        'course_assignments': {10: SimpleNamespace(course_id=100, teacher_id=1000),
+                               11: SimpleNamespace(course_id=101, teacher_id=1001)},
+        'courses': {100: SimpleNamespace(name="数据结构"), 101: SimpleNamespace(name="高等数学")},
+        'teachers': {1000: SimpleNamespace(name="张老师"), 1001: SimpleNamespace(name="李老师")},
+        'timeslots': {5: SimpleNamespace(day_of_week="星期一", period=1),
+                      6: SimpleNamespace(day_of_week="星期二", period=3)},
+    }
+
+
+def test_describe_conflicts_orders_by_weeks_and_applies_limit(all_data):
+    records = [
+        ConflictRecord(2, 11, 6, 3, 3, CONFLICT_AVOID_PREFERENCE),
+        ConflictRecord(1, 10, 5, 2, 9, TEACHER_AND_ROOM),
+        ConflictRecord(1, 10, 6, 4, 6, CONFLICT_TEACHER_BUSY),
+    ]
+
+    described = describe_conflicts(records, all_data)
+    assert [(d["major_id"], d["week_start"], d["week_end"]) for d in described] == [(1, 2, 9), (1, 4, 6), (2, 3, 3)]
+
+    first = described[0]
+    assert first["major_name"] == "计算机"
+    assert first["course_name"] == "数据结构"
+    assert first["teacher_name"] == "张老师"
+    assert first["reasons"] == ['teacher_busy', 'classroom_busy']
+    assert first["message"] == "第 2-9 周 星期一 第 1 节 数据结构: 教师冲突 (已安排其它课程)、教室冲突 (已被占用)"
+    assert described[2]["message"].startswith("第 3 周 星期二 第 3 节 高等数学")
+
+    assert describe_conflicts(records, all_data, limit=2) == described[:2]
+
+
+def test_describe_conflicts_tolerates_missing_lookup_data(all_data):
+    described = describe_conflicts([ConflictRecord(9, 99, 77, 1, 1, CONFLICT_TEACHER_BUSY)], all_data)
+
+    assert described[0]["course_name"] is None
+    assert described[0]["message"] == "第 1 周 时段 77 未知课程: 教师冲突 (已安排其它课程)"
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# 指标注册表的合并与 Prometheus 文本输出测试，不需要数据库。
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import metrics  # noqa: E402
+
+
+def _exited_pid():
+    """一个已经退出的进程的 pid。"""
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def _write_process_file(directory, pid, registry):
+    """模拟另一个进程 flush 出的指标文件。"""
+    with open(os.path.join(directory, f"metrics_{pid}.json"), "w", encoding="utf-8") as f:
+        json.dump({"pid": pid, "metrics": registry.snapshot()}, f)
+
+
+def _process_registry(requests, latencies, open_connections):
+    registry = metrics.Registry()
+    metrics.Counter("requests_total", "请求数", ("route",), registry=registry).inc(requests, route="/a")
+    histogram = metrics.Histogram("latency_seconds", "耗时", buckets=(0.1, 1), registry=registry)
+    for value in latencies:
+        histogram.observe(value)
+    metrics.Gauge("connections_open", "打开的连接数", registry=registry).set(open_connections)
+    return registry
+
+
+@pytest.fixture
+def collecting_registry(tmp_path):
+    # 直接设置 multiproc_dir，避免构造函数注册 atexit 写文件
+    registry = metrics.Registry()
+    registry.multiproc_dir = str(tmp_path)
+    return registry
+
+
+def test_counters_and_histograms_merge_across_process_files(tmp_path, collecting_registry):
+    _write_process_file(str(tmp_path), os.getppid(), _process_registry(2, [0.05, 0.5], 3))
+    _write_process_file(str(tmp_path), _exited_pid(), _process_registry(5, [0.05, 7], 4))
+
+    merged = collecting_registry._collect()
+
+    assert merged["requests_total"]["samples"] == [[["/a"], 7]]
+    assert merged["latency_seconds"]["samples"] == [[[], [[2, 1], 7.6, 4]]]
+    # 已退出进程的仪表不再计入
+    assert merged["connections_open"]["samples"] == [[[], 3]]
+
+
+def test_own_process_file_is_replaced_by_live_values(tmp_path, collecting_registry):
+    metrics.Counter("requests_total", "请求数", registry=collecting_registry).inc(1)
+    collecting_registry.flush()
+    collecting_registry.metrics["requests_total"].inc(1)
+
+    assert collecting_registry._collect()["requests_total"]["samples"] == [[[], 2]]
+
+
+def test_merge_dump_adds_new_label_sets():
+    target = {"type": "counter", "samples": [[["a"], 1]]}
+    metrics._merge_dump(target, {"type": "counter", "samples": [[["a"], 2], [["b"], 5]]})
+
+    assert sorted(target["samples"]) == [[["a"], 3], [["b"], 5]]
+
+
+def test_render_histogram_buckets_are_cumulative():
+    registry = metrics.Registry()
+    histogram = metrics.Histogram("latency_seconds", "耗时", ("route",), buckets=(0.1, 1, 2.5),
+                                  registry=registry)
+    for value in (0.05, 0.05, 0.5, 2, 10):
+        histogram.observe(value, route="/a")
+
+    lines = registry.render().splitlines()
+
+    assert lines[:2] == ["# HELP latency_seconds 耗时", "# TYPE latency_seconds histogram"]
+    assert lines[2:] == [
+        'latency_seconds_bucket{route="/a",le="0.1"} 2',
+        'latency_seconds_bucket{route="/a",le="1"} 3',
+        'latency_seconds_bucket{route="/a",le="2.5"} 4',
+        'latency_seconds_bucket{route="/a",le="+Inf"} 5',
+        'latency_seconds_sum{route="/a"} 12.6',
+        'latency_seconds_count{route="/a"} 5',
+    ]
+
+
+def test_render_escapes_label_values():
+    registry = metrics.Registry()
+    metrics.Counter("requests_total", "请求数", ("route",), registry=registry).inc(route='/a"b\\')
+
+    assert 'requests_total{route="/a\\"b\\\\"} 1' in registry.render().splitlines()